@@ -1,6 +1,6 @@
 # distbuild/__init__.py -- library for Morph's distributed build plugin
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,7 +18,9 @@
 
 from stringbuffer import StringBuffer
 from sm import StateMachine
-from eventsrc import EventSource
+from poller import (Poller, SelectPoller, EpollPoller, new_poller,
+                    READ, WRITE, EXCEPT)
+from eventsrc import EventSource, FileDescriptorEventSource
 from socketsrc import (SocketError, NewConnection, ListeningSocketEventSource,
                        SocketReadable, SocketWriteable, SocketEventSource,
                        set_nonblocking)
@@ -30,12 +32,16 @@ from jm import JsonMachine, JsonNewMessage, JsonEof
 
 from serialise import serialise_artifact, deserialise_artifact
 from idgen import IdentifierGenerator
+from build_times import BuildTimes
+from bloomfilter import BloomFilter
 from route_map import RouteMap
 from timer_event_source import TimerEventSource, Timer
 from proxy_event_source import ProxyEventSource
 from json_router import JsonRouter
 from helper_router import (HelperRouter, HelperRequest, HelperOutput, 
                            HelperResult)
+from helper_machine import (HelperMachine, ForkedProcess,
+                            SubprocessEventSource)
 from initiator_connection import (InitiatorConnection, InitiatorDisconnect)
 from connection_machine import (ConnectionMachine, InitiatorConnectionMachine,
                                 Reconnect, StopConnecting)
@@ -49,7 +55,9 @@ from worker_build_scheduler import (WorkerBuildQueuer,
                                     WorkerBuildWaiting,
                                     WorkerBuildFinished,
                                     WorkerBuildFailed,
-                                    WorkerBuildStepStarted)
+                                    WorkerBuildStepStarted,
+                                    artifact_summary_key,
+                                    repo_summary_key)
 from build_controller import (BuildController, BuildFailed, BuildProgress,
                               BuildSteps, BuildStepStarted,
                               BuildStepAlreadyStarted, BuildOutput,
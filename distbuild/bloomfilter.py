@@ -0,0 +1,109 @@
+# distbuild/bloomfilter.py -- compact summaries of sets of strings
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+
+class BloomFilter(object):
+
+    '''A set of strings that takes a fixed, small amount of space.
+
+    Strings can be added, and tested for, but not removed or listed.
+    Testing for a string that was added always succeeds; testing for one
+    that was not usually fails, but succeeds by mistake for a small
+    fraction of strings, which depends on how full the filter is.
+
+    ``bit_count`` bits are set by ``hash_count`` hashes of each string.
+    Use ``for_capacity`` to choose them for a number of strings.
+
+    '''
+
+    def __init__(self, bit_count, hash_count, bits=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        if bits is None:
+            bits = bytearray((bit_count + 7) / 8)
+        self._bits = bits
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        '''Return a filter for up to capacity strings.
+
+        Once it holds that many, testing for strings that are not in it
+        succeeds for about error_rate of them.
+
+        '''
+
+        capacity = max(capacity, 1)
+        bit_count = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        hash_count = max(1, int(round(
+            float(bit_count) / capacity * math.log(2))))
+        return cls(bit_count, hash_count)
+
+    def _positions(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        # Derive all the hashes from two, as Kirsch and Mitzenmacher show
+        # works as well as independent ones.
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(s).digest())
+        return ((h1 + i * h2) % self.bit_count
+                for i in xrange(self.hash_count))
+
+    def add(self, s):
+        '''Add a string to the filter.'''
+
+        for position in self._positions(s):
+            self._bits[position / 8] |= 1 << (position % 8)
+
+    def __contains__(self, s):
+        return all(self._bits[position / 8] & (1 << (position % 8))
+                   for position in self._positions(s))
+
+    def encode(self):
+        '''Return the filter as a dict of plain data, for ``decode``.'''
+
+        return {
+            'bit-count': self.bit_count,
+            'hash-count': self.hash_count,
+            'bits': base64.b64encode(zlib.compress(str(self._bits))),
+        }
+
+    @classmethod
+    def decode(cls, encoded):
+        '''Re-create a filter from the result of ``encode``.
+
+        Raise ValueError if the data is not a valid filter.
+
+        '''
+
+        try:
+            bit_count = int(encoded['bit-count'])
+            hash_count = int(encoded['hash-count'])
+            bits = bytearray(zlib.decompress(
+                base64.b64decode(encoded['bits'])))
+        except (KeyError, TypeError, zlib.error), e:
+            raise ValueError('Invalid Bloom filter: %s' % e)
+        if bit_count <= 0 or len(bits) != (bit_count + 7) / 8:
+            raise ValueError('Invalid Bloom filter: %d bytes for %d bits' %
+                             (len(bits), bit_count))
+        return cls(bit_count, hash_count, bits)
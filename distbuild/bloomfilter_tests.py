@@ -0,0 +1,71 @@
+# distbuild/bloomfilter_tests.py -- unit tests for BloomFilter
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import unittest
+
+import distbuild
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bloom = distbuild.BloomFilter.for_capacity(1000)
+
+    def test_contains_nothing_when_new(self):
+        self.assertFalse('foo' in self.bloom)
+
+    def test_contains_added_strings(self):
+        for i in xrange(1000):
+            self.bloom.add('artifact-%d' % i)
+        for i in xrange(1000):
+            self.assertTrue('artifact-%d' % i in self.bloom)
+
+    def test_contains_few_strings_that_were_not_added(self):
+        for i in xrange(1000):
+            self.bloom.add('artifact-%d' % i)
+        mistakes = sum(1 for i in xrange(10000)
+                       if 'other-%d' % i in self.bloom)
+        self.assertTrue(mistakes < 300)
+
+    def test_treats_unicode_like_utf8(self):
+        self.bloom.add(u'caf\xe9')
+        self.assertTrue(u'caf\xe9'.encode('utf-8') in self.bloom)
+
+    def test_survives_encoding_as_json(self):
+        self.bloom.add('foo')
+        encoded = json.loads(json.dumps(self.bloom.encode()))
+        decoded = distbuild.BloomFilter.decode(encoded)
+        self.assertTrue('foo' in decoded)
+        self.assertFalse('bar' in decoded)
+        decoded.add('bar')
+        self.assertTrue('bar' in decoded)
+
+    def test_encodes_compactly(self):
+        for i in xrange(1000):
+            self.bloom.add('%064x' % i)
+        self.assertTrue(len(json.dumps(self.bloom.encode())) < 2000)
+
+    def test_rejects_invalid_encoding(self):
+        encoded = self.bloom.encode()
+        encoded['bit-count'] += 100
+        self.assertRaises(ValueError, distbuild.BloomFilter.decode, encoded)
+        self.assertRaises(ValueError, distbuild.BloomFilter.decode, {})
+        self.assertRaises(ValueError, distbuild.BloomFilter.decode,
+                          {'bit-count': 8, 'hash-count': 1,
+                           'bits': 'not base64'})
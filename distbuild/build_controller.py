@@ -1,6 +1,6 @@
 # distbuild/build_controller.py -- control the steps for one build
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import heapq
 import logging
 import httplib
 import traceback
@@ -134,6 +135,12 @@ def build_step_name(artifact):
     return artifact.name
 
 
+def _format_duration(seconds):
+    hours, remainder = divmod(int(seconds), 60*60)
+    minutes, seconds = divmod(remainder, 60)
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
+
+
 def map_build_graph(artifact, callback):
     result = []
     done = set()
@@ -162,14 +169,17 @@ class BuildController(distbuild.StateMachine):
     _idgen = distbuild.IdentifierGenerator('BuildController')
     
     def __init__(self, initiator_connection, build_request_message,
-                 artifact_cache_server, morph_instance):
+                 artifact_cache_server, morph_instance, build_times=None):
         distbuild.crash_point()
         distbuild.StateMachine.__init__(self, 'init')
         self._initiator_connection = initiator_connection
         self._request = build_request_message
         self._artifact_cache_server = artifact_cache_server
         self._morph_instance = morph_instance
+        self._build_times = build_times or distbuild.BuildTimes()
         self._helper_id = None
+        self._artifacts = []
+        self._artifacts_by_cache_key = {}
         self.debug_transitions = False
         self.debug_graph_state = False
 
@@ -373,29 +383,133 @@ class BuildController(distbuild.StateMachine):
 
         cache_state = json.loads(event.msg['body'])
         map_build_graph(self._artifact, set_status)
+        self._index_build_graph()
         self.mainloop.queue_event(self, _Annotated())
 
-        count = sum(map_build_graph(self._artifact,
-                    lambda a: 1 if a.state == UNBUILT else 0))
+        count = sum(1 for a in self._artifacts if a.state == UNBUILT)
 
         progress = BuildProgress(
             self._request['id'],
             'Need to build %d artifacts' % count)
         self.mainloop.queue_event(BuildController, progress)
 
+        if count > 0 and len(self._build_times) > 0:
+            progress = BuildProgress(
+                self._request['id'],
+                'Estimated build time: at least %s' %
+                    _format_duration(self._estimate_makespan()))
+            self.mainloop.queue_event(BuildController, progress)
+
         if count == 0:
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
-    def _find_artifacts_that_are_ready_to_build(self):
-        def is_ready_to_build(artifact):
-            return (artifact.state == UNBUILT and
-                    all(a.state == BUILT
-                        for a in artifact.source.dependencies))
-
-        return [a 
-                for a in map_build_graph(self._artifact, lambda a: a)
-                if is_ready_to_build(a)]
+    def _index_build_graph(self):
+        '''Index the annotated build graph.
+
+        Worker events name artifacts by cache key, and finishing one
+        build step can make others ready, so rather than walking the
+        whole graph for every event, this keeps the artifacts by cache
+        key, the artifacts that depend on each artifact, and how many of
+        its dependencies each artifact is still waiting for. Artifacts
+        that are waiting for none of them, but are not built, are kept
+        in a heap ordered by their position in the graph.
+
+        '''
+
+        self._artifacts = map_build_graph(self._artifact, lambda a: a)
+        self._positions = {}
+        self._artifacts_by_cache_key = {}
+        self._dependents = {}
+        self._unbuilt_dependencies = {}
+        self._ready = []
+
+        for position, artifact in enumerate(self._artifacts):
+            self._positions[artifact] = position
+            self._artifacts_by_cache_key.setdefault(
+                artifact.source.cache_key, []).append(artifact)
+            self._dependents.setdefault(artifact, [])
+        for artifact in self._artifacts:
+            dependencies = set(artifact.source.dependencies)
+            for dependency in dependencies:
+                self._dependents[dependency].append(artifact)
+            self._unbuilt_dependencies[artifact] = sum(
+                1 for a in dependencies if a.state != BUILT)
+            self._maybe_mark_ready(artifact)
+        self._compute_priorities()
+
+    def _compute_priorities(self):
+        '''Work out how long the build takes from each artifact on.
+
+        This is the estimated time to build the artifact, plus the
+        longest such time of the artifacts that depend on it. Building
+        the artifacts with the highest priority first keeps the longest
+        chain of build steps from being started late.
+
+        '''
+
+        self._priorities = {}
+        for start in self._artifacts:
+            stack = [(start, False)]
+            while stack:
+                artifact, expanded = stack.pop()
+                if artifact in self._priorities:
+                    continue
+                dependents = self._dependents[artifact]
+                if not expanded:
+                    # Work out the priorities of the dependents first.
+                    stack.append((artifact, True))
+                    stack.extend((d, False) for d in dependents
+                                 if d not in self._priorities)
+                    continue
+                if artifact.state == BUILT:
+                    cost = 0
+                else:
+                    cost = self._build_times.estimate(artifact.source)
+                self._priorities[artifact] = cost + max(
+                    [self._priorities[d] for d in dependents
+                     if d.state != BUILT] or [0])
+
+    def _estimate_makespan(self):
+        '''Estimate how long the artifacts left to build will take.
+
+        With enough workers this is the longest chain of build steps;
+        how many workers there are is up to the WorkerBuildQueuer.
+
+        '''
+
+        return max([self._priorities[a] for a in self._artifacts
+                    if a.state != BUILT] or [0])
+
+    def _maybe_mark_ready(self, artifact):
+        if (artifact.state == UNBUILT and
+                self._unbuilt_dependencies[artifact] == 0):
+            heapq.heappush(self._ready,
+                           (self._positions[artifact], artifact))
+
+    def _mark_built(self, artifact):
+        if artifact.state == BUILT:
+            return
+        artifact.state = BUILT
+        for dependent in self._dependents[artifact]:
+            self._unbuilt_dependencies[dependent] -= 1
+            self._maybe_mark_ready(dependent)
+
+    def _source_artifacts(self, artifact):
+        '''Return the artifacts in the graph built along with an artifact.'''
+
+        return [a for a in self._artifacts_by_cache_key[
+                    artifact.source.cache_key]
+                if a.source == artifact.source]
+
+    def _next_artifact_to_build(self):
+        while self._ready:
+            position, artifact = heapq.heappop(self._ready)
+            # Artifacts that started building along with another one
+            # are still in the heap.
+            if artifact.state == UNBUILT:
+                return artifact
+        return None
 
     def _queue_worker_builds(self, event_source, event):
         distbuild.crash_point()
@@ -408,7 +522,7 @@ class BuildController(distbuild.StateMachine):
         logging.debug('Queuing more worker-builds to run')
         if self.debug_graph_state:
             logging.debug('Current state of build graph nodes:')
-            for a in map_build_graph(self._artifact, lambda a: a):
+            for a in self._artifacts:
                 logging.debug('  %s state is %s' % (a.name, a.state))
                 if a.state != BUILT:
                     for dep in a.dependencies:
@@ -417,19 +531,17 @@ class BuildController(distbuild.StateMachine):
                                 (dep.name, dep.state))
 
         while True:
-            ready = self._find_artifacts_that_are_ready_to_build()
+            artifact = self._next_artifact_to_build()
 
-            if len(ready) == 0:
+            if artifact is None:
                 logging.debug('No new artifacts queued for building')
                 break
 
-            artifact = ready[0]
-
             logging.debug(
                 'Requesting worker-build of %s (%s)' %
                     (artifact.name, artifact.source.cache_key))
-            request = distbuild.WorkerBuildRequest(artifact,
-                                                   self._request['id'])
+            request = distbuild.WorkerBuildRequest(
+                artifact, self._request['id'], self._priorities[artifact])
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
 
             artifact.state = BUILDING
@@ -438,8 +550,8 @@ class BuildController(distbuild.StateMachine):
                 # so when we're building any chunk artifact
                 # we're also building all the chunk artifacts
                 # in this source
-                for a in ready:
-                    if a.source == artifact.source:
+                for a in self._source_artifacts(artifact):
+                    if a.state == UNBUILT:
                         a.state = BUILDING
 
 
@@ -542,8 +654,7 @@ class BuildController(distbuild.StateMachine):
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
+        wanted = self._artifacts_by_cache_key.get(cache_key)
         if wanted:
             return wanted[0]
         else:
@@ -566,18 +677,15 @@ class BuildController(distbuild.StateMachine):
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, finished)
 
-        artifact.state = BUILT
-
-        def set_state(a):
-            if a.source == artifact.source:
-                a.state = BUILT
+        self._mark_built(artifact)
 
         if artifact.source.morphology['kind'] == 'chunk':
             # Building a single chunk artifact
             # yields all chunk artifacts for the given source
             # so we set the state of this source's artifacts
             # to BUILT
-            map_build_graph(self._artifact, set_state)
+            for a in self._source_artifacts(artifact):
+                self._mark_built(a)
 
         self._queue_worker_builds(None, event)
 
@@ -0,0 +1,108 @@
+# distbuild/build_times.py -- remember how long build steps take
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import logging
+import os
+import tempfile
+
+
+class BuildTimes(object):
+
+    '''Remember how long build steps took, to estimate how long they take.
+
+    Steps are known by the kind and name of the source they build, since
+    a changed chunk usually takes about as long to build as it did last
+    time, even though its cache key differs. Each new time is averaged
+    with the one remembered before, so that one unusually slow or fast
+    build does not count for too much.
+
+    A step that has not been built before is estimated to take as long
+    as the average of the known steps of the same kind, or ``default``
+    seconds if there are none.
+
+    If ``filename`` is given, the times are loaded from it and saved to
+    it whenever one is recorded.
+
+    '''
+
+    def __init__(self, filename=None, default=1.0):
+        self.filename = filename
+        self.default = default
+        self._times = {}
+        self._means = {}
+        if filename is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._times)
+
+    def estimate(self, source):
+        '''Return how many seconds building a source is expected to take.'''
+
+        kind, key = self._key(source)
+        if key in self._times:
+            return self._times[key]
+        if kind not in self._means:
+            times = [seconds for k, seconds in self._times.iteritems()
+                     if k.startswith(kind + ':')]
+            self._means[kind] = (sum(times) / len(times) if times
+                                 else self.default)
+        return self._means[kind]
+
+    def record(self, source, seconds):
+        '''Remember that building a source took some seconds.'''
+
+        kind, key = self._key(source)
+        if key in self._times:
+            seconds = (self._times[key] + seconds) / 2.0
+        self._times[key] = seconds
+        self._means.pop(kind, None)
+        if self.filename is not None:
+            self._save()
+
+    def _key(self, source):
+        kind = source.morphology['kind']
+        return kind, '%s:%s' % (kind, source.name)
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                self._times = json.load(f)
+        except IOError:
+            pass
+        except ValueError, e:
+            logging.warning('Ignoring unreadable build times in %s: %s' %
+                            (self.filename, e))
+
+    def _save(self):
+        # Times only help to schedule builds, so failing to save them is
+        # not an error.
+        try:
+            dirname = os.path.dirname(self.filename) or '.'
+            fd, tempname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._times, f)
+                os.rename(tempname, self.filename)
+            except BaseException:
+                os.remove(tempname)
+                raise
+        except (IOError, OSError), e:
+            logging.warning('Could not save build times to %s: %s' %
+                            (self.filename, e))
@@ -0,0 +1,102 @@
+# distbuild/build_times_tests.py -- unit tests for BuildTimes
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind='chunk'):
+        self.name = name
+        self.morphology = {'kind': kind}
+
+
+class BuildTimesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'build-times.json')
+        self.times = distbuild.BuildTimes(default=5.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_estimates_default_for_unknown_source(self):
+        self.assertEqual(self.times.estimate(FakeSource('gcc')), 5.0)
+
+    def test_estimates_recorded_time(self):
+        self.times.record(FakeSource('gcc'), 100.0)
+        self.assertEqual(self.times.estimate(FakeSource('gcc')), 100.0)
+
+    def test_averages_new_time_with_old_one(self):
+        self.times.record(FakeSource('gcc'), 100.0)
+        self.times.record(FakeSource('gcc'), 50.0)
+        self.assertEqual(self.times.estimate(FakeSource('gcc')), 75.0)
+
+    def test_estimates_unknown_source_from_others_of_same_kind(self):
+        self.times.record(FakeSource('gcc'), 100.0)
+        self.times.record(FakeSource('zlib'), 20.0)
+        self.times.record(FakeSource('core', 'stratum'), 2.0)
+        self.assertEqual(self.times.estimate(FakeSource('bash')), 60.0)
+        self.assertEqual(self.times.estimate(FakeSource('x', 'stratum')),
+                         2.0)
+        self.times.record(FakeSource('bash'), 30.0)
+        self.assertEqual(self.times.estimate(FakeSource('perl')), 50.0)
+
+    def test_keeps_kinds_apart(self):
+        self.times.record(FakeSource('gcc'), 100.0)
+        self.assertEqual(self.times.estimate(FakeSource('gcc', 'stratum')),
+                         5.0)
+
+    def test_saves_times_to_file(self):
+        times = distbuild.BuildTimes(self.filename)
+        times.record(FakeSource('gcc'), 100.0)
+        times = distbuild.BuildTimes(self.filename)
+        self.assertEqual(len(times), 1)
+        self.assertEqual(times.estimate(FakeSource('gcc')), 100.0)
+        self.assertEqual(os.listdir(self.tempdir), ['build-times.json'])
+
+    def test_ignores_missing_file(self):
+        times = distbuild.BuildTimes(self.filename)
+        self.assertEqual(len(times), 0)
+
+    def test_ignores_unreadable_file(self):
+        with open(self.filename, 'w') as f:
+            f.write('not json')
+        times = distbuild.BuildTimes(self.filename)
+        self.assertEqual(len(times), 0)
+
+    def test_ignores_failure_to_save(self):
+        times = distbuild.BuildTimes(
+            os.path.join(self.tempdir, 'missing', 'build-times.json'))
+        times.record(FakeSource('gcc'), 100.0)
+        self.assertEqual(times.estimate(FakeSource('gcc')), 100.0)
+
+    def test_removes_temporary_file_if_saving_fails(self):
+        # A file cannot be renamed over a directory.
+        os.mkdir(self.filename)
+        times = distbuild.BuildTimes(self.filename)
+        times.record(FakeSource('gcc'), 100.0)
+        self.assertEqual(times.estimate(FakeSource('gcc')), 100.0)
+        self.assertEqual(os.listdir(self.tempdir), ['build-times.json'])
+        self.assertEqual(os.listdir(self.filename), [])
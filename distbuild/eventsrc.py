@@ -1,6 +1,6 @@
 # mainloop/eventsrc.py -- interface for event sources
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,6 +16,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+from poller import READ, WRITE, EXCEPT
+
+
 class EventSource(object):
 
     '''A source of events for state machines.
@@ -58,3 +61,85 @@ class EventSource(object):
         
         return False
 
+
+class FileDescriptorEventSource(EventSource):
+
+    '''An event source that watches file descriptors through a poller.
+
+    This is a base class.
+
+    Rather than being asked what to watch before every wait, a subclass
+    calls ``watch`` and ``unwatch`` whenever that changes, and the main
+    loop passes them on to its poller (see distbuild.Poller). When a file
+    descriptor is ready, the main loop calls ``get_poll_events`` with it
+    and with the flags saying what it is ready for.
+
+    Such event sources still work as plain event sources, for example
+    when wrapped by a ProxyEventSource.
+
+    '''
+
+    def __init__(self):
+        # fd -> flags
+        self._watched = {}
+        self._poller = None
+
+    def attach(self, poller):
+        '''Start watching file descriptors through a poller.'''
+
+        self._poller = poller
+        for fd, flags in self._watched.iteritems():
+            poller.watch(fd, self, flags)
+
+    def detach(self):
+        '''Stop watching file descriptors through the poller.'''
+
+        for fd in self._watched:
+            self._poller.unwatch(fd)
+        self._poller = None
+
+    def watch(self, fd, flags):
+        '''Watch a file descriptor for some of READ, WRITE and EXCEPT.'''
+
+        self._watched[fd] = flags
+        if self._poller is not None:
+            self._poller.watch(fd, self, flags)
+
+    def unwatch(self, fd):
+        '''Stop watching a file descriptor, before it is closed.'''
+
+        del self._watched[fd]
+        if self._poller is not None:
+            self._poller.unwatch(fd)
+
+    def get_poll_events(self, fd, flags):
+        '''Return events for a file descriptor that is ready.'''
+
+        return []
+
+    def get_select_params(self):
+        r = []
+        w = []
+        x = []
+        for fd, flags in self._watched.iteritems():
+            if flags & READ:
+                r.append(fd)
+            if flags & WRITE:
+                w.append(fd)
+            if flags & EXCEPT:
+                x.append(fd)
+        return r, w, x, None
+
+    def get_events(self, r, w, x):
+        events = []
+        for fd in self._watched.keys():
+            flags = 0
+            if fd in r:
+                flags |= READ
+            if fd in w:
+                flags |= WRITE
+            if fd in x:
+                flags |= EXCEPT
+            if flags:
+                events.extend(self.get_poll_events(fd, flags))
+        return events
@@ -0,0 +1,399 @@
+# distbuild/helper_machine.py -- run requests for a worker or controller
+#
+# Copyright (C) 2014, 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import fcntl
+import httplib
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import traceback
+import urlparse
+import weakref
+
+import distbuild
+
+
+class FileReadable(object):
+
+    def __init__(self, request_id, p, f):
+        self.request_id = request_id
+        self.process = p
+        self.file = f
+
+
+class FileWriteable(object):
+
+    def __init__(self, request_id, p, f):
+        self.request_id = request_id
+        self.process = p
+        self.file = f
+
+
+class SubprocessEventSource(distbuild.FileDescriptorEventSource):
+
+    def __init__(self):
+        distbuild.FileDescriptorEventSource.__init__(self)
+        self.procs = []
+        # fd -> (request_id, process, file)
+        self.files = {}
+        self.closed = False
+
+    def get_poll_events(self, fd, flags):
+        request_id, p, f = self.files[fd]
+        if f is p.stdin:
+            return [FileWriteable(request_id, p, f)]
+        else:
+            return [FileReadable(request_id, p, f)]
+
+    def add(self, request_id, process):
+
+        self.procs.append((request_id, process))
+        distbuild.set_nonblocking(process.stdin)
+        distbuild.set_nonblocking(process.stdout)
+        distbuild.set_nonblocking(process.stderr)
+        if process.stdin_contents is not None:
+            self._watch_file(request_id, process, process.stdin,
+                             distbuild.WRITE)
+        self._watch_file(request_id, process, process.stdout, distbuild.READ)
+        self._watch_file(request_id, process, process.stderr, distbuild.READ)
+
+    def _watch_file(self, request_id, process, f, flags):
+        self.files[f.fileno()] = (request_id, process, f)
+        self.watch(f.fileno(), flags)
+
+    def close_file(self, f):
+        fd = f.fileno()
+        del self.files[fd]
+        self.unwatch(fd)
+        f.close()
+
+    def remove(self, process):
+        self.procs = [t for t in self.procs if t[1] != process]
+
+    def kill_by_id(self, request_id):
+        logging.debug('SES: Killing all processes for %s', request_id)
+        for id, process in self.procs:
+            if id == request_id:
+                logging.debug('SES: killing %s', repr(process))
+                process.kill()
+
+    def close(self):
+        for fd in self.files.keys():
+            del self.files[fd]
+            self.unwatch(fd)
+        self.procs = []
+        self.closed = True
+
+    def is_finished(self):
+        return self.closed
+
+
+class ForkedProcess(object):
+
+    '''Run a function in a forked child process, like subprocess.Popen.
+
+    The standard input, output and error of the child are pipes, as
+    those of a subprocess.Popen made with ``stdin``, ``stdout`` and
+    ``stderr`` all ``subprocess.PIPE``. The exit code of the child is
+    what the function returns, or 1 if it raises an exception, which is
+    reported on its standard error.
+
+    Forking lets the child use whatever the parent has already loaded
+    and set up, instead of starting a new program. The child closes the
+    pipes of the other ForkedProcess children it inherits, so that they
+    do not stay open in it, and a child reading its standard input still
+    gets to the end of it once the parent closes it. Other file
+    descriptors stay open, since objects the child inherits, such as
+    logging handlers, still use them. The pipes are also close-on-exec,
+    so that programs run by the parent or a child do not inherit them.
+
+    '''
+
+    # Every ForkedProcess made by this process, while it is in use.
+    _children = weakref.WeakSet()
+
+    def __init__(self, function, *args):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pipes = [os.pipe() for i in xrange(3)]
+        self.pid = os.fork()
+        if self.pid == 0: # pragma: no cover
+            self._run_child(pipes, function, args)
+
+        (stdin_r, stdin_w), (stdout_r, stdout_w), (stderr_r, stderr_w) = pipes
+        os.close(stdin_r)
+        os.close(stdout_w)
+        os.close(stderr_w)
+        for fd in (stdin_w, stdout_r, stderr_r):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.stdin = os.fdopen(stdin_w, 'w')
+        self.stdout = os.fdopen(stdout_r)
+        self.stderr = os.fdopen(stderr_r)
+        self.returncode = None
+        self._children.add(self)
+
+    def _run_child(self, pipes, function, args): # pragma: no cover
+        code = 1
+        try:
+            # The files are closed rather than their file descriptors, so
+            # that nothing is left using a descriptor which may be reused.
+            for child in list(self._children):
+                for f in (child.stdin, child.stdout, child.stderr):
+                    if f is not None:
+                        f.close()
+            for fd, (r, w) in enumerate(pipes):
+                os.dup2(r if fd == 0 else w, fd)
+                os.close(r)
+                os.close(w)
+            code = function(*args) or 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def poll(self):
+        return self._wait(os.WNOHANG)
+
+    def wait(self):
+        return self._wait(0)
+
+    def _wait(self, options):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, options)
+            if pid == 0:
+                return None
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+
+class HelperMachine(distbuild.StateMachine):
+
+    '''Run the requests a JsonRouter sends, and send back the results.
+
+    By default, a helper runs every request it is sent, each exec-request
+    in a new subprocess. A helper may instead run only exec-requests for
+    some commands, named by the second word of their argv, which it
+    tells the JsonRouter in ``commands``. ``spawn`` is then called with
+    the argv of each request, and returns an object like a
+    subprocess.Popen for the process that runs it.
+
+    '''
+
+    def __init__(self, conn, commands=None, spawn=None):
+        distbuild.StateMachine.__init__(self, 'waiting')
+        self.conn = conn
+        self.debug_messages = False
+        self.commands = commands
+        self.spawn = spawn or self._popen
+
+    def setup(self):
+        distbuild.crash_point()
+
+        jm = self.jm = distbuild.JsonMachine(self.conn)
+        self.mainloop.add_state_machine(jm)
+
+        p = self.procsrc = SubprocessEventSource()
+        self.mainloop.add_event_source(p)
+
+        self.send_helper_ready(jm)
+
+        spec = [
+            ('waiting', jm, distbuild.JsonNewMessage, 'waiting', self.do),
+            ('waiting', jm, distbuild.JsonEof, None, self._eofed),
+            ('waiting', p, FileReadable, 'waiting', self._relay_exec_output),
+            ('waiting', p, FileWriteable, 'waiting', self._feed_stdin),
+        ]
+        self.add_transitions(spec)
+
+    def send_helper_ready(self, jm):
+        msg = {
+            'type': 'helper-ready',
+        }
+        if self.commands is not None:
+            msg['commands'] = self.commands
+        jm.send(msg)
+        logging.debug('HelperMachine: sent: %s', repr(msg))
+
+    def do(self, parent, event):
+        distbuild.crash_point()
+
+        logging.debug('JsonMachine: got: %s', repr(event.msg))
+        handlers = {
+            'http-request': self.do_http_request,
+            'exec-request': self.do_exec_request,
+            'exec-cancel': self.do_exec_cancel,
+        }
+        handler = handlers.get(event.msg['type'])
+        handler(parent, event.msg)
+
+    def do_http_request(self, parent, msg):
+        distbuild.crash_point()
+
+        url = msg['url']
+        method = msg['method']
+        headers = msg['headers']
+        body = msg['body']
+        assert method in ('HEAD', 'GET', 'POST')
+
+        logging.debug('JsonMachine: http request: %s %s' % (method, url))
+
+        schema, netloc, path, query, fragment = urlparse.urlsplit(url)
+        assert schema == 'http'
+        if query:
+            path += '?' + query
+
+        try:
+            conn = httplib.HTTPConnection(netloc)
+
+            if headers:
+                conn.request(method, path, body, headers)
+            else:
+                conn.request(method, path, body)
+        except (socket.error, httplib.HTTPException), e:
+            status = 418 # teapot
+            data = str(e)
+        else:
+            res = conn.getresponse()
+            status = res.status
+            data = res.read()
+        conn.close()
+
+        response = {
+            'type': 'http-response',
+            'id': msg['id'],
+            'status': status,
+            'body': data,
+        }
+        parent.send(response)
+        logging.debug('JsonMachine: sent to parent: %s', repr(response))
+        self.send_helper_ready(parent)
+
+    def do_exec_request(self, parent, msg):
+        distbuild.crash_point()
+
+        argv = msg['argv']
+        stdin_contents = msg.get('stdin_contents', '')
+        logging.debug('JsonMachine: exec request: argv=%s', repr(argv))
+        logging.debug(
+            'JsonMachine: exec request: stdin=%s', repr(stdin_contents))
+
+        p = self.spawn(argv)
+        p.stdin_contents = stdin_contents
+
+        self.procsrc.add(msg['id'], p)
+
+    def _popen(self, argv):
+        return subprocess.Popen(argv,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+
+    def do_exec_cancel(self, parent, msg):
+        distbuild.crash_point()
+
+        self.procsrc.kill_by_id(msg['id'])
+
+    def _relay_exec_output(self, event_source, event):
+        distbuild.crash_point()
+
+        buf_size = 16 * 1024
+        fd = event.file.fileno()
+        data = os.read(fd, buf_size)
+        if data:
+            if event.file == event.process.stdout:
+                stream = 'stdout'
+                other = 'stderr'
+            else:
+                stream = 'stderr'
+                other = 'stdout'
+            msg = {
+                'type': 'exec-output',
+                'id': event.request_id,
+                stream: data,
+                other: '',
+            }
+            logging.debug('JsonMachine: sent to parent: %s', repr(msg))
+            self.jm.send(msg)
+        else:
+            self.procsrc.close_file(event.file)
+            if event.file == event.process.stdout:
+                event.process.stdout = None
+            else:
+                event.process.stderr = None
+
+            if event.process.stdout == event.process.stderr == None:
+                event.process.wait()
+                self.procsrc.remove(event.process)
+                msg = {
+                    'type': 'exec-response',
+                    'id': event.request_id,
+                    'exit': event.process.returncode,
+                }
+                logging.debug('JsonMachine: sent to parent: %s', repr(msg))
+                self.jm.send(msg)
+                self.send_helper_ready(self.jm)
+
+    def _feed_stdin(self, event_source, event):
+        distbuild.crash_point()
+
+        fd = event.file.fileno()
+        try:
+            n = os.write(fd, event.process.stdin_contents)
+        except os.error, e:
+            # If other end closed the read end, stop writing.
+            if e.errno == errno.EPIPE:
+                logging.debug('JsonMachine: reader closed pipe')
+                event.process.stdin_contents = ''
+            else:
+                raise  # pragma: no cover
+        else:
+            logging.debug('JsonMachine: fed %d bytes to stdin', n)
+            event.process.stdin_contents = event.process.stdin_contents[n:]
+        if event.process.stdin_contents == '':
+            logging.debug('JsonMachine: stdin contents finished, closing')
+            self.procsrc.close_file(event.file)
+            event.process.stdin_contents = None
+
+    def _eofed(self, event_source, event):
+        distbuild.crash_point()
+        logging.info('eof from parent, closing')
+        event_source.close()
+        self.procsrc.close()
+
@@ -0,0 +1,344 @@
+# distbuild/helper_machine_tests.py -- unit tests for HelperMachine
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import BaseHTTPServer
+import fcntl
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import distbuild
+
+
+def echo(prefix):
+    line = sys.stdin.readline()
+    sys.stdout.write(prefix + line)
+    sys.stderr.write('done\n')
+
+
+def fail():
+    raise RuntimeError('oops')
+
+
+def exit_with(code):
+    sys.exit(code)
+
+
+def sleep():
+    time.sleep(60)
+
+
+def read_stdin():
+    sys.stdin.read()
+
+
+class ForkedProcessTests(unittest.TestCase):
+
+    def run_process(self, function, *args, **kwargs):
+        p = distbuild.ForkedProcess(function, *args)
+        # Only write to children that read it, since the others may have
+        # exited already, and the write would fail with EPIPE.
+        if 'stdin' in kwargs:
+            p.stdin.write(kwargs['stdin'])
+        p.stdin.close()
+        stdout = p.stdout.read()
+        stderr = p.stderr.read()
+        return p.wait(), stdout, stderr
+
+    def test_runs_function_with_pipes_for_standard_files(self):
+        self.assertEqual(self.run_process(echo, 'said ',
+                                          stdin='hello\n'),
+                         (0, 'said hello\n', 'done\n'))
+
+    def test_exits_with_one_if_function_raises_exception(self):
+        code, stdout, stderr = self.run_process(fail)
+        self.assertEqual(code, 1)
+        self.assertTrue('RuntimeError: oops' in stderr)
+
+    def test_exits_with_code_given_to_sys_exit(self):
+        self.assertEqual(self.run_process(exit_with, 3)[0], 3)
+        self.assertEqual(self.run_process(exit_with, None)[0], 0)
+        self.assertEqual(self.run_process(exit_with, 'failed'),
+                         (1, '', 'failed\n'))
+
+    def test_closes_pipes_of_other_children(self):
+        first = distbuild.ForkedProcess(read_stdin)
+        second = distbuild.ForkedProcess(read_stdin)
+        try:
+            # The first child keeps running until its stdin is closed, so
+            # it only exits if the second child did not keep the pipe.
+            first.stdin.close()
+            for i in xrange(1000):
+                if first.poll() is not None:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(first.poll(), 0)
+        finally:
+            first.kill()
+            second.kill()
+            second.wait()
+
+    def test_pipes_are_not_inherited_by_programs_run(self):
+        p = distbuild.ForkedProcess(read_stdin)
+        for f in (p.stdin, p.stdout, p.stderr):
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+            self.assertTrue(flags & fcntl.FD_CLOEXEC)
+        p.stdin.close()
+        self.assertEqual(p.wait(), 0)
+
+    def test_child_can_log_after_opening_files(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        log = os.path.join(tempdir, 'log')
+        artifact = os.path.join(tempdir, 'artifact')
+        logger = logging.getLogger('distbuild.helper_machine_tests')
+        handler = logging.FileHandler(log)
+        logger.addHandler(handler)
+        logger.propagate = False
+        self.addCleanup(setattr, logger, 'propagate', True)
+        self.addCleanup(handler.close)
+        self.addCleanup(logger.removeHandler, handler)
+
+        def build():
+            with open(artifact, 'w') as f:
+                logger.error('building chunk')
+                handler.flush()
+                f.write('ARTIFACT-DATA\n')
+
+        self.assertEqual(self.run_process(build), (0, '', ''))
+        with open(artifact) as f:
+            self.assertEqual(f.read(), 'ARTIFACT-DATA\n')
+        with open(log) as f:
+            self.assertEqual(f.read(), 'building chunk\n')
+
+    def test_can_be_killed(self):
+        p = distbuild.ForkedProcess(sleep)
+        self.assertEqual(p.poll(), None)
+        p.kill()
+        self.assertEqual(p.wait(), -signal.SIGKILL)
+        self.assertEqual(p.poll(), -signal.SIGKILL)
+
+
+class ParentDone(object):
+
+    pass
+
+
+class ParentMachine(distbuild.StateMachine):
+
+    '''Send requests to a HelperMachine, and record what it sends back.
+
+    Once the helper has sent ``until`` messages of type ``until_type``,
+    or any of type ``close_on``, the connection to it is closed.
+
+    '''
+
+    def __init__(self, conn, requests, until_type, until=1, close_on=None):
+        distbuild.StateMachine.__init__(self, 'waiting')
+        self.conn = conn
+        self.requests = requests
+        self.until_type = until_type
+        self.until = until
+        self.close_on = close_on
+        self.received = []
+
+    def setup(self):
+        self.jm = distbuild.JsonMachine(self.conn)
+        self.mainloop.add_state_machine(self.jm)
+        self.add_transition('waiting', self.jm, distbuild.JsonNewMessage,
+                            'waiting', self.receive)
+        self.add_transition('waiting', self, ParentDone, None, None)
+
+    def receive(self, event_source, event):
+        self.received.append(event.msg)
+        msg_type = event.msg['type']
+        if msg_type == 'helper-ready' and self.requests:
+            for msg in self.requests:
+                self.jm.send(msg)
+            self.requests = []
+        if msg_type == self.until_type:
+            self.until -= 1
+        if self.until == 0 or msg_type == self.close_on:
+            self.jm.close()
+            self.mainloop.queue_event(self, ParentDone())
+
+    def messages(self, msg_type):
+        return [msg for msg in self.received if msg['type'] == msg_type]
+
+    def output(self, request_id, stream):
+        return ''.join(msg[stream] for msg in self.messages('exec-output')
+                       if msg['id'] == request_id)
+
+
+class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('%s %s' % (self.path, self.headers.get('X-Test')))
+
+    def log_message(self, *args):
+        pass
+
+
+class HelperMachineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.processes = []
+
+    def tearDown(self):
+        for p in self.processes:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        self.sock.close()
+        self.other.close()
+
+    def run_helper(self, requests, until_type='exec-response', until=1,
+                   close_on=None, **kwargs):
+        self.helper = distbuild.HelperMachine(self.sock, **kwargs)
+        spawn = self.helper.spawn
+
+        def spawn_and_record(argv):
+            p = spawn(argv)
+            self.processes.append(p)
+            return p
+
+        self.helper.spawn = spawn_and_record
+        parent = ParentMachine(self.other, requests, until_type, until,
+                               close_on)
+        loop = distbuild.MainLoop()
+        loop.add_state_machine(parent)
+        loop.add_state_machine(self.helper)
+        loop.run()
+        return parent
+
+    def exec_request(self, request_id, argv, stdin_contents=''):
+        return {
+            'type': 'exec-request',
+            'id': request_id,
+            'argv': argv,
+            'stdin_contents': stdin_contents,
+        }
+
+    def test_says_it_is_ready_for_any_request(self):
+        parent = self.run_helper([], until_type='helper-ready')
+        self.assertEqual(parent.received, [{'type': 'helper-ready'}])
+
+    def test_says_which_commands_it_runs(self):
+        parent = self.run_helper([], until_type='helper-ready',
+                                 commands=['worker-build'])
+        self.assertEqual(parent.received,
+                         [{'type': 'helper-ready',
+                           'commands': ['worker-build']}])
+
+    def test_runs_exec_request_and_sends_output_and_exit_code(self):
+        parent = self.run_helper([
+            self.exec_request(
+                1, ['sh', '-c', 'cat; echo oops >&2; exit 3'], 'hello\n'),
+        ])
+        self.assertEqual(parent.output(1, 'stdout'), 'hello\n')
+        self.assertEqual(parent.output(1, 'stderr'), 'oops\n')
+        self.assertEqual(parent.messages('exec-response'),
+                         [{'type': 'exec-response', 'id': 1, 'exit': 3}])
+        self.assertEqual(parent.received[-1], {'type': 'helper-ready'})
+        self.assertEqual(self.helper.procsrc.procs, [])
+
+    def test_stops_feeding_stdin_to_process_that_exits(self):
+        stdin_contents = 'x' * (1024 * 1024)
+        parent = self.run_helper([
+            self.exec_request(1, ['true'], stdin_contents),
+        ])
+        self.assertEqual(parent.messages('exec-response'),
+                         [{'type': 'exec-response', 'id': 1, 'exit': 0}])
+
+    def test_runs_requests_with_spawn_function(self):
+        spawned = []
+
+        def spawn(argv):
+            spawned.append(argv)
+            return distbuild.ForkedProcess(echo, argv[1])
+
+        parent = self.run_helper(
+            [self.exec_request(1, ['morph', 'said '], 'hello\n')],
+            spawn=spawn)
+        self.assertEqual(spawned, [['morph', 'said ']])
+        self.assertEqual(parent.output(1, 'stdout'), 'said hello\n')
+
+    def test_runs_requests_at_the_same_time(self):
+        parent = self.run_helper([
+            self.exec_request(1, ['sh', '-c', 'echo started; exec sleep 60']),
+            self.exec_request(2, ['true']),
+        ])
+        self.assertEqual(parent.messages('exec-response'),
+                         [{'type': 'exec-response', 'id': 2, 'exit': 0}])
+
+    def test_kills_processes_of_cancelled_request(self):
+        parent = self.run_helper([
+            self.exec_request(1, ['sh', '-c', 'echo started; exec sleep 60']),
+            {'type': 'exec-cancel', 'id': 1},
+        ])
+        self.assertEqual(parent.messages('exec-response'),
+                         [{'type': 'exec-response', 'id': 1,
+                           'exit': -signal.SIGKILL}])
+
+    def test_stops_watching_processes_when_parent_goes_away(self):
+        parent = self.run_helper([
+            self.exec_request(1, ['sh', '-c', 'echo started; exec sleep 60']),
+        ], close_on='exec-output')
+        self.assertEqual(parent.output(1, 'stdout'), 'started\n')
+        self.assertTrue(self.helper.procsrc.is_finished())
+        self.assertEqual(self.helper.procsrc.files, {})
+
+    def test_runs_http_request(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HttpHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        url = 'http://127.0.0.1:%d/path?query' % server.server_port
+        try:
+            parent = self.run_helper([
+                {'type': 'http-request', 'id': 1, 'url': url,
+                 'method': 'GET', 'headers': {'X-Test': 'yes'},
+                 'body': None},
+            ], until_type='http-response')
+        finally:
+            thread.join()
+            server.server_close()
+        self.assertEqual(parent.messages('http-response'),
+                         [{'type': 'http-response', 'id': 1, 'status': 200,
+                           'body': '/path?query yes'}])
+
+    def test_reports_http_request_that_fails(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/' % listener.getsockname()[1]
+        listener.close()
+        parent = self.run_helper([
+            {'type': 'http-request', 'id': 1, 'url': url, 'method': 'GET',
+             'headers': None, 'body': None},
+        ], until_type='http-response')
+        response, = parent.messages('http-response')
+        self.assertEqual(response['status'], 418)
@@ -1,6 +1,6 @@
 # mainloop/jm.py -- state machine for JSON communication between nodes
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -21,9 +21,15 @@ import json
 import logging
 import os
 import socket
+import struct
 import sys
 import yaml
 
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
 from sm import StateMachine 
 from stringbuffer import StringBuffer
 from sockbuf import (SocketBuffer, SocketBufferNewData, 
@@ -46,16 +52,64 @@ class _Close2(object):
     pass
 
 
+# The libyaml-based implementations are much faster, where PyYAML has them.
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Starts a length-prefixed msgpack frame, which never starts a line of
+# the other encodings.
+_MSGPACK_MARKER = '\0'
+_MSGPACK_HEADER = struct.Struct('>cI')
+
+# The message key used to say what encodings the sender can receive.
+_ENCODINGS_KEY = 'jm-encodings'
+
+
+def ascii_strings(obj):
+    '''Turn unicode strings that are plain ASCII into str, as YAML does.'''
+
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    elif isinstance(obj, dict):
+        return dict((ascii_strings(k), ascii_strings(v))
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [ascii_strings(item) for item in obj]
+    else:
+        return obj
+
+
 class JsonMachine(StateMachine):
 
-    '''A state machine for sending/receiving JSON messages across TCP.'''
+    '''A state machine for sending/receiving JSON messages across TCP.
+
+    Messages used to be sent only as YAML wrapped in a JSON string, one
+    per line, which is slow to produce and parse, and large. They are
+    now sent as plain JSON lines, or as length-prefixed msgpack frames if
+    the msgpack module is available, once the other side has said that
+    it can receive them. Until then, messages are sent the old way, with
+    an extra field listing the encodings this side can receive, which
+    older versions ignore. Incoming messages may use any encoding.
+
+    The extra field also says which address it was sent from, so that
+    it is not believed when a router passes it on to another connection.
+
+    '''
 
     max_buffer = 16 * 1024
 
+    # Encodings this side can receive, in order of preference.
+    receive_encodings = (['msgpack', 'json'] if msgpack is not None
+                         else ['json'])
+
     def __init__(self, conn):
         StateMachine.__init__(self, 'rw')
         self.conn = conn
         self.debug_json = False
+        self.encoding = 'yaml'
 
     def __repr__(self):
         return '<JsonMachine at 0x%x: socket %s, max_buffer %s>' % \
@@ -80,12 +134,32 @@ class JsonMachine(StateMachine):
         
     def send(self, msg):
         '''Send a message to the other side.'''
-        if self.debug_json:
+        if self.debug_json: # pragma: no cover
             logging.debug('JsonMachine: Sending message %s' % repr(msg))
-        s = json.dumps(yaml.safe_dump(msg))
-        if self.debug_json:
+        s = self.encode(msg)
+        if self.debug_json: # pragma: no cover
             logging.debug('JsonMachine: As %s' % repr(s))
-        self.sockbuf.write('%s\n' % s)
+        self.sockbuf.write(s)
+
+    def encode(self, msg):
+        '''Return a message as sent with the current encoding.'''
+
+        if self.encoding == 'msgpack':
+            data = msgpack.packb(msg)
+            return _MSGPACK_HEADER.pack(_MSGPACK_MARKER, len(data)) + data
+        if self.encoding == 'json':
+            try:
+                return json.dumps(msg, separators=(',', ':')) + '\n'
+            except UnicodeDecodeError:
+                # Only YAML can carry strings that are not UTF-8, such
+                # as a piece of build output cut in mid-character.
+                pass
+        msg = dict(msg)
+        msg[_ENCODINGS_KEY] = {
+            'accepts': self.receive_encodings,
+            'from': self._address(self.conn.getsockname),
+        }
+        return '%s\n' % json.dumps(yaml.dump(msg, Dumper=_YamlDumper))
     
     def close(self):
         '''Tell state machine it should shut down.
@@ -100,22 +174,68 @@ class JsonMachine(StateMachine):
     def _parse(self, event_source, event):
         data = event.data
         self.receive_buf.add(data)
-        if self.debug_json:
+        if self.debug_json: # pragma: no cover
             logging.debug('JsonMachine: Received: %s' % repr(data))
         while True:
-            line = self.receive_buf.readline()
-            if line is None:
+            msg = self._read_message()
+            if msg is None:
                 break
-            line = line.rstrip()
-            if self.debug_json:
-                logging.debug('JsonMachine: line: %s' % repr(line))
-            msg = yaml.load(json.loads(line))
             self.mainloop.queue_event(self, JsonNewMessage(msg))
 
+    def _read_message(self):
+        first = self.receive_buf.read(1)
+        if first == '':
+            return None
+
+        if first == _MSGPACK_MARKER:
+            header = self.receive_buf.read(_MSGPACK_HEADER.size)
+            if len(header) < _MSGPACK_HEADER.size:
+                return None
+            marker, size = _MSGPACK_HEADER.unpack(header)
+            if len(self.receive_buf) < len(header) + size:
+                return None
+            frame = self.receive_buf.read(len(header) + size)
+            self.receive_buf.remove(len(frame))
+            return msgpack.unpackb(frame[len(header):])
+
+        line = self.receive_buf.readline()
+        if line is None:
+            return None
+        line = line.rstrip()
+        if self.debug_json: # pragma: no cover
+            logging.debug('JsonMachine: line: %s' % repr(line))
+        if first == '"':
+            msg = yaml.load(json.loads(line), Loader=_YamlLoader)
+            self._check_encodings(msg)
+            return msg
+        return ascii_strings(json.loads(line))
+
+    def _check_encodings(self, msg):
+        info = msg.pop(_ENCODINGS_KEY, None)
+        if not isinstance(info, dict) or self.encoding != 'yaml':
+            return
+        peer = self._address(self.conn.getpeername)
+        if peer is None or info.get('from') != peer:
+            return
+        accepts = info.get('accepts')
+        if not isinstance(accepts, list):
+            return
+        for encoding in self.receive_encodings:
+            if encoding in accepts:
+                logging.debug('JsonMachine: sending %s to %s' %
+                              (encoding, info['from']))
+                self.encoding = encoding
+                break
+
+    def _address(self, getname):
+        try:
+            return list(getname())
+        except socket.error:
+            return None
+
     def _send_eof(self, event_source, event):
         self.mainloop.queue_event(self, JsonEof())
 
     def _really_close(self, event_source, event):
         self.sockbuf.close()
         self._send_eof(event_source, event)
-
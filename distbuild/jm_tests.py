@@ -0,0 +1,227 @@
+# distbuild/jm_tests.py -- unit tests for JsonMachine
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import socket
+import unittest
+
+import yaml
+
+import distbuild
+import distbuild.jm
+
+
+class JsonPacker(object):
+
+    '''Stand in for msgpack, to test sending frames without it.'''
+
+    @staticmethod
+    def packb(msg):
+        return json.dumps(msg)
+
+    @staticmethod
+    def unpackb(data):
+        return distbuild.jm.ascii_strings(json.loads(data))
+
+
+class JsonMachineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.sender = self.new_machine(self.sock)
+        self.receiver = self.new_machine(self.other)
+        self.msg = {
+            'type': 'exec-output',
+            'id': 123,
+            'stdout': 'some output\n',
+            'stderr': '',
+            'list': ['a', 1, None, True],
+        }
+
+    def tearDown(self):
+        self.sock.close()
+        self.other.close()
+
+    def new_machine(self, conn):
+        jm = distbuild.JsonMachine(conn)
+        jm.receive_buf = distbuild.StringBuffer()
+        return jm
+
+    def use_json_packer(self):
+        self.addCleanup(setattr, distbuild.jm, 'msgpack',
+                        distbuild.jm.msgpack)
+        distbuild.jm.msgpack = JsonPacker
+
+    def old_format(self, msg):
+        return '%s\n' % json.dumps(yaml.safe_dump(msg))
+
+    def transfer(self, data, jm=None):
+        jm = jm or self.receiver
+        jm.receive_buf.add(data)
+        msgs = []
+        while True:
+            msg = jm._read_message()
+            if msg is None:
+                return msgs
+            msgs.append(msg)
+
+    def test_sends_yaml_inside_json_at_first(self):
+        line = self.sender.encode(self.msg)
+        self.assertTrue(line.endswith('\n'))
+        msg = yaml.safe_load(json.loads(line))
+        self.assertEqual(msg['jm-encodings']['accepts'],
+                         self.sender.receive_encodings)
+        del msg['jm-encodings']
+        self.assertEqual(msg, self.msg)
+
+    def test_does_not_change_message_it_sends(self):
+        self.sender.encode(self.msg)
+        self.assertFalse('jm-encodings' in self.msg)
+
+    def test_receives_old_format_without_encodings(self):
+        line = self.old_format(self.msg)
+        self.assertEqual(self.transfer(line), [self.msg])
+        self.assertEqual(self.receiver.encoding, 'yaml')
+        self.assertTrue(self.receiver.encode(self.msg).startswith('"'))
+
+    def test_switches_encoding_when_other_side_accepts_it(self):
+        msgs = self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(msgs, [self.msg])
+        self.assertEqual(self.receiver.encoding,
+                         self.receiver.receive_encodings[0])
+
+    def test_ignores_encodings_sent_from_another_connection(self):
+        msg = dict(self.msg)
+        msg['jm-encodings'] = {'accepts': ['json'], 'from': ['elsewhere']}
+        self.assertEqual(self.transfer(self.old_format(msg)), [self.msg])
+        self.assertEqual(self.receiver.encoding, 'yaml')
+
+    def test_ignores_encodings_when_peer_address_is_unknown(self):
+        unconnected = socket.socket(socket.AF_UNIX)
+        self.addCleanup(unconnected.close)
+        receiver = self.new_machine(unconnected)
+        msgs = self.transfer(self.sender.encode(self.msg), receiver)
+        self.assertEqual(msgs, [self.msg])
+        self.assertEqual(receiver.encoding, 'yaml')
+
+    def test_ignores_malformed_encodings(self):
+        address = list(self.sock.getsockname())
+        for info in ['json',
+                     {'from': address},
+                     {'from': address, 'accepts': 'json'}]:
+            msg = dict(self.msg)
+            msg['jm-encodings'] = info
+            self.assertEqual(self.transfer(self.old_format(msg)),
+                             [self.msg])
+            self.assertEqual(self.receiver.encoding, 'yaml')
+
+    def test_ignores_encodings_it_does_not_know(self):
+        self.sender.receive_encodings = ['carrier-pigeon']
+        self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(self.receiver.encoding, 'yaml')
+
+    def test_sends_plain_json_lines(self):
+        self.sender.encoding = 'json'
+        line = self.sender.encode(self.msg)
+        self.assertEqual(json.loads(line), self.msg)
+        self.assertEqual(self.transfer(line), [self.msg])
+
+    def test_receives_plain_json_strings_as_str(self):
+        self.sender.encoding = 'json'
+        msg, = self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(type(msg['type']), str)
+        self.assertEqual(type(msg.keys()[0]), str)
+
+    def test_keeps_unicode_strings_that_are_not_ascii(self):
+        self.sender.encoding = 'json'
+        self.msg['stdout'] = u'caf\xe9'
+        msg, = self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(msg['stdout'], u'caf\xe9')
+
+    def test_receives_message_that_arrives_in_pieces(self):
+        self.sender.encoding = 'json'
+        data = self.sender.encode(self.msg) * 2
+        self.assertEqual(self.transfer(data[:10]), [])
+        self.assertEqual(self.transfer(data[10:-5]), [self.msg])
+        self.assertEqual(self.transfer(data[-5:]), [self.msg])
+
+    def test_falls_back_to_yaml_for_strings_that_are_not_utf8(self):
+        self.sender.encoding = 'json'
+        self.msg['stdout'] = 'cut in the middle of \xc3'
+        line = self.sender.encode(self.msg)
+        self.assertTrue(line.startswith('"'))
+        self.assertEqual(self.transfer(line), [self.msg])
+
+    def test_mixes_encodings_in_one_stream(self):
+        data = self.sender.encode(self.msg)
+        self.sender.encoding = 'json'
+        data += self.sender.encode(self.msg)
+        self.assertEqual(self.transfer(data), [self.msg, self.msg])
+
+    def test_frames_messages_for_msgpack(self):
+        self.use_json_packer()
+        self.sender.encoding = 'msgpack'
+        data = self.sender.encode(self.msg) * 2
+        self.assertEqual(data[0], '\0')
+        self.assertEqual(self.transfer(data[:3]), [])
+        self.assertEqual(self.transfer(data[3:10]), [])
+        self.assertEqual(self.transfer(data[10:-1]), [self.msg])
+        self.assertEqual(self.transfer(data[-1:]), [self.msg])
+
+    def test_switches_to_msgpack_when_both_sides_have_it(self):
+        self.use_json_packer()
+        self.sender.receive_encodings = ['msgpack', 'json']
+        self.receiver.receive_encodings = ['msgpack', 'json']
+        self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(self.receiver.encoding, 'msgpack')
+
+    def test_sends_json_to_side_without_msgpack(self):
+        self.use_json_packer()
+        self.sender.receive_encodings = ['json']
+        self.receiver.receive_encodings = ['msgpack', 'json']
+        self.transfer(self.sender.encode(self.msg))
+        self.assertEqual(self.receiver.encoding, 'json')
+
+    @unittest.skipIf(distbuild.jm.msgpack is None, 'msgpack not installed')
+    def test_sends_msgpack_frames(self): # pragma: no cover
+        self.sender.encoding = 'msgpack'
+        data = self.sender.encode(self.msg) * 2
+        self.assertEqual(self.transfer(data[:3]), [])
+        self.assertEqual(self.transfer(data[3:-1]), [self.msg])
+        self.assertEqual(self.transfer(data[-1:]), [self.msg])
+
+    def test_sends_messages_through_main_loop(self):
+        loop = distbuild.MainLoop()
+        sender = distbuild.JsonMachine(self.sock)
+        receiver = distbuild.JsonMachine(self.other)
+        received = []
+
+        def receive(event_source, event):
+            received.append(event.msg)
+            if len(received) == 2:
+                sender.close()
+                receiver.close()
+
+        loop.add_state_machine(sender)
+        loop.add_state_machine(receiver)
+        receiver.add_transition('rw', receiver, distbuild.JsonNewMessage,
+                                'rw', receive)
+        sender.send(self.msg)
+        sender.send(self.msg)
+        loop.run()
+        self.assertEqual(received, [self.msg, self.msg])
@@ -1,6 +1,6 @@
 # distbuild/json_router.py -- state machine to route JSON messages
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -32,18 +32,30 @@ class JsonRouter(distbuild.StateMachine):
     sent to the next free helper. The helper's response will retain
     the unique id, so that the response can be routed to the right
     client.
+
+    A helper runs up to ``slots`` requests at once. It says it is ready
+    when it starts, and again whenever it finishes a request, so it is
+    counted as free once for each slot when it first says so, and once
+    more each time after that.
+
+    A helper may say that it only runs exec-requests for some commands,
+    such as a ``morph worker-build-service`` for ``worker-build``. While
+    there is such a helper, requests for its commands wait for it, and
+    are not sent to other helpers.
     
     '''
 
     pending_requests = []
     running_requests = {}
     pending_helpers = []
+    helper_commands = {}
     request_counter = distbuild.IdentifierGenerator('JsonRouter')
     route_map = distbuild.RouteMap()
 
-    def __init__(self, conn):
+    def __init__(self, conn, slots=1):
         distbuild.StateMachine.__init__(self, 'idle')
         self.conn = conn
+        self.slots = slots
         logging.debug('JsonMachine: connection from %s', conn.getpeername())
 
     def setup(self):
@@ -80,8 +92,7 @@ class JsonRouter(distbuild.StateMachine):
 
     def do_request(self, client, event):
         self._enqueue_request(client, event.msg)
-        if self.pending_helpers:
-            self._send_request()
+        self._send_requests()
 
     def do_cancel(self, client, event):
         for id in self.route_map.get_outgoing_ids(event.msg['id']):
@@ -104,9 +115,12 @@ class JsonRouter(distbuild.StateMachine):
             logging.debug('JsonRouter: sent to client: %s', repr(new))
 
     def do_helper_ready(self, helper, event):
-        self.pending_helpers.append(helper)
-        if self.pending_requests:
-            self._send_request()
+        if helper in self.helper_commands:
+            self.pending_helpers.append(helper)
+        else:
+            self.helper_commands[helper] = event.msg.get('commands')
+            self.pending_helpers.extend([helper] * self.slots)
+        self._send_requests()
 
     def do_exec_output(self, helper, event):
         t = self._lookup_request(event.msg['id'])
@@ -122,7 +136,8 @@ class JsonRouter(distbuild.StateMachine):
         event_source.close()
 
         # Remove from pending helpers.
-        if event_source in self.pending_helpers:
+        self.helper_commands.pop(event_source, None)
+        while event_source in self.pending_helpers:
             self.pending_helpers.remove(event_source)
 
         # Remove from running requests, and put the request back in the
@@ -147,8 +162,7 @@ class JsonRouter(distbuild.StateMachine):
                 
         # Finally, if there are any pending requests and helpers,
         # send requests.
-        while self.pending_requests and self.pending_helpers:
-            self._send_request()
+        self._send_requests()
 
     def _enqueue_request(self, client, msg):
         new = dict(msg)
@@ -156,10 +170,37 @@ class JsonRouter(distbuild.StateMachine):
         self.route_map.add(msg['id'], new['id'])
         self.pending_requests.append((client, new))
 
-    def _send_request(self):
-        client, msg = self.pending_requests.pop(0)
-        helper = self.pending_helpers.pop()
-        self.running_requests[msg['id']] = (client, msg, helper)
-        helper.send(msg)
-        logging.debug('JsonRouter: sent to helper: %s', repr(msg))
+    def _send_requests(self):
+        i = 0
+        while i < len(self.pending_requests) and self.pending_helpers:
+            client, msg = self.pending_requests[i]
+            helper = self._find_helper(msg)
+            if helper is None:
+                i += 1
+                continue
+            del self.pending_requests[i]
+            self.running_requests[msg['id']] = (client, msg, helper)
+            helper.send(msg)
+            logging.debug('JsonRouter: sent to helper: %s', repr(msg))
+
+    def _find_helper(self, msg):
+        '''Remove and return a free helper for a request, or None.'''
+
+        command = None
+        if msg['type'] == 'exec-request' and len(msg['argv']) > 1:
+            command = msg['argv'][1]
+        if not any(command in commands
+                   for commands in self.helper_commands.itervalues()
+                   if commands is not None):
+            command = None
+
+        for i in xrange(len(self.pending_helpers) - 1, -1, -1):
+            commands = self.helper_commands[self.pending_helpers[i]]
+            if commands is None:
+                suitable = command is None
+            else:
+                suitable = command in commands
+            if suitable:
+                return self.pending_helpers.pop(i)
+        return None
 
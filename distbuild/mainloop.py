@@ -1,6 +1,6 @@
-# mainloop/mainloop.py -- select-based main loop
+# mainloop/mainloop.py -- poll-based main loop
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,15 +16,17 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import collections
 import fcntl
 import logging
 import os
-import select
+
+from poller import new_poller, READ, WRITE, EXCEPT
 
 
 class MainLoop(object):
 
-    '''A select-based main loop.
+    '''A poll-based main loop.
     
     The main loop watches a set of file descriptors wrapped in 
     EventSource objects, and when something happens with them,
@@ -32,15 +34,31 @@ class MainLoop(object):
     feeds into user-supplied state machines. The state machines
     can create further events, which are processed further.
     
-    When nothing is happening, the main loop sleeps in the
-    select.select call.
+    When nothing is happening, the main loop sleeps in its poller,
+    which uses epoll where it is available and select elsewhere.
+    FileDescriptorEventSource objects tell the poller what to watch
+    as that changes. Other event sources are asked for their select
+    parameters before every wait, so they should be few.
+
+    An event is only fed to the state machines that have a transition
+    for its event source and class, in any state, which the main loop
+    looks up in an index rather than asking every machine. Machines
+    which do not say what events they are interested in, by having an
+    ``event_interests`` method, are fed every event.
     
     '''
 
-    def __init__(self):
+    def __init__(self, poller=None):
         self._machines = []
+        self._poller = poller or new_poller()
+        # Event sources asked what to watch before every wait.
         self._sources = []
-        self._events = []
+        self._events = collections.deque()
+        # (event source, event class) -> machines, in the order they
+        # subscribed.
+        self._subscribers = {}
+        # Machines that get every event.
+        self._catch_all = []
         self.dump_filename = None
         
     def add_state_machine(self, machine):
@@ -48,6 +66,11 @@ class MainLoop(object):
         machine.mainloop = self
         machine.setup()
         self._machines.append(machine)
+        if hasattr(machine, 'event_interests'):
+            for event_source, event_class in machine.event_interests():
+                self.subscribe(machine, event_source, event_class)
+        else:
+            self._catch_all.append(machine)
         if self.dump_filename:
             filename = '%s%s.dot' % (self.dump_filename, 
                                      machine.__class__.__name__)
@@ -56,49 +79,134 @@ class MainLoop(object):
     def remove_state_machine(self, machine):
         logging.debug('MainLoop.remove_state_machine: %s' % machine)
         self._machines.remove(machine)
+        if hasattr(machine, 'event_interests'):
+            for key in machine.event_interests():
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None and machine in subscribers:
+                    subscribers.remove(machine)
+                    if not subscribers:
+                        del self._subscribers[key]
+        else:
+            self._catch_all.remove(machine)
+
+    def subscribe(self, machine, event_source, event_class):
+        '''Feed events of a class from a source to a state machine.
+
+        State machines call this when they get a new transition after
+        they have been added. Subscribing more than once is harmless.
+
+        '''
+
+        subscribers = self._subscribers.setdefault(
+            (event_source, event_class), [])
+        if machine not in subscribers:
+            subscribers.append(machine)
     
     def add_event_source(self, event_source):
         logging.debug('MainLoop.add_event_source: %s' % event_source)
-        self._sources.append(event_source)
+        if hasattr(event_source, 'attach'):
+            event_source.attach(self._poller)
+        else:
+            self._sources.append(event_source)
     
     def remove_event_source(self, event_source):
         logging.debug('MainLoop.remove_event_source: %s' % event_source)
-        self._sources.remove(event_source)
+        if hasattr(event_source, 'attach'):
+            event_source.detach()
+        else:
+            self._sources.remove(event_source)
     
     def _setup_select(self):
-        r = []
-        w = []
-        x = []
+        '''Watch what the event sources without a poller want watched.
+
+        Return (watched, shared, timeout), where watched is a list of
+        (object, fd, flag) triples for the things the event sources asked
+        for, and shared maps each of those file descriptors that an event
+        source already watches through the poller to the (source, flags)
+        it watches it with.
+
+        '''
+
+        watched = []
+        flags = {}
         timeout = None
 
         self._sources = [s for s in self._sources if not s.is_finished()]
         
         for event_source in self._sources:
             sr, sw, sx, st = event_source.get_select_params()
-            r.extend(sr)
-            w.extend(sw)
-            x.extend(sx)
+            for objects, flag in ((sr, READ), (sw, WRITE), (sx, EXCEPT)):
+                for obj in objects:
+                    fd = obj if isinstance(obj, int) else obj.fileno()
+                    watched.append((obj, fd, flag))
+                    flags[fd] = flags.get(fd, 0) | flag
             if timeout is None:
                 timeout = st
             elif st is not None:
                 timeout = min(timeout, st)
 
-        return r, w, x, timeout
+        shared = {}
+        for fd, fd_flags in flags.iteritems():
+            old = self._poller.watched_as(fd)
+            if old is not None:
+                shared[fd] = old
+                fd_flags |= old[1]
+            self._poller.watch(fd, None, fd_flags)
 
-    def _run_once(self):
-        r, w, x, timeout = self._setup_select()
-        assert r or w or x or timeout is not None
-        r, w, x = select.select(r, w, x, timeout)
+        return watched, shared, timeout
 
-        for event_source in self._sources:
-            if event_source.is_finished():
-                self.remove_event_source(event_source)
-            else:
-                for event in event_source.get_events(r, w, x):
+    def _run_once(self):
+        watched, shared, timeout = self._setup_select()
+        assert self._poller.is_watching() or timeout is not None
+        try:
+            ready = self._poller.poll(timeout)
+        finally:
+            # File descriptors that were watched already are given back
+            # to the event source that watches them.
+            for fd in set(fd for obj, fd, flag in watched):
+                if fd in shared:
+                    source, flags = shared[fd]
+                    self._poller.watch(fd, source, flags)
+                else:
+                    self._poller.unwatch(fd)
+
+        ready_flags = {}
+        for event_source, fd, flags in ready:
+            if event_source is None:
+                ready_flags[fd] = flags
+                if fd not in shared:
+                    continue
+                event_source, source_flags = shared[fd]
+                flags &= source_flags
+            if flags:
+                for event in event_source.get_poll_events(fd, flags):
                     self.queue_event(event_source, event)
 
+        if self._sources:
+            r = []
+            w = []
+            x = []
+            lists = {READ: r, WRITE: w, EXCEPT: x}
+            for obj, fd, flag in watched:
+                if ready_flags.get(fd, 0) & flag:
+                    lists[flag].append(obj)
+
+            for event_source in self._sources[:]:
+                if event_source.is_finished():
+                    self.remove_event_source(event_source)
+                else:
+                    for event in event_source.get_events(r, w, x):
+                        self.queue_event(event_source, event)
+
+        self._process_events()
+
+    def _process_events(self):
         for event_source, event in self._dequeue_events():
-            for machine in self._machines[:]:
+            machines = self._subscribers.get(
+                (event_source, event.__class__), [])
+            if self._catch_all:
+                machines = machines + self._catch_all
+            for machine in machines[:]:
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
                 if machine.state is None:
@@ -124,6 +232,6 @@ class MainLoop(object):
 
     def _dequeue_events(self):
         while self._events:
-            event_source, event = self._events.pop(0)
+            event_source, event = self._events.popleft()
 
             yield event_source, event
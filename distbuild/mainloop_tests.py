@@ -0,0 +1,261 @@
+# distbuild/mainloop_tests.py -- unit tests for the main loop
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import distbuild
+
+
+class Ping(object):
+
+    pass
+
+
+class Pong(object):
+
+    pass
+
+
+class DummyEventSource(distbuild.EventSource):
+
+    '''Return the given events once, and then finish.'''
+
+    def __init__(self, events):
+        self.events = events
+
+    def get_select_params(self):
+        return [], [], [], 0
+
+    def get_events(self, r, w, x):
+        events, self.events = self.events, []
+        return events
+
+    def is_finished(self):
+        return not self.events
+
+
+class SelectEventSource(distbuild.EventSource):
+
+    '''Ask to watch the given things once, and record what was ready.'''
+
+    def __init__(self, r=[], w=[], timeout=None):
+        self.r = r
+        self.w = w
+        self.timeout = timeout
+        self.ready = None
+
+    def get_select_params(self):
+        return self.r, self.w, [], self.timeout
+
+    def get_events(self, r, w, x):
+        self.ready = (r, w, x)
+        return []
+
+    def is_finished(self):
+        return self.ready is not None
+
+
+class RecordingMachine(distbuild.StateMachine):
+
+    def __init__(self, source, event_class, log, stop=False, returns=()):
+        distbuild.StateMachine.__init__(self, 'init')
+        self.source = source
+        self.event_class = event_class
+        self.log = log
+        self.stop = stop
+        self.returns = returns
+
+    def setup(self):
+        new_state = None if self.stop else 'init'
+        self.add_transition('init', self.source, self.event_class,
+                            new_state, self.record)
+
+    def record(self, event_source, event):
+        self.log.append((self, event))
+        return self.returns
+
+
+class CatchAllMachine(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.state = 'init'
+
+    def setup(self):
+        pass
+
+    def handle_event(self, event_source, event):
+        self.log.append((self, event))
+        return []
+
+
+class MainLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = distbuild.MainLoop()
+        self.source = object()
+        self.log = []
+
+    def machine(self, source=None, event_class=Ping, stop=False,
+                returns=()):
+        machine = RecordingMachine(source or self.source, event_class,
+                                   self.log, stop, returns)
+        self.loop.add_state_machine(machine)
+        return machine
+
+    def dispatch(self, source, event):
+        self.loop.queue_event(source, event)
+        self.loop._process_events()
+
+    def test_feeds_event_only_to_interested_machines(self):
+        ping = self.machine()
+        self.machine(event_class=Pong)
+        self.machine(source=object())
+        event = Ping()
+        self.dispatch(self.source, event)
+        self.assertEqual(self.log, [(ping, event)])
+
+    def test_feeds_event_to_machines_in_order_they_were_added(self):
+        first = self.machine()
+        second = self.machine()
+        event = Ping()
+        self.dispatch(self.source, event)
+        self.assertEqual(self.log, [(first, event), (second, event)])
+
+    def test_feeds_events_from_classes_used_as_sources(self):
+        machine = self.machine(source=RecordingMachine)
+        event = Ping()
+        self.dispatch(RecordingMachine, event)
+        self.assertEqual(self.log, [(machine, event)])
+
+    def test_feeds_events_for_transitions_added_later(self):
+        machine = self.machine()
+        machine.add_transition('init', self.source, Pong, 'init',
+                               machine.record)
+        event = Pong()
+        self.dispatch(self.source, event)
+        self.assertEqual(self.log, [(machine, event)])
+
+    def test_feeds_every_event_to_machines_without_interests(self):
+        machine = CatchAllMachine(self.log)
+        self.loop.add_state_machine(machine)
+        event = Ping()
+        self.dispatch(self.source, event)
+        self.loop.remove_state_machine(machine)
+        self.dispatch(self.source, Ping())
+        self.assertEqual(self.log, [(machine, event)])
+
+    def test_feeds_events_that_machines_return(self):
+        event = Pong()
+        ping = self.machine(returns=[event])
+        pong = self.machine(event_class=Pong)
+        self.dispatch(self.source, Ping())
+        self.assertEqual([m for m, e in self.log], [ping, pong])
+        self.assertEqual(self.log[1], (pong, event))
+
+    def test_removes_machines_that_stop(self):
+        machine = self.machine(stop=True)
+        self.dispatch(self.source, Ping())
+        self.dispatch(self.source, Ping())
+        self.assertEqual([m for m, e in self.log], [machine])
+        self.assertEqual(self.loop._subscribers, {})
+
+    def test_runs_until_all_machines_stop(self):
+        source = DummyEventSource([Ping()])
+        self.machine(source=source, stop=True)
+        self.loop.add_event_source(source)
+        self.loop.run()
+        self.assertEqual(self.loop._machines, [])
+
+    def test_removes_event_sources_that_finish(self):
+        source = DummyEventSource([])
+        source.is_finished = iter([False, True]).next
+        self.machine(source=source)
+        self.loop.add_event_source(source)
+        self.loop._run_once()
+        self.assertEqual(self.loop._sources, [])
+
+    def test_watches_file_descriptor_event_sources_through_poller(self):
+        sock, other = socket.socketpair()
+        source = distbuild.SocketEventSource(sock)
+        source.stop_writing()
+        self.machine(source=source, event_class=distbuild.SocketReadable,
+                     stop=True)
+        self.loop.add_event_source(source)
+        self.assertEqual(self.loop._sources, [])
+        other.send('x')
+        self.loop.run()
+        self.assertEqual(source.read(1), 'x')
+        self.loop.remove_event_source(source)
+        self.assertFalse(self.loop._poller.is_watching())
+        source.close()
+        other.close()
+
+    def test_dumps_machines_if_asked_to(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.loop.dump_filename = os.path.join(tempdir, 'dump-')
+            self.machine()
+            self.assertEqual(os.listdir(tempdir),
+                             ['dump-RecordingMachine.dot'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_watches_select_style_event_sources(self):
+        sock, other = socket.socketpair()
+        other.send('x')
+        source = SelectEventSource(r=[sock, other.fileno()],
+                                   w=[other.fileno()])
+        self.loop.add_event_source(source)
+        self.loop.add_event_source(SelectEventSource(timeout=5))
+        self.loop.add_event_source(SelectEventSource(timeout=1))
+        timeouts = []
+        poll = self.loop._poller.poll
+        def record_poll(timeout):
+            timeouts.append(timeout)
+            return poll(timeout)
+        self.loop._poller.poll = record_poll
+        self.loop._run_once()
+        self.assertEqual(timeouts, [1])
+        self.assertEqual(source.ready, ([sock], [other.fileno()], []))
+        self.assertFalse(self.loop._poller.is_watching())
+        sock.close()
+        other.close()
+
+    def test_shares_file_descriptors_with_select_style_sources(self):
+        sock, other = socket.socketpair()
+        source = distbuild.SocketEventSource(sock)
+        source.stop_writing()
+        machine = self.machine(source=source,
+                               event_class=distbuild.SocketReadable)
+        self.loop.add_event_source(source)
+        select_source = SelectEventSource(r=[sock], w=[sock])
+        self.loop.add_event_source(select_source)
+        other.send('x')
+        self.loop._run_once()
+        self.assertEqual(select_source.ready, ([sock], [sock], []))
+        self.assertEqual([(m, e.__class__) for m, e in self.log],
+                         [(machine, distbuild.SocketReadable)])
+        self.assertEqual(self.loop._poller.watched_as(sock.fileno()),
+                         (source, distbuild.READ))
+        source.close()
+        other.close()
@@ -0,0 +1,227 @@
+# distbuild/poller.py -- watching file descriptors for the main loop
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import fcntl
+import select
+
+
+READ = 1
+WRITE = 2
+EXCEPT = 4
+
+
+class Poller(object):
+
+    '''Watch file descriptors for the main loop.
+
+    Each file descriptor is watched on behalf of an event source, for
+    some of READ, WRITE and EXCEPT. What is watched is changed as it
+    changes, by calling ``watch`` and ``unwatch``, rather than being
+    worked out again before every wait.
+
+    This is a base class; subclasses wait using some system call.
+
+    '''
+
+    def __init__(self):
+        # fd -> (event source, flags)
+        self._watched = {}
+        # How many file descriptors are watched for something.
+        self._active = 0
+
+    def watch(self, fd, source, flags):
+        '''Start watching a file descriptor, or change what is watched.
+
+        If flags is 0, the file descriptor is kept, but nothing is
+        reported for it until it is watched for something again.
+
+        '''
+
+        old_source, old_flags = self._watched.get(fd, (None, 0))
+        self._active += bool(flags) - bool(old_flags)
+        self._watched[fd] = (source, flags)
+
+    def unwatch(self, fd):
+        '''Stop watching a file descriptor.
+
+        This must be called before the file descriptor is closed.
+
+        '''
+
+        source, flags = self._watched.pop(fd)
+        self._active -= bool(flags)
+
+    def watched_as(self, fd):
+        '''Return (source, flags) a file descriptor is watched with.
+
+        Return None if it is not watched at all.
+
+        '''
+
+        return self._watched.get(fd)
+
+    def is_watching(self):
+        '''Is any file descriptor watched for anything?'''
+
+        return self._active > 0
+
+    def poll(self, timeout):
+        '''Wait until a file descriptor is ready, or timeout seconds.
+
+        A timeout of None means to wait for as long as it takes. Return
+        a list of (source, fd, flags) triples, for the file descriptors
+        that are ready for any of the things they are watched for.
+
+        '''
+
+        raise NotImplementedError()
+
+
+class SelectPoller(Poller):
+
+    '''Wait using select.select.
+
+    This works everywhere, but costs time in proportion to the number
+    of file descriptors watched, and cannot watch file descriptors
+    numbered 1024 or higher.
+
+    '''
+
+    def poll(self, timeout):
+        r = []
+        w = []
+        x = []
+        for fd, (source, flags) in self._watched.iteritems():
+            if flags & READ:
+                r.append(fd)
+            if flags & WRITE:
+                w.append(fd)
+            if flags & EXCEPT:
+                x.append(fd)
+
+        try:
+            r, w, x = select.select(r, w, x, timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = {}
+        for fd_list, flag in ((r, READ), (w, WRITE), (x, EXCEPT)):
+            for fd in fd_list:
+                ready[fd] = ready.get(fd, 0) | flag
+        return [(self._watched[fd][0], fd, flags)
+                for fd, flags in ready.iteritems()]
+
+
+class EpollPoller(Poller):
+
+    '''Wait using Linux's epoll.
+
+    The kernel keeps the set of watched file descriptors, so waiting
+    costs time in proportion to the number of ready ones only.
+
+    '''
+
+    def __init__(self):
+        Poller.__init__(self)
+        self._epoll = select.epoll()
+        # Processes started by the main loop's users should not inherit
+        # it.
+        fd = self._epoll.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def watch(self, fd, source, flags):
+        old_source, old_flags = self._watched.get(fd, (None, 0))
+        Poller.watch(self, fd, source, flags)
+        # epoll reports errors and hangups even for file descriptors
+        # watched for nothing, so those are left out altogether.
+        if flags and old_flags:
+            try:
+                self._epoll.modify(fd, self._epoll_mask(flags))
+            except IOError, e:
+                # The kernel forgets file descriptors once they are
+                # closed, so this may be a new one with the same number.
+                if e.errno != errno.ENOENT:
+                    raise
+                self._epoll.register(fd, self._epoll_mask(flags))
+        elif flags:
+            self._epoll.register(fd, self._epoll_mask(flags))
+        elif old_flags:
+            self._unregister(fd)
+
+    def unwatch(self, fd):
+        source, flags = self._watched[fd]
+        Poller.unwatch(self, fd)
+        if flags:
+            self._unregister(fd)
+
+    def _unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except IOError, e:
+            if e.errno not in (errno.ENOENT, errno.EBADF):
+                raise # pragma: no cover
+
+    def poll(self, timeout):
+        try:
+            ready = self._epoll.poll(-1 if timeout is None else timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        result = []
+        for fd, mask in ready:
+            source, flags = self._watched[fd]
+            ready_flags = 0
+            if mask & select.EPOLLIN:
+                ready_flags |= READ
+            if mask & select.EPOLLOUT:
+                ready_flags |= WRITE
+            if mask & select.EPOLLPRI:
+                ready_flags |= EXCEPT
+            if mask & (select.EPOLLERR | select.EPOLLHUP):
+                # As select does, report the file descriptor as ready, so
+                # that reading or writing it finds out what happened.
+                ready_flags |= READ | WRITE
+            ready_flags &= flags
+            if ready_flags:
+                result.append((source, fd, ready_flags))
+        return result
+
+    def _epoll_mask(self, flags):
+        mask = 0
+        if flags & READ:
+            mask |= select.EPOLLIN
+        if flags & WRITE:
+            mask |= select.EPOLLOUT
+        if flags & EXCEPT:
+            mask |= select.EPOLLPRI
+        return mask
+
+
+def new_poller():
+    '''Return the best poller available on this system.'''
+
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    else: # pragma: no cover
+        return SelectPoller()
@@ -0,0 +1,192 @@
+# distbuild/poller_tests.py -- unit tests for pollers
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import os
+import select
+import socket
+import unittest
+
+import distbuild
+
+
+class InterruptedSelect(object):
+
+    '''Stand in for the select module, failing as a system call can.'''
+
+    error = select.error
+
+    def __init__(self, code):
+        self.code = code
+
+    def select(self, r, w, x, timeout):
+        raise select.error(self.code, os.strerror(self.code))
+
+
+class InterruptedEpoll(object):
+
+    '''Stand in for an epoll object, failing as a system call can.'''
+
+    def __init__(self, code):
+        self.code = code
+
+    def poll(self, timeout):
+        raise IOError(self.code, os.strerror(self.code))
+
+
+class PollerTests(object):
+
+    def setUp(self):
+        self.poller = self.new_poller()
+        self.read_fd, self.write_fd = os.pipe()
+        self.source = object()
+
+    def tearDown(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def test_is_not_watching_anything_at_first(self):
+        self.assertFalse(self.poller.is_watching())
+
+    def test_times_out_when_nothing_is_ready(self):
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        self.assertTrue(self.poller.is_watching())
+        self.assertEqual(self.poller.poll(0), [])
+
+    def test_reports_ready_file_descriptors(self):
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        os.write(self.write_fd, 'x')
+        self.assertEqual(
+            sorted(self.poller.poll(None)),
+            sorted([(self.source, self.read_fd, distbuild.READ),
+                    (self.source, self.write_fd, distbuild.WRITE)]))
+
+    def test_reports_nothing_for_file_descriptors_watched_for_nothing(self):
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        self.poller.watch(self.write_fd, self.source, 0)
+        self.assertFalse(self.poller.is_watching())
+        self.assertEqual(self.poller.poll(0), [])
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        self.assertEqual(self.poller.poll(0),
+                         [(self.source, self.write_fd, distbuild.WRITE)])
+
+    def test_reports_hangup_as_readable(self):
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        os.close(self.write_fd)
+        self.write_fd = os.open(os.devnull, os.O_WRONLY)
+        self.assertEqual(self.poller.poll(0),
+                         [(self.source, self.read_fd, distbuild.READ)])
+
+    def test_reports_urgent_data_as_exceptional(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.create_connection(listener.getsockname())
+        receiver, addr = listener.accept()
+        self.poller.watch(receiver.fileno(), self.source, distbuild.EXCEPT)
+        sender.send('x', socket.MSG_OOB)
+        self.assertEqual(self.poller.poll(1),
+                         [(self.source, receiver.fileno(), distbuild.EXCEPT)])
+        for sock in (listener, sender, receiver):
+            sock.close()
+
+    def test_returns_nothing_when_interrupted(self):
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        self.interrupt(errno.EINTR)
+        self.assertEqual(self.poller.poll(None), [])
+
+    def test_raises_other_errors_from_waiting(self):
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        self.interrupt(errno.EBADF)
+        self.assertRaises((select.error, IOError), self.poller.poll, None)
+
+    def test_stops_watching_file_descriptors(self):
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        self.poller.unwatch(self.write_fd)
+        self.assertFalse(self.poller.is_watching())
+        self.assertEqual(self.poller.poll(0), [])
+
+
+    def test_tells_how_file_descriptors_are_watched(self):
+        self.assertEqual(self.poller.watched_as(self.read_fd), None)
+        self.poller.watch(self.read_fd, self.source, distbuild.READ)
+        self.assertEqual(self.poller.watched_as(self.read_fd),
+                         (self.source, distbuild.READ))
+
+
+class BasePollerTests(unittest.TestCase):
+
+    def test_leaves_waiting_to_subclasses(self):
+        self.assertRaises(NotImplementedError, distbuild.Poller().poll, 0)
+
+    def test_uses_epoll_where_available(self):
+        self.assertTrue(isinstance(distbuild.poller.new_poller(),
+                                   distbuild.EpollPoller))
+
+    def test_falls_back_to_select_without_epoll(self):
+        self.addCleanup(setattr, distbuild.poller, 'select', select)
+        distbuild.poller.select = InterruptedSelect(errno.EINTR)
+        self.assertTrue(isinstance(distbuild.poller.new_poller(),
+                                   distbuild.SelectPoller))
+
+
+class SelectPollerTests(PollerTests, unittest.TestCase):
+
+    new_poller = distbuild.SelectPoller
+
+    def interrupt(self, code):
+        self.addCleanup(setattr, distbuild.poller, 'select', select)
+        distbuild.poller.select = InterruptedSelect(code)
+
+
+class EpollPollerTests(PollerTests, unittest.TestCase):
+
+    new_poller = distbuild.EpollPoller
+
+    def interrupt(self, code):
+        self.poller._epoll.close()
+        self.poller._epoll = InterruptedEpoll(code)
+
+    def test_fails_to_watch_closed_file_descriptor_again(self):
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        os.close(self.write_fd)
+        self.assertRaises(IOError, self.poller.watch, self.write_fd,
+                          self.source, distbuild.READ | distbuild.WRITE)
+        self.write_fd = os.open(os.devnull, os.O_WRONLY)
+
+    def test_unwatches_file_descriptor_the_kernel_forgot(self):
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        read_fd, write_fd = os.pipe()
+        os.close(self.write_fd)
+        os.dup2(write_fd, self.write_fd)
+        os.close(write_fd)
+        os.close(read_fd)
+        self.poller.unwatch(self.write_fd)
+        self.assertFalse(self.poller.is_watching())
+
+    def test_watches_new_file_descriptor_with_number_of_closed_one(self):
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        read_fd, write_fd = os.pipe()
+        os.close(self.write_fd)
+        os.dup2(write_fd, self.write_fd)
+        os.close(write_fd)
+        self.poller.watch(self.write_fd, self.source, distbuild.WRITE)
+        self.assertEqual(self.poller.poll(0),
+                         [(self.source, self.write_fd, distbuild.WRITE)])
+        os.close(read_fd)
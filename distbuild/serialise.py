@@ -1,7 +1,7 @@
 # distbuild/serialise.py -- (de)serialise Artifact object graphs
 #
-# Copyright (C) 2012, 2014  Codethink Limited
-# 
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
+#
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; version 2 of the License.
@@ -16,123 +16,257 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import hashlib
 import json
 import yaml
 
 import morphlib
-import logging
+
+from jm import ascii_strings
+
+
+# The version of the format written by serialise_artifact. Graphs in the
+# original format, YAML wrapped in a JSON string, are still read.
+FORMAT_VERSION = 2
+
+# The fields of an encoded source, in order. All but the last five are
+# indexes into the table of strings, or None.
+_SOURCE_STRINGS = ('name', 'repo_name', 'original_ref', 'sha1', 'tree',
+                   'filename', 'cache_key', 'build_mode', 'prefix')
 
 
 def serialise_artifact(artifact):
-    '''Serialise an Artifact object and its dependencies into string form.'''
+    '''Serialise an Artifact object and its dependencies into string form.
+
+    The result is one line of JSON. It holds the artifact, everything it
+    depends on, and the strata that depend on any of those, so that
+    ``morph worker-build`` can tell which stratum a chunk is in. Only
+    what is needed to build the artifact is included, so serialising a
+    chunk gives a much smaller graph than serialising a system.
+
+    Strings that appear in many sources, such as repository names and
+    refs, are stored once in a table, as are the values in cache ids,
+    such as the build environment. Morphologies are stored once for each
+    distinct content, and the rules of the split rules of sources once
+    for each distinct rule, so that the regular expressions in them are
+    only compiled once by ``deserialise_artifact``.
+
+    '''
+
+    strings = []
+    string_ids = {}
+    morphologies = []
+    morphology_ids = {}
+    morphology_ids_by_content = {}
+    rules = []
+    rule_ids = {}
+    values = []
+    value_ids = {}
+    sources = []
+    source_ids = {}
+    artifacts = []
+    artifact_ids = {}
+
+    def encode_string(s):
+        if s is None:
+            return None
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
 
     def encode_morphology(morphology):
-        result = {}
-        for key in morphology.keys():
-            result[key] = morphology[key]
-        return result
-    
-    def encode_source(source, prune_leaf=False):
-        source_dic = {
-            'name': source.name,
-            'repo': None,
-            'repo_name': source.repo_name,
-            'original_ref': source.original_ref,
-            'sha1': source.sha1,
-            'tree': source.tree,
-            'morphology': id(source.morphology),
-            'filename': source.filename,
-            'artifact_ids': [],
-            'cache_id': source.cache_id,
-            'cache_key': source.cache_key,
-            'dependencies': [],
-        }
-        if not prune_leaf:
-            source_dic['artifact_ids'].extend(id(artifact) for (_, artifact)
-                                              in source.artifacts.iteritems())
-            source_dic['dependencies'].extend(id(d)
-                                              for d in source.dependencies)
-
-        if source.morphology['kind'] == 'chunk':
-            source_dic['build_mode'] = source.build_mode
-            source_dic['prefix'] = source.prefix
-        return source_dic
-
-    def encode_artifact(a):
-        if artifact.source.morphology['kind'] == 'system': # pragma: no cover
-            arch = artifact.source.morphology['arch']
+        if id(morphology) not in morphology_ids:
+            data = dict(morphology)
+            key = hashlib.sha1(json.dumps(data, sort_keys=True)).digest()
+            if key not in morphology_ids_by_content:
+                morphology_ids_by_content[key] = len(morphologies)
+                morphologies.append(data)
+            morphology_ids[id(morphology)] = morphology_ids_by_content[key]
+        return morphology_ids[id(morphology)]
+
+    def encode_cache_id(source, pruned):
+        cache_id = source.cache_id
+        if cache_id is None:
+            return None
+        encoded = {}
+        for key, value in cache_id.iteritems():
+            if (key == 'kids' and not pruned and
+                    value == _kids(source.dependencies)):
+                # The largest part of most cache ids, and easily rebuilt.
+                encoded[key] = None
+                continue
+            value_key = json.dumps(value, sort_keys=True)
+            if value_key not in value_ids:
+                value_ids[value_key] = len(values)
+                values.append(value)
+            encoded[key] = value_ids[value_key]
+        return encoded
+
+    def encode_rule(rule):
+        encoded = rule.encode()
+        key = json.dumps(encoded)
+        if key not in rule_ids:
+            rule_ids[key] = len(rules)
+            rules.append(encoded)
+        return rule_ids[key]
+
+    def add_source(source, pruned=False):
+        source_ids[source] = len(sources)
+        sources.append(None)
+        if pruned:
+            split_rules = None
         else:
-            arch = artifact.arch
-
-        return {
-            'source_id': id(a.source),
-            'name': a.name,
-            'arch': arch,
-            'dependents': [id(d)
-                for d in a.dependents],
-        }
-
-    encoded_artifacts = {}
-    encoded_sources = {}
-    encoded_morphologies = {}
-    visited_artifacts = {}
-
-    for a in artifact.walk():
-        if id(a.source) not in encoded_sources:
+            split_rules = [[encode_string(name), encode_rule(rule)]
+                           for name, rule in source.split_rules]
+        sources[source_ids[source]] = [
+            encode_string(getattr(source, field, None))
+            for field in _SOURCE_STRINGS] + [
+            encode_morphology(source.morphology),
+            encode_cache_id(source, pruned),
+            split_rules,
+            [], # artifacts, filled in below
+            [], # dependencies, filled in below
+        ]
+
+    def add_artifact(a):
+        artifact_ids[a] = len(artifacts)
+        artifacts.append(a)
+
+    walked = artifact.walk()
+    for a in walked:
+        if a.source not in source_ids:
+            add_source(a.source)
             for sa in a.source.artifacts.itervalues():
-                if id(sa) not in encoded_artifacts:
-                    visited_artifacts[id(sa)] = sa
-                    encoded_artifacts[id(sa)] = encode_artifact(sa)
-            encoded_morphologies[id(a.source.morphology)] = \
-                encode_morphology(a.source.morphology)
-            encoded_sources[id(a.source)] = encode_source(a.source)
-
-        if id(a) not in encoded_artifacts: # pragma: no cover
-            visited_artifacts[id(a)] = a
-            encoded_artifacts[id(a)] = encode_artifact(a)
-
-    # Include one level of dependents above encoded artifacts, as we need
-    # them to be able to tell whether two sources are in the same stratum.
-    for a in visited_artifacts.itervalues():
-        for source in a.dependents: # pragma: no cover
-            if id(source) not in encoded_sources:
-                encoded_morphologies[id(source.morphology)] = \
-                    encode_morphology(source.morphology)
-                encoded_sources[id(source)] = \
-                    encode_source(source, prune_leaf=True)
+                if sa not in artifact_ids:
+                    add_artifact(sa)
+        if a not in artifact_ids: # pragma: no cover
+            add_artifact(a)
+
+    # Include one level of strata above the artifacts, as they are needed
+    # to tell whether two chunks are in the same stratum, but not their
+    # own dependencies or artifacts.
+    for a in list(artifacts):
+        for source in a.dependents:
+            if (source not in source_ids and
+                    source.morphology['kind'] == 'stratum'):
+                add_source(source, pruned=True)
+
+    for source, i in source_ids.iteritems():
+        if sources[i][-3] is not None:
+            sources[i][-2] = [artifact_ids[a]
+                              for a in source.artifacts.itervalues()]
+            sources[i][-1] = [artifact_ids[a]
+                              for a in source.dependencies]
+
+    encoded_artifacts = [
+        [source_ids[a.source], encode_string(a.name),
+         [source_ids[s] for s in a.dependents if s in source_ids]]
+        for a in artifacts]
+
+    if artifact.source.morphology['kind'] == 'system': # pragma: no cover
+        arch = artifact.source.morphology['arch']
+    else:
+        arch = artifact.arch
 
     content = {
-        'sources': encoded_sources,
+        'format': FORMAT_VERSION,
+        'arch': arch,
+        'strings': strings,
+        'morphologies': morphologies,
+        'rules': rules,
+        'values': values,
+        'sources': sources,
         'artifacts': encoded_artifacts,
-        'morphologies': encoded_morphologies,
-        'root_artifact': id(artifact),
-        'default_split_rules': {
-            'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
-            'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
-        },
+        'root_artifact': artifact_ids[artifact],
     }
-    return json.dumps(yaml.dump(content))
+    return json.dumps(content, separators=(',', ':'))
 
 
 def deserialise_artifact(encoded):
     '''Re-construct the Artifact object (and dependencies).
-    
+
     The argument should be a string returned by ``serialise_artifact``.
     The reconstructed Artifact objects will be sufficiently like the
     originals that they can be used as a build graph, and other such
     purposes, by Morph.
-    
+
     '''
 
-    def decode_morphology(le_dict):
-        '''Convert a dict into something that kinda acts like a Morphology.
-        
-        As it happens, we don't need the full Morphology so we cheat.
-        Cheating is good.
-        
-        '''
-        
-        return morphlib.morphology.Morphology(le_dict)
+    encoded = encoded.strip()
+    if encoded.startswith('"'):
+        return _deserialise_artifact_v1(encoded)
+
+    content = ascii_strings(json.loads(encoded))
+    if content.get('format') != FORMAT_VERSION:
+        raise ValueError('Unknown build graph format %s' %
+                         content.get('format'))
+
+    strings = content['strings']
+    morphologies = [morphlib.morphology.Morphology(d)
+                    for d in content['morphologies']]
+    rules = [morphlib.artifactsplitrule.decode_rule(r)
+             for r in content['rules']]
+    values = content['values']
+    field_count = len(_SOURCE_STRINGS)
+
+    sources = []
+    for encoded_source in content['sources']:
+        fields = dict(
+            (field, None if i is None else strings[i])
+            for field, i in zip(_SOURCE_STRINGS, encoded_source))
+        morphology_id = encoded_source[field_count]
+        split_rules = encoded_source[field_count + 2]
+        morphology = morphologies[morphology_id]
+        split_rules = morphlib.artifactsplitrule.SplitRules(
+            (strings[name], rules[rule])
+            for name, rule in split_rules or [])
+        source = morphlib.source.Source(
+            fields['name'], fields['repo_name'], fields['original_ref'],
+            fields['sha1'], fields['tree'], morphology, fields['filename'],
+            split_rules)
+        if morphology['kind'] == 'chunk':
+            source.build_mode = fields['build_mode']
+            source.prefix = fields['prefix']
+        source.cache_key = fields['cache_key']
+        sources.append(source)
+
+    artifacts = []
+    for source_id, name, dependent_ids in content['artifacts']:
+        artifact = morphlib.artifact.Artifact(sources[source_id],
+                                              strings[name])
+        artifact.arch = content['arch']
+        artifact.dependents = [sources[i] for i in dependent_ids]
+        artifacts.append(artifact)
+
+    for source, encoded_source in zip(sources, content['sources']):
+        artifact_ids, dependency_ids = encoded_source[-2:]
+        source.artifacts = dict((artifacts[i].name, artifacts[i])
+                                for i in artifact_ids)
+        source.dependencies = [artifacts[i] for i in dependency_ids]
+        cache_id = encoded_source[field_count + 1]
+        if cache_id is not None:
+            source.cache_id = dict(
+                (key, _kids(source.dependencies) if i is None else values[i])
+                for key, i in cache_id.iteritems())
+
+    return artifacts[content['root_artifact']]
+
+
+def _kids(dependencies):
+    '''Return the 'kids' field of a cache id, as CacheKeyComputer does.'''
+
+    return [{'artifact': a.name, 'cache-key': a.source.cache_key}
+            for a in dependencies]
+
+
+def _deserialise_artifact_v1(encoded):
+    '''Re-construct an Artifact serialised in the original format.
+
+    This was YAML, wrapped in a JSON string, and is still sent by older
+    controllers to ``morph worker-build``.
+
+    '''
 
     def decode_source(le_dict, morphology, split_rules):
         '''Convert a dict into a Source object.'''
@@ -152,12 +286,12 @@ def deserialise_artifact(encoded):
         source.cache_id =  le_dict['cache_id']
         source.cache_key = le_dict['cache_key']
         return source
-        
+
     def decode_artifact(artifact_dict, source):
         '''Convert dict into an Artifact object.
-        
+
         Do not set dependencies, that will be dealt with later.
-        
+
         '''
 
         artifact = morphlib.artifact.Artifact(source, artifact_dict['name'])
@@ -175,7 +309,7 @@ def deserialise_artifact(encoded):
 
     artifacts = {}
     sources = {}
-    morphologies = {id: decode_morphology(d)
+    morphologies = {id: morphlib.morphology.Morphology(d)
                     for (id, d) in morphologies_dict.iteritems()}
 
     # Decode sources
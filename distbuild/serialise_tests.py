@@ -1,6 +1,6 @@
 # distbuild/serialise_tests.py -- unit tests for Artifact serialisation
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,9 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import json
 import unittest
 
+import yaml
+
 import distbuild
+import morphlib
 
 
 class MockMorphology(object):
@@ -67,6 +71,9 @@ class MockSource(object):
         }
         self.cache_key = '%s.cache_key' % name
         self.artifacts = {}
+        self.split_rules = morphlib.artifactsplitrule.SplitRules()
+        self.split_rules.add(
+            name, morphlib.artifactsplitrule.FileMatch([r'.*']))
 
 
 class MockArtifact(object):
@@ -111,6 +118,7 @@ class SerialisationTests(unittest.TestCase):
                          b.needs_artifact_metadata_cached)
 
     def assertEqualSources(self, a, b):
+        self.assertEqual(a.name, b.name)
         self.assertEqual(a.repo, b.repo)
         self.assertEqual(a.repo_name, b.repo_name)
         self.assertEqual(a.original_ref, b.original_ref)
@@ -118,6 +126,7 @@ class SerialisationTests(unittest.TestCase):
         self.assertEqual(a.tree, b.tree)
         self.assertEqualMorphologies(a.morphology, b.morphology)
         self.assertEqual(a.filename, b.filename)
+        self.assertEqual(repr(a.split_rules), repr(b.split_rules))
 
     def assertEqualArtifacts(self, a, b):
         self.assertEqualSources(a.source, b.source)
@@ -172,3 +181,132 @@ class SerialisationTests(unittest.TestCase):
         self.art1.source.dependencies = [self.art2, self.art3]
         self.verify_round_trip(self.art1)
 
+
+    def test_returns_one_line(self):
+        self.art1.source.dependencies = [self.art2]
+        encoded = distbuild.serialise_artifact(self.art1)
+        self.assertFalse('\n' in encoded)
+
+    def test_returns_strings_as_str(self):
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art1))
+        self.assertEqual(type(decoded.name), str)
+        self.assertEqual(type(decoded.source.repo_name), str)
+        self.assertEqual(type(decoded.source.morphology['kind']), str)
+        self.assertEqual(type(decoded.source.cache_id['blip']), str)
+
+    def test_sets_chunk_fields(self):
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art2))
+        self.assertEqual(decoded.source.build_mode, 'staging')
+        self.assertEqual(decoded.source.prefix, '/usr')
+        self.assertEqual(decoded.arch, 'testarch')
+
+    def test_stores_identical_morphologies_once(self):
+        self.art3.source.morphology.dict = self.art2.source.morphology.dict
+        self.art1.source.dependencies = [self.art2, self.art3]
+        encoded = json.loads(distbuild.serialise_artifact(self.art1))
+        self.assertEqual(len(encoded['morphologies']), 2)
+        decoded = distbuild.deserialise_artifact(json.dumps(encoded))
+        dep2, dep3 = decoded.source.dependencies
+        self.assertTrue(dep2.source.morphology is dep3.source.morphology)
+
+    def test_shares_identical_split_rules(self):
+        self.art1.source.dependencies = [self.art2, self.art3]
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art1))
+        rules = [list(a.source.split_rules)[0][1]
+                 for a in decoded.source.dependencies]
+        self.assertTrue(rules[0] is rules[1])
+
+    def test_includes_strata_that_depend_on_dependencies(self):
+        self.art2.dependents = [self.art1.source, self.art3.source]
+        self.art3.source.dependencies = [self.art2]
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art2))
+        self.assertEqual([s.name for s in decoded.dependents], ['name1'])
+        self.assertEqual(decoded.dependents[0].dependencies, [])
+
+    def kids(self, *artifacts):
+        return [{'artifact': a.name, 'cache-key': a.source.cache_key}
+                for a in artifacts]
+
+    def test_rebuilds_kids_of_cache_ids_from_dependencies(self):
+        self.art2.source.dependencies = [self.art4]
+        self.art3.source.dependencies = [self.art4]
+        self.art1.source.dependencies = [self.art2, self.art3]
+        for a in (self.art1, self.art2):
+            a.source.cache_id['kids'] = self.kids(*a.source.dependencies)
+        self.art3.source.cache_id = dict(self.art2.source.cache_id)
+        encoded = json.loads(distbuild.serialise_artifact(self.art1))
+        self.assertFalse([v for v in encoded['values'] if type(v) == list])
+        self.verify_round_trip(self.art1)
+
+    def test_keeps_kids_that_are_not_the_dependencies(self):
+        self.art1.source.dependencies = [self.art2]
+        self.art1.source.cache_id['kids'] = self.kids(self.art3)
+        self.verify_round_trip(self.art1)
+
+    def test_keeps_kids_of_strata_without_their_dependencies(self):
+        self.art1.source.dependencies = [self.art2]
+        self.art1.source.cache_id['kids'] = self.kids(self.art2)
+        self.art2.dependents = [self.art1.source]
+        decoded = distbuild.deserialise_artifact(
+            distbuild.serialise_artifact(self.art2))
+        self.assertEqual(decoded.dependents[0].cache_id,
+                         self.art1.source.cache_id)
+
+    def test_works_without_cache_id_or_tree(self):
+        self.art1.source.cache_id = None
+        self.art1.source.tree = None
+        self.verify_round_trip(self.art1)
+
+    def test_rejects_unknown_format(self):
+        self.assertRaises(ValueError, distbuild.deserialise_artifact,
+                          '{"format": 1000}')
+
+    def test_reads_original_format(self):
+        source = self.art2.source
+        content = {
+            'sources': {
+                1: {
+                    'name': source.name,
+                    'repo': None,
+                    'repo_name': source.repo_name,
+                    'original_ref': source.original_ref,
+                    'sha1': source.sha1,
+                    'tree': source.tree,
+                    'morphology': 3,
+                    'filename': source.filename,
+                    'artifact_ids': [2],
+                    'cache_id': source.cache_id,
+                    'cache_key': source.cache_key,
+                    'dependencies': [],
+                    'build_mode': source.build_mode,
+                    'prefix': source.prefix,
+                },
+            },
+            'artifacts': {
+                2: {
+                    'source_id': 1,
+                    'name': self.art2.name,
+                    'arch': 'testarch',
+                    'dependents': [],
+                },
+            },
+            'morphologies': {3: source.morphology.dict},
+            'root_artifact': 2,
+            'default_split_rules': {
+                'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
+                'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
+            },
+        }
+        decoded = distbuild.deserialise_artifact(
+            json.dumps(yaml.dump(content)))
+        self.assertEqual(decoded.name, self.art2.name)
+        self.assertEqual(decoded.source.cache_key, source.cache_key)
+        self.assertEqual(decoded.source.split_rules.artifacts,
+                         ['name2'] + [
+                             'name2.morphology.name' + suffix
+                             for suffix, patterns in
+                             morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES])
@@ -1,6 +1,6 @@
 # mainloop/sm.py -- state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -50,8 +50,10 @@ class StateMachine(object):
     
     def __init__(self, initial_state):
         self._transitions = {}
+        self._interests = set()
         self.state = self._initial_state = initial_state
         self.debug_transitions = False
+        self.mainloop = None
 
     def setup(self):
         '''Set up machine for execution.
@@ -76,6 +78,9 @@ class StateMachine(object):
         assert key not in self._transitions, \
             'Transition %s already registered' % str(key)
         self._transitions[key] = (new_state, callback)
+        self._interests.add((source, event_class))
+        if self.mainloop is not None:
+            self.mainloop.subscribe(self, source, event_class)
 
     def add_transitions(self, specification):
         '''Add many transitions.
@@ -89,6 +94,16 @@ class StateMachine(object):
         for t in specification:
             self.add_transition(*t)
     
+    def event_interests(self):
+        '''Return the (event source, event class) pairs to be fed.
+
+        These are the pairs that the machine has a transition for, in
+        any state.
+
+        '''
+
+        return set(self._interests)
+
     def handle_event(self, event_source, event):
         '''Handle a given event.
         
@@ -1,6 +1,6 @@
 # distbuild/sm_tests.py -- unit tests for state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -96,3 +96,22 @@ class StateMachineTests(unittest.TestCase):
         self.assertEqual(self.event_sources, [self.event_source])
         self.assertEqual(self.events, [self.event])
 
+    def test_reports_event_interests(self):
+        spec = [
+            ('init', self.event_source, DummyEvent, 'init', None),
+            ('other', self.event_source, DummyEvent, 'init', None),
+            ('init', self.event_source, str, 'init', None),
+        ]
+        self.sm.add_transitions(spec)
+        self.assertEqual(self.sm.event_interests(),
+                         set([(self.event_source, DummyEvent),
+                              (self.event_source, str)]))
+
+    def test_subscribes_to_transitions_added_in_main_loop(self):
+        loop = distbuild.MainLoop()
+        loop.add_state_machine(self.sm)
+        self.sm.add_transition('init', self.event_source, DummyEvent,
+                               'init', self.callback)
+        loop.queue_event(self.event_source, self.event)
+        loop._process_events()
+        self.assertEqual(self.events, [self.event])
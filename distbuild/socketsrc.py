@@ -1,6 +1,6 @@
 # mainloop/socketsrc.py -- events and event sources for sockets
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -23,7 +23,8 @@ import socket
 
 import distbuild
 
-from eventsrc import EventSource
+from eventsrc import FileDescriptorEventSource
+from poller import READ, WRITE
 
 
 def set_nonblocking(handle):
@@ -57,42 +58,36 @@ class NewConnection(object):
         self.addr = addr
         
 
-class ListeningSocketEventSource(EventSource):
+class ListeningSocketEventSource(FileDescriptorEventSource):
 
     '''An event source for a socket that listens for connections.'''
 
     def __init__(self, addr, port):
+        FileDescriptorEventSource.__init__(self)
         self.sock = distbuild.create_socket()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         logging.info('Binding socket to %s', addr)
         self.sock.bind((addr, port))
         self.sock.listen(5)
-        self._accepting = True
+        self.start_accepting()
         logging.info('Listening at %s' % self.sock.remotename())
 
-    def get_select_params(self):
-        r = [self.sock.fileno()] if self._accepting else []
-        return r, [], [], None
-
-    def get_events(self, r, w, x):
-        if self._accepting and self.sock.fileno() in r:
-            try:
-                conn, addr = self.sock.accept()
-            except socket.error, e:
-                return [SocketError(self.sock, e)]
-            else:
-                logging.info(
-                    'New connection to %s from %s' %
-                        (conn.getsockname(), addr))
-                return [NewConnection(conn, addr)]
-            
-        return []
+    def get_poll_events(self, fd, flags):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error, e:
+            return [SocketError(self.sock, e)]
+        else:
+            logging.info(
+                'New connection to %s from %s' %
+                    (conn.getsockname(), addr))
+            return [NewConnection(conn, addr)]
 
     def start_accepting(self):
-        self._accepting = True
+        self.watch(self.sock.fileno(), READ)
         
     def stop_accepting(self):
-        self._accepting = False
+        self.watch(self.sock.fileno(), 0)
 
 
 class SocketReadable(object):
@@ -111,7 +106,7 @@ class SocketWriteable(object):
         self.sock = sock
 
 
-class SocketEventSource(EventSource):
+class SocketEventSource(FileDescriptorEventSource):
 
     '''Event source for normal sockets (for I/O).
     
@@ -127,43 +122,55 @@ class SocketEventSource(EventSource):
     '''
 
     def __init__(self, sock):
+        FileDescriptorEventSource.__init__(self)
         self.sock = sock
         self._reading = True
         self._writing = True
 
         set_nonblocking(sock)
+        self._watch()
 
     def __repr__(self):
         return '<SocketEventSource at %x: socket %s>' % (id(self), self.sock)
 
-    def get_select_params(self):
-        r = [self.sock.fileno()] if self._reading else []
-        w = [self.sock.fileno()] if self._writing else []
-        return r, w, [], None
-
-    def get_events(self, r, w, x):
+    def _watch(self):
+        if self.sock is None:
+            return
+        flags = 0
+        if self._reading:
+            flags |= READ
+        if self._writing:
+            flags |= WRITE
+        self.watch(self.sock.fileno(), flags)
+
+    def get_poll_events(self, fd, flags):
         events = []
-        fd = self.sock.fileno()
 
-        if self._reading and fd in r:
+        if self._reading and flags & READ:
             events.append(SocketReadable(self))
 
-        if self._writing and fd in w:
+        if self._writing and flags & WRITE:
             events.append(SocketWriteable(self))
             
         return events
 
     def start_reading(self):
-        self._reading = True
+        if self.sock is not None:
+            self._reading = True
+            self._watch()
         
     def stop_reading(self):
         self._reading = False
+        self._watch()
 
     def start_writing(self):
-        self._writing = True
+        if self.sock is not None:
+            self._writing = True
+            self._watch()
         
     def stop_writing(self):
         self._writing = False
+        self._watch()
 
     def read(self, max_bytes):
         fd = self.sock.fileno()
@@ -174,11 +181,11 @@ class SocketEventSource(EventSource):
         return os.write(fd, data)
 
     def close(self):
-        self.stop_reading()
-        self.stop_writing()
+        self._reading = False
+        self._writing = False
+        self.unwatch(self.sock.fileno())
         self.sock.close()
         self.sock = None
         
     def is_finished(self):
         return self.sock is None
-
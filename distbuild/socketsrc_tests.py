@@ -0,0 +1,137 @@
+# distbuild/socketsrc_tests.py -- unit tests for socket event sources
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import fcntl
+import os
+import socket
+import unittest
+
+import distbuild
+
+
+class SetNonblockingTests(unittest.TestCase):
+
+    def is_nonblocking(self, fd):
+        return bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+
+    def test_sets_file_descriptor_nonblocking(self):
+        read_fd, write_fd = os.pipe()
+        distbuild.set_nonblocking(read_fd)
+        self.assertTrue(self.is_nonblocking(read_fd))
+        os.close(read_fd)
+        os.close(write_fd)
+
+    def test_sets_socket_nonblocking(self):
+        sock, other = socket.socketpair()
+        distbuild.set_nonblocking(sock)
+        self.assertTrue(self.is_nonblocking(sock.fileno()))
+        sock.close()
+        other.close()
+
+
+class ListeningSocketEventSourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.source = distbuild.ListeningSocketEventSource('127.0.0.1', 0)
+        self.sock = self.source.sock
+        self.poller = distbuild.SelectPoller()
+        self.source.attach(self.poller)
+
+    def tearDown(self):
+        self.source.detach()
+        self.sock.close()
+
+    def test_reports_new_connections(self):
+        client = socket.create_connection(self.sock.getsockname())
+        (source, fd, flags), = self.poller.poll(1)
+        event, = self.source.get_poll_events(fd, flags)
+        self.assertEqual(event.__class__, distbuild.NewConnection)
+        self.assertEqual(event.connection.getpeername(),
+                         client.getsockname())
+        event.connection.close()
+        client.close()
+
+    def test_reports_errors_accepting_connections(self):
+        self.sock.setblocking(False)
+        event, = self.source.get_poll_events(self.sock.fileno(),
+                                             distbuild.READ)
+        self.assertEqual(event.__class__, distbuild.SocketError)
+        self.assertEqual(event.sock, self.sock)
+
+    def test_stops_and_starts_accepting(self):
+        self.source.stop_accepting()
+        self.assertFalse(self.poller.is_watching())
+        self.source.start_accepting()
+        self.assertTrue(self.poller.is_watching())
+
+
+class SocketEventSourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.other = socket.socketpair()
+        self.source = distbuild.SocketEventSource(self.sock)
+        self.poller = distbuild.SelectPoller()
+        self.source.attach(self.poller)
+        self.fd = self.sock.fileno()
+
+    def tearDown(self):
+        if self.source.sock is not None:
+            self.source.close()
+        self.other.close()
+
+    def events(self):
+        return [event.__class__ for event in
+                self.source.get_poll_events(self.fd, distbuild.READ |
+                                            distbuild.WRITE)]
+
+    def test_reports_readable_and_writeable_socket(self):
+        self.assertTrue(repr(self.source).startswith('<SocketEventSource'))
+        self.assertEqual(self.events(),
+                         [distbuild.SocketReadable, distbuild.SocketWriteable])
+
+    def test_stops_reporting_what_it_is_told_to(self):
+        self.source.stop_reading()
+        self.assertEqual(self.events(), [distbuild.SocketWriteable])
+        self.source.stop_writing()
+        self.assertEqual(self.events(), [])
+        self.assertEqual(self.poller.watched_as(self.fd), (self.source, 0))
+        self.source.start_reading()
+        self.source.start_writing()
+        self.assertEqual(self.poller.watched_as(self.fd),
+                         (self.source, distbuild.READ | distbuild.WRITE))
+
+    def test_reads_and_writes(self):
+        self.assertEqual(self.source.write('foo'), 3)
+        self.assertEqual(self.other.recv(3), 'foo')
+        self.other.send('bar')
+        self.assertEqual(self.source.read(3), 'bar')
+
+    def test_closes_socket(self):
+        self.assertFalse(self.source.is_finished())
+        self.source.close()
+        self.assertTrue(self.source.is_finished())
+        self.assertEqual(self.poller.watched_as(self.fd), None)
+
+    def test_ignores_being_told_to_start_or_stop_after_closing(self):
+        self.source.close()
+        self.source.start_reading()
+        self.source.start_writing()
+        self.source.stop_reading()
+        self.source.stop_writing()
+        self.assertEqual(self.poller.watched_as(self.fd), None)
+        self.assertEqual(self.events(), [])
@@ -1,6 +1,6 @@
 # mainloop/stringbuffer.py -- efficient buffering of strings as a queue
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -28,6 +28,8 @@ class StringBuffer(object):
     def __init__(self):
         self.strings = []
         self.len = 0
+        # How many of the first strings are known to have no newline.
+        self._no_newline = 0
         
     def add(self, data):
         '''Add data to buffer.'''
@@ -42,6 +44,7 @@ class StringBuffer(object):
                 num_bytes -= len(first)
                 del self.strings[0]
                 self.len -= len(first)
+                self._no_newline = max(0, self._no_newline - 1)
             else:
                 self.strings[0] = first[num_bytes:]
                 self.len -= num_bytes
@@ -56,6 +59,7 @@ class StringBuffer(object):
             return self.strings[0]
         else:
             self.strings = [''.join(self.strings)]
+            self._no_newline = 0
             return self.strings[0]
 
     def read(self, max_bytes):
@@ -83,7 +87,10 @@ class StringBuffer(object):
     def readline(self):
         '''Return a complete line (ends with '\n') or None.'''
 
-        for i, s in enumerate(self.strings):
+        # A long line arrives in many pieces, so don't look for a newline
+        # in the same pieces again every time one arrives.
+        for i in xrange(self._no_newline, len(self.strings)):
+            s = self.strings[i]
             newline = s.find('\n')
             if newline != -1:
                 if newline+1 == len(s):
@@ -94,7 +101,11 @@ class StringBuffer(object):
                     use = self.strings[:i] + [pre]
                     del self.strings[:i]
                     self.strings[0] = s[newline+1:]
-                return ''.join(use)
+                self._no_newline = 0
+                line = ''.join(use)
+                self.len -= len(line)
+                return line
+        self._no_newline = len(self.strings)
         return None
             
     def __len__(self):
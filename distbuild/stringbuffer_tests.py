@@ -1,6 +1,6 @@
 # distbuild/stringbuffer_tests.py -- unit tests
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -150,3 +150,19 @@ class StringBufferReadlineTests(unittest.TestCase):
         self.assertEqual(self.buf.readline(), 'foo\n')
         self.assertEqual(self.buf.peek(), 'bar')
 
+
+    def test_updates_length(self):
+        self.buf.add('foo\nba')
+        self.buf.add('r')
+        self.buf.readline()
+        self.assertEqual(len(self.buf), 3)
+
+    def test_finds_line_that_arrives_in_pieces(self):
+        self.buf.add('fo')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('o')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('\nbar')
+        self.assertEqual(self.buf.readline(), 'foo\n')
+        self.buf.add('\n')
+        self.assertEqual(self.buf.readline(), 'bar\n')
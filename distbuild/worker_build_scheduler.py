@@ -1,6 +1,6 @@
 # distbuild/worker_build_scheduler.py -- schedule worker-builds on workers
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,19 +18,59 @@
 
 import collections
 import httplib
+import json
 import logging
+import random
 import socket
+import time
 import urllib
 import urlparse
 
 import distbuild
+import morphlib
+
+
+# When choosing which idle worker to give a job to, a worker that already
+# has the git repository of a chunk counts for as much as one that has
+# this many of the artifacts the chunk depends on, since cloning or
+# updating a repository usually takes much longer than fetching one
+# artifact.
+REPO_WEIGHT = 5
+
+# How many jobs a worker does between summaries of its caches. Between
+# them, what it fetched and built for each job is added to the last
+# summary, but what it removed from its caches is not noticed.
+SUMMARY_INTERVAL = 20
+
+
+# How many other workers holding an artifact a worker is told about, to
+# fetch it from instead of the shared artifact cache.
+MAX_PEERS = 3
+
+
+def artifact_summary_key(basename):
+    '''Return the key for an artifact in a summary of a worker's caches.'''
+
+    return 'artifact:%s' % basename
+
+
+def repo_summary_key(cache_name):
+    '''Return the key for a git repository in a summary of worker caches.
+
+    A repository is known by the name of its directory in the git cache,
+    which is its URL quoted by ``morphlib.localrepocache.quote_url``.
+
+    '''
+
+    return 'repo:%s' % cache_name
 
 
 class WorkerBuildRequest(object):
 
-    def __init__(self, artifact, initiator_id):
+    def __init__(self, artifact, initiator_id, priority=0):
         self.artifact = artifact
         self.initiator_id = initiator_id
+        self.priority = priority
 
 class WorkerCancelPending(object):
     
@@ -84,10 +124,20 @@ class WorkerBuildFailed(object):
 
 class _NeedJob(object):
 
+    '''A worker has a free slot.'''
+
     def __init__(self, who):
         self.who = who
         
 
+class _WorkerGone(object):
+
+    '''A worker's connection was closed.'''
+
+    def __init__(self, who):
+        self.who = who
+
+
 class _HaveAJob(object):
 
     def __init__(self, job):
@@ -95,13 +145,22 @@ class _HaveAJob(object):
 
 class Job(object):
 
-    def __init__(self, job_id, artifact, initiator_id):
+    def __init__(self, job_id, artifact, initiator_id, priority=0,
+                 sequence=0):
         self.id = job_id
         self.artifact = artifact
         self.initiators = [initiator_id]
         self.who = None  # we don't know who's going to do this yet
         self.running = False
         self.failed = False
+        self.priority = priority
+        self.sequence = sequence
+        self.started = None
+        # Basenames of the artifacts that are fetched for this job, and
+        # (key, weight) pairs of what a worker holding it locally saves
+        # fetching for it; see WorkerBuildQueuer._locality.
+        self.dependencies = []
+        self.locality = []
 
 
 class Jobs(object):
@@ -109,18 +168,21 @@ class Jobs(object):
     def __init__(self, idgen):
         self._idgen = idgen
         self._jobs = {}
+        self._created = 0
 
     def get(self, artifact_basename):
         return (self._jobs[artifact_basename]
             if artifact_basename in self._jobs else None)
 
-    def create(self, artifact, initiator_id):
-        job = Job(self._idgen.next(), artifact, initiator_id)
+    def create(self, artifact, initiator_id, priority=0):
+        self._created += 1
+        job = Job(self._idgen.next(), artifact, initiator_id, priority,
+                  self._created)
         self._jobs[job.artifact.basename()] = job
         return job
 
     def remove(self, job):
-        if job.artifact.basename() in self._jobs:
+        if self._jobs.get(job.artifact.basename()) is job:
             del self._jobs[job.artifact.basename()]
         else:
             logging.warning("Tried to remove a job that doesn't exist "
@@ -137,11 +199,30 @@ class Jobs(object):
         return artifact_basename in self._jobs
 
     def get_next_job(self):
-        # for now just return the first thing we find that's not being built
-        waiting = [job for (_, job) in
-            self._jobs.iteritems() if job.who == None]
+        '''Return the waiting job that should be built next, or None.
+
+        The job with the highest priority goes first. The priority of a
+        job is how long the rest of the build is expected to take once
+        it starts, so the longest chains of build steps are started
+        first. Of jobs with the same priority, the one for the initiator
+        with the fewest jobs being built goes first, so that initiators
+        share the workers fairly, and then the oldest.
+
+        '''
+
+        building = collections.Counter()
+        waiting = []
+        for job in self._jobs.itervalues():
+            if job.who is None:
+                waiting.append(job)
+            else:
+                building.update(job.initiators)
+
+        def order(job):
+            share = min([building[i] for i in job.initiators] or [0])
+            return -job.priority, share, job.sequence
 
-        return waiting.pop() if len(waiting) > 0 else None
+        return min(waiting, key=order) if waiting else None
 
     def __repr__(self):
         return str([job.artifact.basename()
@@ -168,6 +249,11 @@ class _Cached(object):
     pass
 
 
+class _Summarised(object):
+
+    pass
+
+
 class _JobStarted(object):
 
     def __init__(self, job):
@@ -193,11 +279,18 @@ class WorkerBuildQueuer(distbuild.StateMachine):
     into a queue. It also catches _NeedJob events, from a
     WorkerConnection, and responds to them with _HaveAJob events,
     when it has an outstanding request.
+
+    A job is given to the idle worker whose caches, as summarised by its
+    WorkerConnection, already hold the most of what it needs. If
+    ``repo_resolver`` is given, it is used to tell which git repository
+    the worker needs for a chunk.
     
     '''
     
-    def __init__(self):
+    def __init__(self, build_times=None, repo_resolver=None):
         distbuild.StateMachine.__init__(self, 'idle')
+        self._build_times = build_times or distbuild.BuildTimes()
+        self._repo_resolver = repo_resolver
 
     def setup(self):
         distbuild.crash_point()
@@ -215,6 +308,8 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                 self._handle_cancel),
 
             ('idle', WorkerConnection, _NeedJob, 'idle', self._handle_worker),
+            ('idle', WorkerConnection, _WorkerGone, 'idle',
+                self._forget_worker),
             ('idle', WorkerConnection, _JobStarted, 'idle',
                 self._set_job_started),
             ('idle', WorkerConnection, _JobFinished, 'idle',
@@ -230,6 +325,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                       event.job.artifact.basename(), event.job.id)
 
         event.job.running = True
+        event.job.started = time.time()
 
     def _set_job_finished(self, event_source, event):
         logging.debug('Setting job state for job %s with id %s: '
@@ -238,6 +334,18 @@ class WorkerBuildQueuer(distbuild.StateMachine):
 
         event.job.running = False
 
+        logging.debug('Removing job %s with job id %s',
+                      event.job.artifact.basename(), event.job.id)
+        self._jobs.remove(event.job)
+
+        # Record how long the job took, including sending its artifacts
+        # to the shared cache, to know which jobs to start first next
+        # time.
+        if event.job.started is not None and not event.job.failed:
+            elapsed = time.time() - event.job.started
+            self._build_times.record(event.job.artifact.source, elapsed)
+        event.job.started = None
+
     def _set_job_failed(self, event_source, event):
         logging.debug('Job %s with id %s failed',
                       event.job.artifact.basename(), event.job.id)
@@ -257,6 +365,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         if self._jobs.exists(event.artifact.basename()):
             job = self._jobs.get(event.artifact.basename())
             job.initiators.append(event.initiator_id)
+            job.priority = max(job.priority, event.priority)
 
             if job.running:
                 logging.debug('Worker build step already started: %s' %
@@ -273,7 +382,10 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             self.mainloop.queue_event(WorkerConnection, progress)
         else:
             logging.debug('WBQ: Creating job for: %s' % event.artifact.name)
-            job = self._jobs.create(event.artifact, event.initiator_id)
+            job = self._jobs.create(event.artifact, event.initiator_id,
+                                    event.priority)
+            job.dependencies = self._dependencies(event.artifact)
+            job.locality = self._locality(event.artifact, job.dependencies)
 
             if self._available_workers:
                 self._give_job(job)
@@ -322,18 +434,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
     def _handle_worker(self, event_source, event):
         distbuild.crash_point()
 
-        who = event.who
-        last_job = who.job()  # the job this worker's just completed
-
-        if last_job:
-            logging.debug('%s wants new job, just did %s',
-                          who.name(), last_job.artifact.basename())
-
-            logging.debug('Removing job %s with job id %s',
-                          last_job.artifact.basename(), last_job.id)
-            self._jobs.remove(last_job)
-        else:
-            logging.debug('%s wants its first job', who.name())
+        logging.debug('%s wants a job', event.who.name())
 
         logging.debug('WBQ: Adding worker to queue: %s', event.who.name())
         self._available_workers.append(event)
@@ -346,8 +447,86 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         if job:
             self._give_job(job)
             
+    def _forget_worker(self, event_source, event):
+        '''Stop giving jobs to a worker whose connection was closed.
+
+        Its requests for jobs are dropped, and jobs it was given but had
+        not started are given to other workers.
+
+        '''
+
+        logging.debug('WBQ: Forgetting worker %s', event.who.name())
+        self._available_workers = [worker
+                                   for worker in self._available_workers
+                                   if worker.who is not event.who]
+        for job in self._jobs.get_jobs().values():
+            if job.who is event.who and not job.running:
+                job.who = None
+                if self._available_workers:
+                    self._give_job(job)
+
+    def _dependencies(self, artifact):
+        '''Return the basenames of the artifacts fetched for a job.
+
+        These are the artifacts that ``morph worker-build`` fetches
+        before building the artifact's source.
+
+        '''
+
+        source = artifact.source
+        own = set(source.artifacts.itervalues())
+        seen = set()
+        dependencies = []
+        for a in source.artifacts.itervalues():
+            for dep in a.walk():
+                if dep not in own and dep not in seen:
+                    seen.add(dep)
+                    dependencies.append(dep.basename())
+        return dependencies
+
+    def _locality(self, artifact, dependencies):
+        '''Return what a worker holding locally saves fetching for a job.
+
+        This is a list of (key, weight) pairs, where the keys are those
+        of the summaries of worker caches. They are the dependencies of
+        the job, and the git repository of a chunk.
+
+        '''
+
+        source = artifact.source
+        locality = [(artifact_summary_key(basename), 1)
+                    for basename in dependencies]
+
+        if (self._repo_resolver is not None and
+                source.morphology['kind'] == 'chunk'):
+            url = self._repo_resolver.pull_url(source.repo_name)
+            cache_name = morphlib.localrepocache.quote_url(url)
+            locality.append((repo_summary_key(cache_name), REPO_WEIGHT))
+
+        return locality
+
+    def _pick_worker(self, job):
+        '''Return the index of the idle worker best placed to do a job.
+
+        Workers that have not summarised their caches count as holding
+        nothing. Of equally placed workers, the one that has been idle
+        longest is picked.
+
+        '''
+
+        best, best_score = 0, 0
+        for i, worker in enumerate(self._available_workers):
+            summary = worker.who.cache_summary()
+            if summary is None:
+                continue
+            score = sum(weight for key, weight in job.locality
+                        if key in summary)
+            if score > best_score:
+                best, best_score = i, score
+        return best
+
     def _give_job(self, job):
-        worker = self._available_workers.pop(0)
+        worker = self._available_workers.pop(self._pick_worker(job))
         job.who = worker.who
 
         logging.debug(
@@ -357,35 +536,124 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         self.mainloop.queue_event(worker.who, _HaveAJob(job))
     
     
+class ArtifactLocations(object):
+
+    '''Remember which workers hold which artifacts in their caches.
+
+    Workers are known by the URLs of their artifact cache servers. What a
+    worker has fetched or built for a job is added when the job is done,
+    and what it has since removed from its cache is forgotten when it
+    summarises its caches again.
+
+    '''
+
+    def __init__(self):
+        self._locations = collections.defaultdict(set)
+
+    def add(self, basenames, url):
+        for basename in basenames:
+            self._locations[basename].add(url)
+
+    def retain(self, url, holds):
+        '''Forget the artifacts of a worker for which holds is false.'''
+
+        for basename, urls in self._locations.items():
+            if url in urls and not holds(basename):
+                self._discard(basename, url)
+
+    def remove(self, url):
+        '''Forget all the artifacts of a worker.'''
+
+        self.retain(url, lambda basename: False)
+
+    def peers(self, basenames, exclude=None, max_peers=MAX_PEERS):
+        '''Return which workers hold some artifacts.
+
+        The result maps each basename some worker other than exclude
+        holds to the URLs of up to max_peers of those workers, picked at
+        random to spread the load.
+
+        '''
+
+        peers = {}
+        for basename in basenames:
+            urls = self._locations.get(basename, set()) - set([exclude])
+            if urls:
+                peers[basename] = random.sample(
+                    sorted(urls), min(max_peers, len(urls)))
+        return peers
+
+    def _discard(self, basename, url):
+        urls = self._locations[basename]
+        urls.discard(url)
+        if not urls:
+            del self._locations[basename]
+
+
 class WorkerConnection(distbuild.StateMachine):
 
-    '''Communicate with a single worker.'''
+    '''Communicate with a single worker.
+
+    The worker runs as many jobs at once as it has slots, as it says in
+    its summary when the connection is made, or one if it cannot
+    summarise itself. A slot is free again as soon as the worker has
+    built a job, so that the next job starts while the shared artifact
+    cache fetches the artifacts of the last one. If a later summary
+    says the worker has more slots, jobs are asked for them at once; if
+    fewer, slots are closed as they become free.
+
+    If the worker says in its summary that it can, and the shared
+    artifact cache accepts uploads, the worker instead uploads the
+    artifacts of each job to the shared artifact cache as it builds
+    them, so they are cached when the job has been built. The cache
+    server is asked whether it accepts uploads each time the worker is
+    summarised, since it may have been restarted or upgraded meanwhile.
+
+    Workers are told which other workers hold the artifacts a job needs,
+    so that they fetch them from those instead of all from the shared
+    artifact cache.
+
+    '''
     
     _request_ids = distbuild.IdentifierGenerator('WorkerConnection')
     _initiator_request_map = collections.defaultdict(set)
+    _artifact_locations = ArtifactLocations()
 
     def __init__(self, cm, conn, writeable_cache_server, 
                  worker_cache_server_port, morph_instance):
-        distbuild.StateMachine.__init__(self, 'idle')
+        distbuild.StateMachine.__init__(self, 'summarising')
         self._cm = cm
         self._conn = conn
         self._writeable_cache_server = writeable_cache_server
         self._worker_cache_server_port = worker_cache_server_port
         self._morph_instance = morph_instance
-        self._helper_id = None
-        self._job = None
-        self._exec_response_msg = None
+        self._worker_uploads = False
+        self._server_uploads = False
+        self._probe_id = None
+        self._uploading = set()  # ids of jobs whose artifacts are uploaded
+        self._building = {}  # job id -> job being built
+        self._caching = {}  # helper request id -> job being cached
+        self._exec_response_msgs = {}  # job id -> exec-response message
         self._debug_json = False
+        self._slots = 1
+        self._open_slots = 0  # slots waiting for or building a job
+        self._cache_summary = None
+        self._summary_id = None
+        self._summary_output = []
+        self._summaries_supported = True
+        self._jobs_since_summary = 0
 
         addr, port = self._conn.getpeername()
         name = socket.getfqdn(addr)
         self._worker_name = '%s:%s' % (name, port)
+        self._cache_url = 'http://%s:%d/' % (addr, worker_cache_server_port)
 
     def name(self):
         return self._worker_name
 
-    def job(self):
-        return self._job
+    def cache_summary(self):
+        '''Return a BloomFilter of what the worker has cached, or None.'''
+        return self._cache_summary
 
     def setup(self):
         distbuild.crash_point()
@@ -397,84 +665,104 @@ class WorkerConnection(distbuild.StateMachine):
         
         spec = [
             # state, source, event_class, new_state, callback
-            ('idle', self._jm, distbuild.JsonEof, None,  self._reconnect),
-            ('idle', self, _HaveAJob, 'building', self._start_build),
-            
-            ('building', distbuild.BuildController,
-                distbuild.BuildCancel, 'building',
-                self._maybe_cancel),
+            ('summarising', self._jm, distbuild.JsonEof, None,
+                self._reconnect),
+            ('summarising', self._jm, distbuild.JsonNewMessage,
+                'summarising', self._handle_json_message),
+            ('summarising', self, _Summarised, 'building',
+                self._request_jobs),
+            ('summarising', distbuild.HelperRouter, distbuild.HelperResult,
+                'summarising', self._maybe_handle_helper_result),
 
             ('building', self._jm, distbuild.JsonEof, None, self._reconnect),
+            ('building', self, _Summarised, 'building', self._request_jobs),
             ('building', self._jm, distbuild.JsonNewMessage, 'building',
                 self._handle_json_message),
-            ('building', self, _BuildFailed, 'idle', self._request_job),
-            ('building', self, _BuildCancelled, 'idle', self._request_job),
-            ('building', self, _BuildFinished, 'caching',
-                self._request_caching),
-
-            ('caching', distbuild.HelperRouter, distbuild.HelperResult,
-                'caching', self._maybe_handle_helper_result),
-            ('caching', self, _Cached, 'idle', self._request_job),
-            ('caching', self, _BuildFailed, 'idle', self._request_job),
+            ('building', self, _HaveAJob, 'building', self._start_build),
+            ('building', distbuild.BuildController,
+                distbuild.BuildCancel, 'building',
+                self._maybe_cancel),
+            ('building', distbuild.HelperRouter, distbuild.HelperResult,
+                'building', self._maybe_handle_helper_result),
         ]
         self.add_transitions(spec)
         
-        self._request_job(None, None)
+        self._request_summary()
 
     def _maybe_cancel(self, event_source, build_cancel):
-
-        if build_cancel.id not in self._job.initiators:
-            return  # event not relevant
-
-        logging.debug('WC: BuildController %r requested a cancel',
-                      event_source)
-
-        if (len(self._job.initiators) == 1):
+        for job in self._building.values():
+            if build_cancel.id in job.initiators:
+                logging.debug('WC: BuildController %r requested a cancel',
+                              event_source)
+                self._cancel(job, build_cancel.id)
+
+    def _cancel(self, job, initiator_id):
+        if (len(job.initiators) == 1):
             logging.debug('WC: Cancelling running job %s '
                           'with job id %s running on %s',
-                           self._job.artifact.basename(),
-                           self._job.id,
+                           job.artifact.basename(),
+                           job.id,
                            self.name())
 
-            msg = distbuild.message('exec-cancel', id=self._job.id)
+            msg = distbuild.message('exec-cancel', id=job.id)
             self._jm.send(msg)
-            self.mainloop.queue_event(self, _BuildCancelled())
+
+            # Mark the job as failed, so that how long it ran for is not
+            # taken for how long it takes to build.
+            del self._building[job.id]
+            self._uploading.discard(job.id)
+            self.mainloop.queue_event(WorkerConnection, _JobFailed(job))
+            self.mainloop.queue_event(WorkerConnection, _JobFinished(job))
+            self._free_slot()
         else:
             logging.debug('WC: Not cancelling running job %s with job id %s, '
                           'other initiators want it done: %s',
-                          self._job.artifact.basename(),
-                          self._job.id,
-                          [i for i in self._job.initiators
-                            if i != build_cancel.id])
+                          job.artifact.basename(),
+                          job.id,
+                          [i for i in job.initiators
+                            if i != initiator_id])
 
-        self._job.initiators.remove(build_cancel.id)
+        job.initiators.remove(initiator_id)
 
     def _reconnect(self, event_source, event):
         distbuild.crash_point()
 
         logging.debug('WC: Triggering reconnect')
+        self._artifact_locations.remove(self._cache_url)
+        self.mainloop.queue_event(WorkerConnection, _WorkerGone(self))
         self.mainloop.queue_event(self._cm, distbuild.Reconnect())
 
     def _start_build(self, event_source, event):
         distbuild.crash_point()
 
-        self._job = event.job
-        self._helper_id = None
-        self._exec_response_msg = None
+        job = event.job
+        self._building[job.id] = job
 
         logging.debug('WC: starting build: %s for %s' %
-                      (self._job.artifact.name, self._job.initiators))
+                      (job.artifact.name, job.initiators))
 
         argv = [
             self._morph_instance,
             'worker-build',
             '--build-log-on-stdout',
-            self._job.artifact.name,
+            job.artifact.name,
         ]
+        if self._server_uploads and self._worker_uploads:
+            argv.append('--artifact-upload-server=%s' %
+                        self._writeable_cache_server)
+            self._uploading.add(job.id)
+        stdin_contents = distbuild.serialise_artifact(job.artifact) + '\n'
+        peers = self._artifact_locations.peers(job.dependencies,
+                                               exclude=self._cache_url)
+        if peers:
+            logging.debug('WC: %d of %d dependencies of %s are on other '
+                          'workers', len(peers), len(job.dependencies),
+                          job.artifact.name)
+            stdin_contents += json.dumps({'peers': peers}) + '\n'
         msg = distbuild.message('exec-request',
-            id=self._job.id,
+            id=job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=stdin_contents,
         )
         self._jm.send(msg)
 
@@ -482,10 +770,10 @@ class WorkerConnection(distbuild.StateMachine):
             logging.debug('WC: sent to worker %s: %r'
                 % (self._worker_name, msg))
 
-        started = WorkerBuildStepStarted(self._job.initiators,
-            self._job.artifact.source.cache_key, self.name())
+        started = WorkerBuildStepStarted(job.initiators,
+            job.artifact.source.cache_key, self.name())
 
-        self.mainloop.queue_event(WorkerConnection, _JobStarted(self._job))
+        self.mainloop.queue_event(WorkerConnection, _JobStarted(job))
         self.mainloop.queue_event(WorkerConnection, started)
 
     def _handle_json_message(self, event_source, event):
@@ -496,47 +784,166 @@ class WorkerConnection(distbuild.StateMachine):
         logging.debug(
             'WC: from worker %s: %r' % (self._worker_name, event.msg))
 
+        if event.msg['id'] == self._summary_id:
+            self._handle_summary_message(event.msg)
+            return
+
+        job = self._building.get(event.msg['id'])
+        if job is None:
+            return  # from a cancelled job
+
         handlers = {
             'exec-output': self._handle_exec_output,
             'exec-response': self._handle_exec_response,
         }
         
         handler = handlers[event.msg['type']]
-        handler(event.msg)
+        handler(job, event.msg)
 
-    def _handle_exec_output(self, msg):
+    def _handle_exec_output(self, job, msg):
         new = dict(msg)
-        new['ids'] = self._job.initiators
+        new['ids'] = job.initiators
         logging.debug('WC: emitting: %s', repr(new))
         self.mainloop.queue_event(
             WorkerConnection,
-            WorkerBuildOutput(new, self._job.artifact.source.cache_key))
+            WorkerBuildOutput(new, job.artifact.source.cache_key))
 
-    def _handle_exec_response(self, msg):
-        logging.debug('WC: finished building: %s' % self._job.artifact.name)
+    def _handle_exec_response(self, job, msg):
+        logging.debug('WC: finished building: %s' % job.artifact.name)
         logging.debug('initiators that need to know: %s'
-            % self._job.initiators)
+            % job.initiators)
 
+        del self._building[job.id]
+        uploaded = job.id in self._uploading
+        self._uploading.discard(job.id)
         new = dict(msg)
-        new['ids'] = self._job.initiators
+        new['ids'] = job.initiators
 
         if new['exit'] != 0:
             # Build failed.
             new_event = WorkerBuildFailed(new,
-                                          self._job.artifact.source.cache_key)
+                                          job.artifact.source.cache_key)
             self.mainloop.queue_event(WorkerConnection, new_event)
-            self.mainloop.queue_event(WorkerConnection, _JobFailed(self._job))
-            self.mainloop.queue_event(self, _BuildFailed())
+            self.mainloop.queue_event(WorkerConnection, _JobFailed(job))
+            self.mainloop.queue_event(WorkerConnection, _JobFinished(job))
+        elif uploaded:
+            # Build succeeded, and the worker uploaded the result to the
+            # shared artifact cache as it went.
+            self._job_finished(job, new)
+            self.mainloop.queue_event(WorkerConnection, _JobFinished(job))
         else:
-            # Build succeeded. We have more work to do: caching the result.
-            self.mainloop.queue_event(self, _BuildFinished())
-            self._exec_response_msg = new
+            # Build succeeded. We have more work to do: caching the result,
+            # but the worker can start on another job meanwhile.
+            self._exec_response_msgs[job.id] = new
+            self._request_caching(job)
+
+        self._free_slot()
 
-    def _request_job(self, event_source, event):
+    def _request_jobs(self, event_source, event):
+        '''Ask for a job for each slot that has not been asked for yet.'''
+
+        logging.debug('WC: %s has %d slots', self.name(), self._slots)
+        while self._open_slots < self._slots:
+            self._open_slots += 1
+            self._request_job()
+
+    def _free_slot(self):
+        if self._open_slots > self._slots:
+            logging.debug('WC: %s has fewer slots now', self.name())
+            self._open_slots -= 1
+        else:
+            self._request_job()
+
+    def _request_job(self):
         distbuild.crash_point()
         self.mainloop.queue_event(WorkerConnection, _NeedJob(self))
 
-    def _request_caching(self, event_source, event):
+    def _request_summary(self):
+        '''Ask the worker to summarise itself, if it is time to.
+
+        A worker running a version of morph that cannot summarise itself
+        is not asked again.
+
+        '''
+
+        if self._summary_id is not None:
+            return  # already asked
+
+        if (not self._summaries_supported or
+                (self._cache_summary is not None and
+                 self._jobs_since_summary < SUMMARY_INTERVAL)):
+            self.mainloop.queue_event(self, _Summarised())
+            return
+
+        logging.debug('WC: asking %s to summarise itself', self.name())
+        self._summary_id = self._request_ids.next()
+        self._summary_output = []
+        msg = distbuild.message('exec-request',
+            id=self._summary_id,
+            argv=[self._morph_instance, 'worker-cache-summary'],
+            stdin_contents='',
+        )
+        self._jm.send(msg)
+        self._probe_uploads()
+
+    def _probe_uploads(self):
+        '''Ask the shared artifact cache if it accepts uploads.
+
+        Older cache servers, and those not started with --enable-writes,
+        do not, and fetch what the workers build instead.
+
+        '''
+
+        url = urlparse.urljoin(self._writeable_cache_server,
+                               '/1.0/uploads?filename=probe')
+        msg = distbuild.message(
+            'http-request', id=self._request_ids.next(), url=url,
+            method='GET', body=None, headers=None)
+        self._probe_id = msg['id']
+        self.mainloop.queue_event(distbuild.HelperRouter,
+                                  distbuild.HelperRequest(msg))
+
+    def _handle_summary_message(self, msg):
+        if msg['type'] == 'exec-output':
+            self._summary_output.append(msg['stdout'])
+            return
+
+        if msg['exit'] == 0:
+            # The summary is the last line of output, after any status
+            # messages.
+            lines = ''.join(self._summary_output).strip().splitlines()
+            try:
+                summary = json.loads(lines[-1] if lines else '')
+                if 'caches' not in summary:
+                    # From a worker that only summarises its caches.
+                    summary = {'caches': summary}
+                cache_summary = distbuild.BloomFilter.decode(
+                    summary['caches'])
+                slots = int(summary.get('slots', 1))
+                uploads = bool(summary.get('uploads', False))
+            except (ValueError, KeyError, TypeError), e:
+                logging.warning('WC: ignoring summary from %s: %s',
+                                self.name(), e)
+            else:
+                self._cache_summary = cache_summary
+                self._artifact_locations.retain(
+                    self._cache_url,
+                    lambda basename:
+                        artifact_summary_key(basename) in cache_summary)
+                self._slots = max(1, slots)
+                self._worker_uploads = uploads
+                self._jobs_since_summary = 0
+        else:
+            logging.info('WC: %s cannot summarise itself, so it is given '
+                         'jobs regardless of its slots and caches',
+                         self.name())
+            self._summaries_supported = False
+
+        self._summary_id = None
+        self._summary_output = []
+        self.mainloop.queue_event(self, _Summarised())
+
+    def _request_caching(self, job):
         # This code should be moved into the morphlib.remoteartifactcache
         # module. It would be good to share it with morphlib.buildcommand,
         # which also wants to fetch artifacts from a remote cache.
@@ -544,15 +951,15 @@ class WorkerConnection(distbuild.StateMachine):
 
         logging.debug('Requesting shared artifact cache to get artifacts')
 
-        kind = self._job.artifact.source.morphology['kind']
+        kind = job.artifact.source.morphology['kind']
 
         if kind == 'chunk':
-            source_artifacts = self._job.artifact.source.artifacts
+            source_artifacts = job.artifact.source.artifacts
 
             suffixes = ['%s.%s' % (kind, name) for name in source_artifacts]
             suffixes.append('build-log')
         else:
-            filename = '%s.%s' % (kind, self._job.artifact.name)
+            filename = '%s.%s' % (kind, job.artifact.name)
             suffixes = [filename]
 
             if kind == 'stratum':
@@ -568,52 +975,77 @@ class WorkerConnection(distbuild.StateMachine):
             '/1.0/fetch?host=%s:%d&cacheid=%s&artifacts=%s' %
                 (urllib.quote(worker_host),
                  self._worker_cache_server_port,
-                 urllib.quote(self._job.artifact.source.cache_key),
+                 urllib.quote(job.artifact.source.cache_key),
                  suffixes))
 
         msg = distbuild.message(
             'http-request', id=self._request_ids.next(), url=url,
             method='GET', body=None, headers=None)
-        self._helper_id = msg['id']
+        self._caching[msg['id']] = job
         req = distbuild.HelperRequest(msg)
         self.mainloop.queue_event(distbuild.HelperRouter, req)
         
-        progress = WorkerBuildCaching(self._job.initiators,
-            self._job.artifact.source.cache_key)
+        progress = WorkerBuildCaching(job.initiators,
+            job.artifact.source.cache_key)
         self.mainloop.queue_event(WorkerConnection, progress)
 
     def _maybe_handle_helper_result(self, event_source, event):
-        if event.msg['id'] == self._helper_id:
-            distbuild.crash_point()
-
-            logging.debug('caching: event.msg: %s' % repr(event.msg))
-            if event.msg['status'] == httplib.OK:
-                logging.debug('Shared artifact cache population done')
-
-                new_event = WorkerBuildFinished(
-                    self._exec_response_msg,
-                    self._job.artifact.source.cache_key)
-                self.mainloop.queue_event(WorkerConnection, new_event)
-                self.mainloop.queue_event(self, _Cached())
-            else:
-                logging.error(
-                    'Failed to populate artifact cache: %s %s' %
-                        (event.msg['status'], event.msg['body']))
-
-                # We will attempt to remove this job twice
-                # unless we mark it as failed before the BuildController
-                # processes the WorkerBuildFailed event.
-                #
-                # The BuildController will not try to cancel jobs that have
-                # been marked as failed.
-                self.mainloop.queue_event(WorkerConnection,
-                                          _JobFailed(self._job))
-
-                new_event = WorkerBuildFailed(
-                    self._exec_response_msg,
-                    self._job.artifact.source.cache_key)
-                self.mainloop.queue_event(WorkerConnection, new_event)
-
-                self.mainloop.queue_event(self, _BuildFailed())
-
-        self.mainloop.queue_event(WorkerConnection, _JobFinished(self._job))
+        if event.msg['id'] == self._probe_id:
+            self._probe_id = None
+            self._server_uploads = event.msg['status'] == httplib.OK
+            logging.debug('WC: %s accepts uploads: %s',
+                          self._writeable_cache_server, self._server_uploads)
+            return
+
+        job = self._caching.pop(event.msg['id'], None)
+        if job is None:
+            return  # not for us
+
+        distbuild.crash_point()
+
+        exec_response_msg = self._exec_response_msgs.pop(job.id)
+
+        logging.debug('caching: event.msg: %s' % repr(event.msg))
+        if event.msg['status'] == httplib.OK:
+            logging.debug('Shared artifact cache population done')
+            self._job_finished(job, exec_response_msg)
+        else:
+            logging.error(
+                'Failed to populate artifact cache: %s %s' %
+                    (event.msg['status'], event.msg['body']))
+
+            # We will attempt to remove this job twice
+            # unless we mark it as failed before the BuildController
+            # processes the WorkerBuildFailed event.
+            #
+            # The BuildController will not try to cancel jobs that have
+            # been marked as failed.
+            self.mainloop.queue_event(WorkerConnection, _JobFailed(job))
+
+            new_event = WorkerBuildFailed(
+                exec_response_msg, job.artifact.source.cache_key)
+            self.mainloop.queue_event(WorkerConnection, new_event)
+
+        self.mainloop.queue_event(WorkerConnection, _JobFinished(job))
+
+    def _job_finished(self, job, exec_response_msg):
+        new_event = WorkerBuildFinished(
+            exec_response_msg, job.artifact.source.cache_key)
+        self.mainloop.queue_event(WorkerConnection, new_event)
+        self._job_cached(job)
+
+    def _job_cached(self, job):
+        # The worker now has what it fetched for the job, and what it
+        # built, even if it has not been summarised since.
+        built = [artifact.basename()
+                 for artifact in job.artifact.source.artifacts.itervalues()]
+        self._artifact_locations.add(job.dependencies + built,
+                                     self._cache_url)
+        if self._cache_summary is not None:
+            for key, weight in job.locality:
+                self._cache_summary.add(key)
+            for artifact in job.artifact.source.artifacts.itervalues():
+                self._cache_summary.add(
+                    artifact_summary_key(artifact.basename()))
+        self._jobs_since_summary += 1
+        self._request_summary()
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -33,6 +33,7 @@ else:
 import cliapp
 
 import gitversion
+import graphcache
 
 __version__ = gitversion.version
 
@@ -55,24 +56,31 @@ import bins
 import buildbranch
 import buildcommand
 import buildenvironment
+import buildscheduler
 import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import chunkcache
 import extensions
 import extractedtarball
 import fsutils
 import git
+import gitbatch
 import gitdir
 import gitindex
+import httppool
+import jobserver
 import localartifactcache
 import localrepocache
 import mountableimage
+import morphologycache
 import morphologyfactory
 import morphologyfinder
 import morphology
 import morphloader
 import morphset
+import peerartifactcache
 import remoteartifactcache
 import remoterepocache
 import repoaliasresolver
@@ -81,6 +89,7 @@ import source
 import sourcepool
 import sourceresolver
 import stagingarea
+import stagingareacache
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
@@ -91,4 +100,7 @@ import yamlparse
 
 import writeexts
 
+# These subclass classes from the modules above.
+import artifactuploader
+
 import app  # this needs to be last
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,6 +19,7 @@ import logging
 import os
 import pipes
 import sys
+import threading
 import time
 import urlparse
 import extensions
@@ -83,6 +84,10 @@ class Morph(cliapp.Application):
                               'do not update the cached git repositories '
                               'automatically',
                               group=group_advanced)
+        self.settings.boolean(['no-graph-cache'],
+                              'do not reuse build graphs resolved by earlier '
+                              'runs of morph for the same definitions',
+                              group=group_advanced)
         self.settings.boolean(['build-log-on-stdout'],
                               'write build log on stdout',
                               group=group_advanced)
@@ -130,6 +135,35 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['build-slots'],
+                              'build up to N independent sources at the '
+                              'same time, each in its own staging area '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
+        self.settings.integer(['prefetch-threads'],
+                              'fetch artifacts from the remote artifact '
+                              'cache with N threads in the background while '
+                              'building; 0 fetches each one only when it is '
+                              'needed (default: %default)',
+                              metavar='N',
+                              default=4,
+                              group=group_build)
+        self.settings.integer(['staging-area-snapshots'],
+                              'keep up to N staging areas with the build '
+                              'dependencies of chunks installed, to build '
+                              'chunks with the same dependencies in again; '
+                              '0 builds each chunk in a new staging area '
+                              '(default: %default)',
+                              metavar='N',
+                              default=4,
+                              group=group_build)
+        self.settings.boolean(['no-jobserver'],
+                              'do not share make jobs between builds '
+                              'running at the same time on this machine; '
+                              'each build runs up to max-jobs jobs instead',
+                              group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
@@ -148,6 +182,15 @@ class Morph(cliapp.Application):
                               '`ignore` setting.',
                               group=group_build)
 
+        self.settings.choice(['source-extraction'],
+                             ['copy', 'tree'],
+                             'how to get the sources of chunks to build: '
+                             '`copy` copies the cached git repository and '
+                             'checks out the commit; `tree` writes only the '
+                             'files of the commit, which is faster, but '
+                             'leaves no git repository for the build to use',
+                             group=group_build)
+
         group_storage = 'Storage Options'
         self.settings.string(['tempdir'],
                              'temporary directory to use for builds '
@@ -191,6 +234,15 @@ class Morph(cliapp.Application):
         # estimate size needed for the git cache, and it tends to not grow
         # too quickly once everything is checked out.
         # ccache is self-managing so does not need much extra attention
+        # Unpacked chunks are kept in tempdir to install them into staging
+        # areas. The default is enough for the chunks of a large system.
+        self.settings.bytesize(['chunk-cache-size'],
+                               'keep unpacked chunks in tempdir up to SIZE '
+                               'bytes, removing those used longest ago '
+                               'first; 0 keeps them all (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='2G')
         self.settings.bytesize(['cachedir-min-space'],
                                'Immediately fail to build if the directory '
                                'specified by cachedir has less space '
@@ -206,6 +258,9 @@ class Morph(cliapp.Application):
                 'System time is far in the past, please set your system clock')
 
     def setup(self):
+        self._main_thread = threading.current_thread()
+        self._status_lock = threading.Lock()
+        self._status_prefixes = threading.local()
         self.status_prefix = ''
 
         self.add_subcommand('help-extensions', self.help_extensions)
@@ -265,6 +320,7 @@ class Morph(cliapp.Application):
         tmpdir = self.settings['tempdir']
         for required_dir in (os.path.join(tmpdir, 'chunks'),
                              os.path.join(tmpdir, 'staging'),
+                             os.path.join(tmpdir, 'snapshots'),
                              os.path.join(tmpdir, 'failed'),
                              os.path.join(tmpdir, 'deployments'),
                              self.settings['cachedir']):
@@ -308,7 +364,8 @@ class Morph(cliapp.Application):
 
             try:
                 submodules = morphlib.git.Submodules(self, cached_repo.path,
-                                                     ref)
+                                                     ref,
+                                                     cached_repo=cached_repo)
                 submodules.load()
             except morphlib.git.NoModulesFileError:
                 pass
@@ -317,10 +374,30 @@ class Morph(cliapp.Application):
                     if (submod.url, submod.commit) not in done:
                         subs_to_process.add((submod.url, submod.commit))
 
+    @property
+    def status_prefix(self):
+        '''Prefix for status messages from the current thread.
+
+        Concurrent builds each run in their own thread, so each of them can
+        label its own messages. Threads that have not set a prefix of their
+        own use the one set by the main thread.
+
+        '''
+        return getattr(self._status_prefixes, 'prefix',
+                       self._main_status_prefix)
+
+    @status_prefix.setter
+    def status_prefix(self, prefix):
+        if threading.current_thread() is self._main_thread:
+            self._main_status_prefix = prefix
+        else:
+            self._status_prefixes.prefix = prefix
+
     def _write_status(self, text):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-        self.output.write('%s %s\n' % (timestamp, text))
-        self.output.flush()
+        with self._status_lock:
+            self.output.write('%s %s\n' % (timestamp, text))
+            self.output.flush()
 
     def status(self, **kwargs):
         '''Show user a status update.
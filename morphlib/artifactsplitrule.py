@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -35,6 +35,10 @@ class Rule(object):
     def match(self, *args):
         return True
 
+    def encode(self):
+        '''Return the rule as plain data, for ``decode_rule``.'''
+        return [type(self).__name__, []]
+
 
 class FileMatch(Rule):
     '''Match a file path against a list of regular expressions.
@@ -51,6 +55,9 @@ class FileMatch(Rule):
     def match(self, path):
         return any(r.match(path) for r in self._regexes)
 
+    def encode(self):
+        return ['FileMatch', [[r.pattern for r in self._regexes]]]
+
     def __repr__(self):
         return 'FileMatch(%s)' % '|'.join(r.pattern for r in self._regexes)
 
@@ -66,6 +73,9 @@ class ArtifactMatch(Rule):
     def match(self, (source_name, artifact_name)):
         return any(r.match(artifact_name) for r in self._regexes)
 
+    def encode(self):
+        return ['ArtifactMatch', [[r.pattern for r in self._regexes]]]
+
     def __repr__(self):
         return 'ArtifactMatch(%s)' % '|'.join(r.pattern for r in self._regexes)
 
@@ -86,6 +96,9 @@ class ArtifactAssign(Rule):
     def match(self, (source_name, artifact_name)):
         return (source_name, artifact_name) == self._key
 
+    def encode(self):
+        return ['ArtifactAssign', list(self._key)]
+
     def __repr__(self):
         return 'ArtifactAssign(%s, %s)' % self._key
 
@@ -105,6 +118,9 @@ class SourceAssign(Rule):
     def match(self, (source_name, artifact_name)):
         return source_name == self._source
 
+    def encode(self):
+        return ['SourceAssign', [self._source]]
+
     def __repr__(self):
         return 'SourceAssign(%s, *)' % self._source
 
@@ -190,6 +206,17 @@ class SplitRules(collections.Iterable):
             for artifact, rule in  self._rules)
 
 
+_rule_classes = dict((cls.__name__, cls) for cls in (
+    Rule, FileMatch, ArtifactMatch, ArtifactAssign, SourceAssign))
+
+
+def decode_rule(encoded):
+    '''Re-create a rule from what its ``encode`` method returned.'''
+
+    kind, args = encoded
+    return _rule_classes[kind](*args)
+
+
 # TODO: Work out a good way to feed new defaults in. This is good for
 #       the usual Linux userspace, but we may find issues and need a
 #       migration path to a more useful set, or develop a system with
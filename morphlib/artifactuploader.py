@@ -0,0 +1,252 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import httplib
+import json
+import logging
+import os
+import Queue
+import socket
+import threading
+import urllib
+import urlparse
+
+import morphlib
+
+
+class UploadError(cliapp.AppException):
+
+    def __init__(self, server_url, filenames):
+        cliapp.AppException.__init__(
+            self, 'Failed to upload %s to the artifact cache %s' %
+                  (', '.join(sorted(filenames)), server_url))
+
+
+class ArtifactUploader(object):
+
+    '''Upload files to the artifact cache server in the background.
+
+    Files are uploaded by up to ``max_uploads`` threads at once, as soon
+    as they are passed to ``upload``. Each upload is started with a
+    request that gives it an id of its own on the server, so that it
+    never mixes with other uploads of the same file. An upload that
+    fails part way is resumed from as much of the file as the server
+    got, up to ``retries`` times. ``wait`` waits for every upload to
+    finish.
+
+    The server makes an uploaded artifact available only once it has
+    all of it, so a failed upload never leaves a partial artifact in
+    the cache.
+
+    '''
+
+    def __init__(self, server_url, max_uploads=4, retries=3):
+        self.server_url = server_url
+        self.max_uploads = max_uploads
+        self.retries = retries
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._failed = []
+
+    def upload(self, filename):
+        '''Start uploading a file, named by its basename on the server.'''
+
+        logging.debug('Queueing %s for upload to %s' %
+                      (filename, self.server_url))
+        self._queue.put(filename)
+        if len(self._threads) < self.max_uploads:
+            thread = threading.Thread(target=self._run,
+                                      name='upload-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def wait(self):
+        '''Wait for all uploads to finish.
+
+        Raise UploadError if any of the files could not be uploaded.
+
+        '''
+
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._failed:
+            failed, self._failed = self._failed, []
+            raise UploadError(self.server_url, failed)
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                return
+            try:
+                uploaded = self._upload_file(filename)
+            except Exception, e:
+                logging.warning('Uploading %s failed: %s' % (filename, e))
+                uploaded = False
+            if not uploaded:
+                self._failed.append(os.path.basename(filename))
+
+    def _upload_file(self, filename):
+        basename = os.path.basename(filename)
+        size = os.path.getsize(filename)
+        upload = None
+        for attempt in xrange(self.retries + 1):
+            try:
+                if upload is None:
+                    upload, complete = self._start_upload(basename)
+                    offset = 0
+                else:
+                    offset, complete = self._uploaded_size(basename, upload)
+                if complete:
+                    return True
+                with open(filename, 'rb') as f:
+                    f.seek(offset)
+                    status, data = self._request(
+                        'PUT', self._upload_path(basename, upload, offset,
+                                                 size),
+                        f, {'Content-Length': str(size - offset)})
+                if status == httplib.OK and json.loads(data)['complete']:
+                    logging.debug('Uploaded %s to %s' %
+                                  (basename, self.server_url))
+                    return True
+                if status == httplib.NOT_FOUND:
+                    upload = None  # the server dropped it, so start again
+                error = 'HTTP status %d' % status
+            except (socket.error, httplib.HTTPException,
+                    ValueError, KeyError), e:
+                error = str(e)
+            logging.warning('Uploading %s to %s failed at attempt %d: %s' %
+                            (basename, self.server_url, attempt + 1, error))
+        return False
+
+    def _start_upload(self, basename):
+        '''Start an upload of a file, and return its id, and if it is done.
+
+        The server is done if it already has all of the file, from an
+        earlier upload.
+
+        '''
+
+        status, data = self._request(
+            'POST', '/1.0/uploads?filename=%s' % urllib.quote(basename))
+        if status != httplib.OK:
+            raise httplib.HTTPException('HTTP status %d' % status)
+        result = json.loads(data)
+        return result['upload'], bool(result['complete'])
+
+    def _uploaded_size(self, basename, upload):
+        '''Return how much of a file the server has, and if it is all.'''
+
+        try:
+            status, data = self._request(
+                'GET', '/1.0/uploads?filename=%s&upload=%s' %
+                       (urllib.quote(basename), urllib.quote(upload)))
+            if status == httplib.OK:
+                result = json.loads(data)
+                return int(result['size']), bool(result['complete'])
+        except (socket.error, httplib.HTTPException,
+                ValueError, KeyError, TypeError), e:
+            logging.debug('Asking %s about %s failed: %s' %
+                          (self.server_url, basename, e))
+        # Start again from the beginning, which the server always accepts.
+        return 0, False
+
+    def _upload_path(self, basename, upload, offset, size):
+        return '/1.0/uploads?filename=%s&upload=%s&offset=%d&size=%d' % (
+            urllib.quote(basename), urllib.quote(upload), offset, size)
+
+    def _request(self, method, path, body=None,
+                 headers=None):  # pragma: no cover
+        # Each upload uses a connection of its own, so that a retried
+        # request never resends a body that was partly read already.
+        url = urlparse.urljoin(self.server_url, path)
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        conn = httplib.HTTPConnection(netloc)
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+class UploadingSaveFile(morphlib.savefile.SaveFile):
+
+    '''A SaveFile that is passed to a function once it is saved.
+
+    The function, usually the upload method of an ArtifactUploader,
+    is called with the name of the saved file.
+
+    '''
+
+    def __init__(self, filename, upload, *args, **kwargs):
+        morphlib.savefile.SaveFile.__init__(self, filename, *args, **kwargs)
+        self.upload = upload
+
+    def close(self):
+        ret = morphlib.savefile.SaveFile.close(self)
+        self.upload(self.real_filename)
+        return ret
+
+
+class UploadingArtifactCache(morphlib.localartifactcache.LocalArtifactCache):
+
+    '''A local artifact cache that uploads what is built into it.
+
+    Every file put in the cache for the given cache key is uploaded by
+    the uploader as soon as it is saved. Files for other cache keys,
+    such as dependencies fetched from the shared cache, are not.
+
+    The source's own metadata file, which the builder writes last, is
+    held back until finish is called once the build has succeeded, so
+    the shared cache only lists builds which finished. A failed build
+    may still leave some of its artifacts there, but each is complete
+    and correct for its cache key, and a build which lacks any of its
+    artifacts is run again.
+
+    '''
+
+    def __init__(self, cachefs, uploader, cache_key):
+        morphlib.localartifactcache.LocalArtifactCache.__init__(
+            self, cachefs)
+        self.uploader = uploader
+        self.cache_key = cache_key
+        self.held_back = []
+
+    def _save_file(self, filename):
+        basename = os.path.basename(filename)
+        if basename == '%s.meta' % self.cache_key:
+            return UploadingSaveFile(filename, self.held_back.append,
+                                     mode='w')
+        if basename.startswith(self.cache_key):
+            return UploadingSaveFile(filename, self.uploader.upload,
+                                     mode='w')
+        return morphlib.localartifactcache.LocalArtifactCache._save_file(
+            self, filename)
+
+    def finish(self):
+        '''Upload the files held back until the build succeeded.'''
+
+        for filename in self.held_back:
+            self.uploader.upload(filename)
+        self.held_back = []
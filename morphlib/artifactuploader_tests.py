@@ -0,0 +1,229 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import urlparse
+
+import fs.osfs
+
+import morphlib
+
+
+class FakeUploader(morphlib.artifactuploader.ArtifactUploader):
+
+    '''An uploader to a fake server, which keeps what it gets in memory.
+
+    As on the real server, each upload is kept apart by its id. The
+    first ``failures`` PUT requests get half of what they send through
+    before the connection breaks. Requests are answered with what is in
+    ``responses`` for their method first, if anything.
+
+    '''
+
+    def __init__(self, failures=0, **kwargs):
+        morphlib.artifactuploader.ArtifactUploader.__init__(
+            self, 'http://cache.example.com:8080/', **kwargs)
+        self.failures = failures
+        self.responses = {}
+        self.partial = {}
+        self.complete = {}
+        self.puts = []
+        self.uploads = 0
+
+    def _request(self, method, path, body=None, headers=None):
+        path, query = path.split('?', 1)
+        assert path == '/1.0/uploads'
+        if self.responses.get(method):
+            return self.responses[method].pop(0)
+        query = dict(urlparse.parse_qsl(query))
+        name = query['filename']
+        if method == 'POST':
+            self.uploads += 1
+            upload = 'u%d' % self.uploads
+            self.partial[upload] = ''
+            return 200, json.dumps({
+                'upload': upload,
+                'size': 0,
+                'complete': name in self.complete,
+            })
+
+        upload = query['upload']
+        if method == 'GET':
+            return 200, json.dumps({
+                'size': len(self.partial.get(upload, '')),
+                'complete': name in self.complete,
+            })
+
+        offset = int(query['offset'])
+        self.puts.append((name, offset))
+        if upload not in self.partial:
+            return 404, '{}'
+        data = body.read(int(headers['Content-Length']))
+        if self.failures > 0:
+            self.failures -= 1
+            self.partial[upload] += data[:len(data) / 2]
+            raise socket.error('connection reset')
+        if offset != len(self.partial[upload]) and offset != 0:
+            return 409, '{}'
+        content = self.partial[upload][:offset] + data
+        self.partial[upload] = content
+        if len(content) >= int(query['size']):
+            self.complete[name] = self.partial.pop(upload)
+        return 200, json.dumps({'size': len(content),
+                                'complete': name in self.complete})
+
+
+class ArtifactUploaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_file(self, name, contents):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def test_uploads_files(self):
+        uploader = FakeUploader()
+        uploader.upload(self.make_file('foo', 'foo contents'))
+        uploader.upload(self.make_file('bar', ''))
+        uploader.wait()
+        self.assertEqual(uploader.complete,
+                         {'foo': 'foo contents', 'bar': ''})
+
+    def test_resumes_failed_upload(self):
+        uploader = FakeUploader(failures=2)
+        uploader.upload(self.make_file('foo', 'x' * 1000))
+        uploader.wait()
+        self.assertEqual(uploader.complete, {'foo': 'x' * 1000})
+        self.assertEqual(uploader.puts,
+                         [('foo', 0), ('foo', 500), ('foo', 750)])
+
+    def test_starts_again_when_status_of_upload_is_unknown(self):
+        uploader = FakeUploader(failures=2)
+        uploader.responses['GET'] = [(500, ''), (200, 'garbage')]
+        uploader.upload(self.make_file('foo', 'x' * 1000))
+        uploader.wait()
+        self.assertEqual(uploader.complete, {'foo': 'x' * 1000})
+        self.assertEqual(uploader.puts,
+                         [('foo', 0), ('foo', 0), ('foo', 0)])
+
+    def test_starts_new_upload_when_server_drops_upload(self):
+        uploader = FakeUploader()
+        uploader.responses['PUT'] = [(404, '{}')]
+        uploader.upload(self.make_file('foo', 'x' * 1000))
+        uploader.wait()
+        self.assertEqual(uploader.complete, {'foo': 'x' * 1000})
+        self.assertEqual(uploader.uploads, 2)
+
+    def test_retries_starting_upload(self):
+        uploader = FakeUploader()
+        uploader.responses['POST'] = [(500, '')]
+        uploader.upload(self.make_file('foo', 'foo contents'))
+        uploader.wait()
+        self.assertEqual(uploader.complete, {'foo': 'foo contents'})
+        self.assertEqual(uploader.uploads, 1)
+
+    def test_does_not_upload_what_server_has_already(self):
+        uploader = FakeUploader()
+        uploader.complete['foo'] = 'foo contents'
+        uploader.upload(self.make_file('foo', 'foo contents'))
+        uploader.wait()
+        self.assertEqual(uploader.puts, [])
+
+    def test_raises_error_when_retries_run_out(self):
+        uploader = FakeUploader(failures=3, retries=2)
+        uploader.upload(self.make_file('foo', 'foo contents'))
+        self.assertRaises(morphlib.artifactuploader.UploadError,
+                          uploader.wait)
+        self.assertEqual(uploader.complete, {})
+
+    def test_raises_error_when_file_is_missing(self):
+        uploader = FakeUploader()
+        uploader.upload(os.path.join(self.tempdir, 'missing'))
+        self.assertRaises(morphlib.artifactuploader.UploadError,
+                          uploader.wait)
+
+
+class FakeArtifact(object):
+
+    def __init__(self, basename):
+        self._basename = basename
+
+    def basename(self):
+        return self._basename
+
+
+class UploadingArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.uploader = FakeUploader()
+        self.cache = morphlib.artifactuploader.UploadingArtifactCache(
+            fs.osfs.OSFS(self.tempdir), self.uploader, '0' * 64)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_uploads_files_for_its_cache_key_when_saved(self):
+        f = self.cache.put_source_metadata(None, '0' * 64, 'build-log')
+        f.write('log')
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete, {})
+        f.close()
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete,
+                         {'%s.build-log' % ('0' * 64): 'log'})
+
+    def test_does_not_upload_files_for_other_cache_keys(self):
+        with self.cache.put_source_metadata(None, '1' * 64, 'meta') as f:
+            f.write('meta')
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete, {})
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tempdir, '%s.meta' % ('1' * 64))))
+
+    def test_holds_back_metadata_of_its_source_until_finished(self):
+        with self.cache.put_source_metadata(None, '0' * 64, 'meta') as f:
+            f.write('meta')
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete, {})
+        self.cache.finish()
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete,
+                         {'%s.meta' % ('0' * 64): 'meta'})
+
+    def test_uploads_artifacts_but_not_metadata_of_failed_build(self):
+        artifact = FakeArtifact('%s.chunk.foo' % ('0' * 64))
+        with self.cache.put(artifact) as f:
+            f.write('artifact')
+        with self.cache.put_source_metadata(None, '0' * 64, 'meta') as f:
+            f.write('meta')
+        # The build fails here, so finish is never called.
+        self.uploader.wait()
+        self.assertEqual(self.uploader.complete,
+                         {artifact.basename(): 'artifact'})
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tempdir, '%s.meta' % ('0' * 64))))
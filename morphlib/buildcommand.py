@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,9 +16,11 @@
 
 import itertools
 import os
+import Queue
 import shutil
 import logging
 import tempfile
+import threading
 import datetime
 
 import morphlib
@@ -33,6 +35,58 @@ class MultipleRootArtifactsError(morphlib.Error):
         self.artifacts = artifacts
 
 
+class ArtifactPrefetcher(object):
+
+    '''Fetch artifacts from the remote artifact cache in the background.
+
+    Artifacts are fetched in the given order by a pool of threads, so that
+    artifacts which are needed first should be listed first. Builds that
+    need an artifact which is still being fetched wait for that fetch to
+    finish, rather than starting a second one.
+
+    Failing to fetch an artifact is not an error here: the build fetches
+    or builds it again once it gets to it.
+
+    '''
+
+    def __init__(self, build_command, artifacts, threads):
+        self.build_command = build_command
+        self.app = build_command.app
+        self.queue = Queue.Queue()
+        for artifact in artifacts:
+            self.queue.put(artifact)
+        self.threads = [threading.Thread(target=self._run,
+                                         name='prefetch-%d' % i)
+                        for i in xrange(threads)]
+        self._stopped = False
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        '''Stop fetching, once the fetches in progress are done.'''
+
+        self._stopped = True
+
+    def _run(self):
+        self.app.status_prefix = '[Prefetch] '
+        while not self._stopped:
+            try:
+                artifact = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.build_command.prefetch_artifact(artifact)
+            except morphlib.remoteartifactcache.GetError:
+                # Error is logged by the RemoteArtifactCache object.
+                pass
+            except Exception, e:
+                logging.warning('Prefetching %s failed: %s' %
+                                (artifact.basename(), e))
+
+
 class BuildCommand(object):
 
     '''High level logic for building.
@@ -49,6 +103,19 @@ class BuildCommand(object):
         self.app = app
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
+        self.morphology_cache = morphlib.util.new_morphology_cache(
+            app.settings)
+
+        # Held while updating the local git cache, which is shared between
+        # concurrent builds.
+        self._fetch_lock = threading.RLock()
+        # One lock per artifact being fetched to the local artifact cache,
+        # so that artifacts are only ever fetched once at a time.
+        self._artifact_locks = {}
+        self._artifact_locks_lock = threading.Lock()
+        self.jobserver = self.new_jobserver()
+        self.staging_area_cache = self.new_staging_area_cache()
+        self.chunk_cache = self.new_chunk_cache()
 
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
@@ -58,16 +125,27 @@ class BuildCommand(object):
             repo_name=repo_name, ref=ref, filename=filename)
 
         self.app.status(msg='Deciding on task order')
-        srcpool = self.create_source_pool(
+        root_artifact = self.resolve_graph(
             repo_name, ref, filename, original_ref)
-        self.validate_sources(srcpool)
-        root_artifact = self.resolve_artifacts(srcpool)
-        self.build_in_order(root_artifact)
+        prefetcher = self.start_prefetching(root_artifact)
+        try:
+            self.build_in_order(root_artifact)
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
 
         self.app.status(
             msg='Build of %(repo_name)s %(ref)s %(filename)s ended '
                 'successfully',
             repo_name=repo_name, ref=ref, filename=filename)
+        self.app.status(
+            msg='Made %(requests-served)d requests to cache servers over '
+                '%(connections-opened)d connections',
+            chatty=True, **morphlib.httppool.default_pool.stats())
+        self.app.status(
+            msg='Unpacked chunk cache: %(hits)d hits, %(misses)d misses, '
+                '%(size)d bytes in use',
+            chatty=True, **self.chunk_cache.stats())
 
     def new_artifact_caches(self):
         '''Create interfaces for the build artifact caches.
@@ -80,11 +158,87 @@ class BuildCommand(object):
     def new_repo_caches(self):
         return morphlib.util.new_repo_caches(self.app)
 
+    def new_jobserver(self):
+        '''Create the make jobserver shared by all builds on this host.
+
+        It is only joined once a build first runs make with it, which
+        also happens in the processes ``worker-build-service`` forks for
+        each build.
+
+        '''
+
+        if self.app.settings['no-jobserver']:
+            return None
+        return morphlib.jobserver.JobServer(
+            self.app.settings['tempdir'], self.app.settings['max-jobs'])
+
+    def new_staging_area_cache(self):
+        '''Create the cache of staging area snapshots, or return None.'''
+
+        max_snapshots = self.app.settings['staging-area-snapshots']
+        if max_snapshots <= 0:
+            return None
+        return morphlib.stagingareacache.StagingAreaCache(
+            os.path.join(self.app.settings['tempdir'], 'snapshots'),
+            max_snapshots)
+
+    def new_chunk_cache(self):
+        '''Create the cache of unpacked chunks.'''
+
+        return morphlib.chunkcache.UnpackedChunkCache(
+            os.path.join(self.app.settings['tempdir'], 'chunks'),
+            self.app.settings['chunk-cache-size'] or None)
+
     def new_build_env(self, arch):
         '''Create a new BuildEnvironment instance.'''
         return morphlib.buildenvironment.BuildEnvironment(self.app.settings,
                                                           arch)
 
+    def resolve_graph(self, repo_name, ref, filename, original_ref=None):
+        '''Resolve the build graph of a system, returning its root artifact.
+
+        This creates and validates the source pool and resolves artifacts,
+        unless the graph was already resolved by an earlier run of morph
+        for the same commit of definitions, and the named refs in it still
+        point to the same commits.
+
+        '''
+        graph_cache = morphlib.util.new_graph_cache(self.app.settings)
+        if graph_cache is None:
+            return self._resolve_graph(repo_name, ref, filename, original_ref)
+
+        resolver = morphlib.sourceresolver.SourceResolver(
+            self.lrc, self.rrc, not self.app.settings['no-git-update'],
+            self.app.status, self.morphology_cache)
+        sha1, tree = resolver.resolve_ref(repo_name, ref)
+        key = graph_cache.key(repo_name, sha1, filename, original_ref or ref)
+        root_artifact = graph_cache.get(key, resolver.resolve_refs)
+        if root_artifact is not None:
+            self.app.status(msg='Reusing build graph resolved earlier',
+                            chatty=True)
+            # Other commands may have stored the graph without validating
+            # it, and validating it is quick anyway.
+            srcpool = morphlib.sourcepool.SourcePool()
+            sources, artifacts = morphlib.graphcache.walk_graph(root_artifact)
+            for source in sources:
+                srcpool.add(source)
+            self.validate_sources(srcpool)
+            self._validate_root_artifact(root_artifact)
+            root_artifact.build_env = self.new_build_env(
+                root_artifact.source.morphology['arch'])
+            return root_artifact
+
+        root_artifact = self._resolve_graph(
+            repo_name, ref, filename, original_ref)
+        graph_cache.put(key, root_artifact)
+        return root_artifact
+
+    def _resolve_graph(self, repo_name, ref, filename, original_ref):
+        srcpool = self.create_source_pool(
+            repo_name, ref, filename, original_ref)
+        self.validate_sources(srcpool)
+        return self.resolve_artifacts(srcpool)
+
     def create_source_pool(self, repo_name, ref, filename, original_ref=None):
         '''Find the source objects required for building a the given artifact
 
@@ -98,7 +252,8 @@ class BuildCommand(object):
             self.lrc, self.rrc, repo_name, ref, filename,
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            morphology_cache=self.morphology_cache)
         return srcpool
 
     def validate_sources(self, srcpool):
@@ -259,6 +414,34 @@ class BuildCommand(object):
                              other.morphology['kind'],
                              wanted))
 
+    def start_prefetching(self, root_artifact):
+        '''Start fetching the remotely cached artifacts in the background.
+
+        Every artifact in the build graph which is in the remote artifact
+        cache but not in the local one is fetched, in build order, while
+        the build goes on. The remote cache is asked about all of them in
+        one request.
+
+        '''
+
+        threads = self.app.settings['prefetch-threads']
+        if self.rac is None or threads < 1:
+            return None
+        self.app.status(msg='Prefetching artifacts with %(threads)d threads',
+                        threads=threads, chatty=True)
+        missing = [a for a in root_artifact.walk() if not self.lac.has(a)]
+        cached = self.rac.has_many(missing)
+        prefetcher = ArtifactPrefetcher(
+            self, [a for a in missing if a in cached], threads)
+        prefetcher.start()
+        return prefetcher
+
+    def prefetch_artifact(self, artifact):
+        '''Fetch a remotely cached artifact to the local cache.'''
+
+        if not self.lac.has(artifact):
+            self.cache_artifacts_locally([artifact])
+
     @staticmethod
     def get_ordered_sources(artifacts):
         ordered_sources = []
@@ -269,23 +452,41 @@ class BuildCommand(object):
                 yield artifact.source
 
     def build_in_order(self, root_artifact):
-        '''Build everything specified in a build order.'''
+        '''Build everything specified in a build order.
+
+        Up to ``build-slots`` sources are built at the same time. A source
+        is started as soon as all the sources it depends on are cached.
+
+        '''
 
         self.app.status(msg='Building a set of sources', chatty=True)
         build_env = root_artifact.build_env
         ordered_sources = list(self.get_ordered_sources(root_artifact.walk()))
         old_prefix = self.app.status_prefix
-        for i, s in enumerate(ordered_sources):
-            self.app.status_prefix = (
-                old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
-                    'index': (i+1),
-                    'total': len(ordered_sources),
-                    'name': s.name,
-                })
-
-            self.cache_or_build_source(s, build_env)
-
-        self.app.status_prefix = old_prefix
+        slots = self.app.settings['build-slots']
+
+        def build(source, slot, number):
+            prefix = old_prefix + '[Build %(index)d/%(total)d] ' % {
+                'index': number,
+                'total': len(ordered_sources),
+            }
+            if slots > 1:
+                prefix += '[Slot %d] ' % (slot + 1)
+            self.app.status_prefix = prefix + '[%s] ' % source.name
+            self.cache_or_build_source(source, build_env)
+
+        if slots > 1:
+            self.app.status(msg='Building in %(slots)d slots',
+                            slots=slots, chatty=True)
+            scheduler = morphlib.buildscheduler.BuildScheduler(
+                ordered_sources, slots)
+            scheduler.run(build)
+        else:
+            try:
+                for i, s in enumerate(ordered_sources):
+                    build(s, 0, i + 1)
+            finally:
+                self.app.status_prefix = old_prefix
 
     def cache_or_build_source(self, source, build_env):
         '''Make artifacts of the built source available in the local cache.
@@ -385,6 +586,10 @@ class BuildCommand(object):
     def fetch_sources(self, source):
         '''Update the local git repository cache with the sources.'''
 
+        with self._fetch_lock:
+            self._fetch_sources(source)
+
+    def _fetch_sources(self, source):
         repo_name = source.repo_name
         if self.app.settings['no-git-update']:
             self.app.status(msg='Not updating existing git repository '
@@ -442,7 +647,7 @@ class BuildCommand(object):
                     remote.close()
                     local.close()
 
-        for artifact in artifacts:
+        def fetch_artifact(artifact):
             # This block should fetch all artifact files in one go, using the
             # 1.0/artifacts method of morph-cache-server. The code to do that
             # needs bringing in from the distbuild.worker_build_connection
@@ -464,6 +669,15 @@ class BuildCommand(object):
                     name=artifact.name)
                 fetch_files(to_fetch)
 
+        for artifact in artifacts:
+            with self._artifact_lock(artifact):
+                fetch_artifact(artifact)
+
+    def _artifact_lock(self, artifact):
+        with self._artifact_locks_lock:
+            return self._artifact_locks.setdefault(artifact.basename(),
+                                                   threading.Lock())
+
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
         '''Create the staging area for building a single artifact.'''
@@ -473,11 +687,19 @@ class BuildCommand(object):
             dir=os.path.join(self.app.settings['tempdir'], 'staging'))
         staging_area = morphlib.stagingarea.StagingArea(
             self.app, staging_dir, build_env, use_chroot, extra_env,
-            extra_path)
+            extra_path, jobserver=self.jobserver,
+            chunk_cache=self.chunk_cache)
         return staging_area
 
     def remove_staging_area(self, staging_area):
-        '''Remove the staging area.'''
+        '''Remove the staging area, or keep it to build in again.'''
+
+        if staging_area.snapshot is not None:
+            self.app.status(msg='Keeping staging area as a snapshot')
+            basenames, listing = staging_area.snapshot
+            self.staging_area_cache.keep(staging_area.dirname, basenames,
+                                         listing)
+            return
 
         self.app.status(msg='Removing staging area')
         staging_area.remove()
@@ -511,14 +733,38 @@ class BuildCommand(object):
 
         All artifacts MUST be in the local artifact cache already.
 
+        In staging mode, the staging area starts from the snapshot of an
+        earlier one with the most of the same artifacts installed, if
+        there is one, and is kept as a snapshot again once it has been
+        built in.
+
         '''
 
+        to_install = []
         for artifact in artifacts:
             if artifact.source.morphology['kind'] != 'chunk':
                 continue
             if artifact.source.build_mode == 'bootstrap':
                if not self.in_same_stratum(artifact.source, target_source):
                     continue
+            to_install.append(artifact)
+
+        # Builds in staging mode run in a chroot, which they cannot change
+        # outside a few directories, so their staging areas can be reused.
+        snapshots = None
+        installed = 0
+        if target_source.build_mode == 'staging':
+            snapshots = self.staging_area_cache
+        if snapshots is not None:
+            basenames = [a.basename() for a in to_install]
+            installed = snapshots.take(basenames, staging_area.dirname)
+            if installed > 0:
+                self.app.status(
+                    msg='Starting from a snapshot with %(count)d of '
+                        '%(total)d chunks installed',
+                    count=installed, total=len(to_install), chatty=True)
+
+        for artifact in to_install[installed:]:
             self.app.status(
                 msg='Installing chunk %(chunk_name)s from cache %(cache)s',
                 chunk_name=artifact.name,
@@ -527,9 +773,15 @@ class BuildCommand(object):
             handle = self.lac.get(artifact)
             staging_area.install_artifact(handle)
 
-        if target_source.build_mode == 'staging':
+        # A snapshot of all the artifacts has ld.so.cache made already.
+        if (target_source.build_mode == 'staging' and
+                installed < len(to_install)):
             morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
 
+        if snapshots is not None:
+            staging_area.snapshot = (basenames, snapshots.listing(
+                staging_area.dirname, staging_area.chroot_writable_dirs()))
+
     def build_and_cache(self, staging_area, source, setup_mounts):
         '''Build a source and put its artifacts into the local cache.'''
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -40,16 +40,28 @@ import morphlib.gitversion
 SYSTEM_INTEGRATION_PATH = os.path.join('baserock', 'system-integration')
 
 def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
-    '''Get sources from git to a source directory, including submodules'''
+    '''Get sources from git to a source directory, including submodules
+
+    With the `tree` source-extraction setting, only the files of each
+    commit are written, rather than a copy of each repository. Repos that
+    use git-fat are still copied, since their files are got with git.
+
+    '''
+
+    export_trees = app.settings['source-extraction'] == 'tree'
 
     def extract_repo(repo, sha1, destdir):
         app.status(msg='Extracting %(source)s into %(target)s',
                    source=repo.original_name,
                    target=destdir)
 
-        repo.checkout(sha1, destdir)
-        morphlib.git.reset_workdir(app.runcmd, destdir)
-        submodules = morphlib.git.Submodules(app, repo.path, sha1)
+        if export_trees and repo.get_tree_entry(sha1, '.gitfat') is None:
+            repo.export(sha1, destdir)
+        else:
+            repo.checkout(sha1, destdir)
+            morphlib.git.reset_workdir(app.runcmd, destdir)
+        submodules = morphlib.git.Submodules(app, repo.path, sha1,
+                                             cached_repo=repo)
         try:
             submodules.load()
         except morphlib.git.NoModulesFileError:
@@ -135,15 +147,19 @@ def download_depends(constituents, lac, rac, metadatas=None):
             shutil.copyfileobj(source, target)
             target.close()
             source.close()
-        if metadatas is not None:
-            for metadata in metadatas:
-                if not lac.has_artifact_metadata(constituent, metadata):
-                    if rac.has_artifact_metadata(constituent, metadata):
-                        src = rac.get_artifact_metadata(constituent, metadata)
-                        dst = lac.put_artifact_metadata(constituent, metadata)
-                        shutil.copyfileobj(src, dst)
-                        dst.close()
-                        src.close()
+    if metadatas is not None:
+        for metadata in metadatas:
+            missing = [c for c in constituents
+                       if not lac.has_artifact_metadata(c, metadata)]
+            # Ask the remote cache about all of them at once.
+            cached = rac.has_many_artifact_metadata(missing, metadata)
+            for constituent in missing:
+                if constituent in cached:
+                    src = rac.get_artifact_metadata(constituent, metadata)
+                    dst = lac.put_artifact_metadata(constituent, metadata)
+                    shutil.copyfileobj(src, dst)
+                    dst.close()
+                    src.close()
 
 
 def get_chunk_files(f):  # pragma: no cover
@@ -369,8 +385,11 @@ class ChunkBuilder(BuilderBase):
                         log.write('# %s\n' % step)
 
                 for cmd in cmds:
-                    if in_parallel:
-                        max_jobs = self.source.morphology['max-jobs']
+                    jobserver = self.staging_area.jobserver
+                    max_jobs = self.source.morphology['max-jobs']
+                    if in_parallel and max_jobs is None and jobserver:
+                        extra_env['MAKEFLAGS'] = jobserver.makeflags()
+                    elif in_parallel:
                         if max_jobs is None:
                             max_jobs = self.max_jobs
                         extra_env['MAKEFLAGS'] = '-j%s' % max_jobs
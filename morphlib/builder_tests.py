@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -135,6 +135,9 @@ class FakeArtifactCache(object):
     def has_source_metadata(self, source, cachekey, name):
         return (cachekey, name) in self._cached
 
+    def has_many_artifact_metadata(self, artifacts, name):
+        return set(a for a in artifacts if self.has_artifact_metadata(a, name))
+
 
 class BuilderBaseTests(unittest.TestCase):
 
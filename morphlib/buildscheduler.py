@@ -0,0 +1,151 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import sys
+import threading
+
+import morphlib
+
+
+class DependencyCycleError(morphlib.Error):
+
+    def __init__(self, sources):
+        self.msg = ('Cannot schedule builds, sources depend on each other: '
+                    '%s' % ', '.join(s.name for s in sources))
+
+
+class BuildScheduler(object):
+
+    '''Build a set of sources concurrently, in dependency order.
+
+    ``sources`` is a list of sources in an order in which they could be
+    built serially, such as the one given by walking the root artifact.
+    A source is only handed out for building once every source that
+    produces one of its ``dependencies`` has been built. Sources that
+    become ready at the same time are handed out in the order they have
+    in ``sources``, so with a single slot the build order is unchanged.
+
+    At most ``slots`` sources are built at once, each in its own thread.
+    If a build fails, no further builds are started, the builds that are
+    already running are allowed to finish, and the first error is raised
+    from ``run``.
+
+    '''
+
+    def __init__(self, sources, slots):
+        self.sources = list(sources)
+        self.slots = max(1, slots)
+
+        self._index = dict((s, i) for i, s in enumerate(self.sources))
+        self._unmet = {}
+        self._dependents = dict((s, []) for s in self.sources)
+        for source in self.sources:
+            deps = set(a.source for a in source.dependencies
+                       if a.source in self._index and a.source != source)
+            self._unmet[source] = len(deps)
+            for dep in deps:
+                self._dependents[dep].append(source)
+
+        self._cond = threading.Condition()
+        self._ready = sorted((s for s in self.sources if not self._unmet[s]),
+                             key=self._index.get)
+        self._remaining = len(self.sources)
+        self._running = 0
+        self._started = 0
+        self._error = None
+
+    def run(self, build):
+        '''Build every source by calling ``build(source, slot, number)``.
+
+        ``slot`` is the index of the slot doing the build, and ``number``
+        counts builds in the order they were started, starting from 1.
+
+        '''
+
+        threads = [threading.Thread(target=self._run_slot,
+                                    args=(slot, build),
+                                    name='build-slot-%d' % slot)
+                   for slot in xrange(min(self.slots, len(self.sources)))]
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                # Joining with a timeout lets KeyboardInterrupt through.
+                while thread.is_alive():
+                    thread.join(1.0)
+        except BaseException:
+            self._fail(sys.exc_info())
+            raise
+
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def _run_slot(self, slot, build):
+        while True:
+            job = self._next_source()
+            if job is None:
+                return
+            source, number = job
+            try:
+                build(source, slot, number)
+            except BaseException:
+                logging.debug('Build of %s in slot %d failed',
+                              source.name, slot)
+                self._finish(source, sys.exc_info())
+                return
+            self._finish(source)
+
+    def _next_source(self):
+        with self._cond:
+            while True:
+                if self._error is not None or self._remaining == 0:
+                    return None
+                if self._ready:
+                    self._running += 1
+                    self._started += 1
+                    return self._ready.pop(0), self._started
+                if self._running == 0:
+                    stuck = [s for s in self.sources if self._unmet[s] > 0]
+                    self._error = (DependencyCycleError,
+                                   DependencyCycleError(stuck), None)
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait()
+
+    def _finish(self, source, exc_info=None):
+        with self._cond:
+            self._running -= 1
+            if exc_info is not None:
+                if self._error is None:
+                    self._error = exc_info
+                self._cond.notify_all()
+                return
+            self._remaining -= 1
+            for dependent in self._dependents[source]:
+                self._unmet[dependent] -= 1
+                if self._unmet[dependent] == 0:
+                    self._ready.append(dependent)
+            self._ready.sort(key=self._index.get)
+            self._cond.notify_all()
+
+    def _fail(self, exc_info):
+        with self._cond:
+            if self._error is None:
+                self._error = exc_info
+            self._cond.notify_all()
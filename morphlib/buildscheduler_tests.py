@@ -0,0 +1,137 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import signal
+import threading
+import unittest
+
+import morphlib
+
+
+class FakeSource(object):
+
+    def __init__(self, name, *deps):
+        self.name = name
+        self.dependencies = [FakeArtifact(d) for d in deps]
+
+
+class FakeArtifact(object):
+
+    def __init__(self, source):
+        self.source = source
+
+
+class BuildSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeSource('a')
+        self.b = FakeSource('b', self.a)
+        self.c = FakeSource('c', self.a)
+        self.d = FakeSource('d', self.b, self.c)
+        self.sources = [self.a, self.b, self.c, self.d]
+        self.lock = threading.Lock()
+        self.built = []
+
+    def record(self, source, slot, number):
+        with self.lock:
+            self.built.append(source)
+
+    def test_single_slot_keeps_given_order(self):
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 1)
+        scheduler.run(self.record)
+        self.assertEqual(self.built, self.sources)
+
+    def test_builds_dependencies_first(self):
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 4)
+        scheduler.run(self.record)
+        self.assertEqual(len(self.built), 4)
+        self.assertEqual(self.built[0], self.a)
+        self.assertEqual(self.built[-1], self.d)
+
+    def test_builds_independent_sources_concurrently(self):
+        barrier = threading.Event()
+        seen = []
+
+        def build(source, slot, number):
+            if source in (self.b, self.c):
+                with self.lock:
+                    seen.append(source)
+                    if len(seen) == 2:
+                        barrier.set()
+                # Only returns if both b and c are being built at once.
+                barrier.wait(5)
+                self.assertTrue(barrier.is_set())
+
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 2)
+        scheduler.run(build)
+        self.assertEqual(set(seen), set([self.b, self.c]))
+
+    def test_numbers_builds_in_start_order(self):
+        numbers = []
+
+        def build(source, slot, number):
+            with self.lock:
+                numbers.append(number)
+
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 3)
+        scheduler.run(build)
+        self.assertEqual(sorted(numbers), [1, 2, 3, 4])
+
+    def test_raises_first_error_and_stops_scheduling(self):
+        def build(source, slot, number):
+            self.record(source, slot, number)
+            if source is self.b:
+                raise morphlib.Error('b failed')
+
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 1)
+        self.assertRaises(morphlib.Error, scheduler.run, build)
+        self.assertEqual(self.built, [self.a, self.b])
+
+    def test_ignores_dependencies_outside_the_set(self):
+        outside = FakeSource('outside')
+        e = FakeSource('e', outside)
+        scheduler = morphlib.buildscheduler.BuildScheduler([e], 2)
+        scheduler.run(self.record)
+        self.assertEqual(self.built, [e])
+
+    def test_reports_dependency_cycle(self):
+        x = FakeSource('x')
+        y = FakeSource('y', x)
+        x.dependencies.append(FakeArtifact(y))
+        scheduler = morphlib.buildscheduler.BuildScheduler([x, y], 2)
+        self.assertRaises(morphlib.buildscheduler.DependencyCycleError,
+                          scheduler.run, self.record)
+
+    def test_stops_scheduling_when_interrupted(self):
+        self.addCleanup(signal.signal, signal.SIGINT,
+                        signal.signal(signal.SIGINT,
+                                      signal.default_int_handler))
+        resume = threading.Event()
+
+        def build(source, slot, number):
+            self.record(source, slot, number)
+            # The main thread gets the KeyboardInterrupt while it waits.
+            os.kill(os.getpid(), signal.SIGINT)
+            resume.wait(5)
+
+        scheduler = morphlib.buildscheduler.BuildScheduler(self.sources, 1)
+        self.assertRaises(KeyboardInterrupt, scheduler.run, build)
+        resume.set()
+        for thread in threading.enumerate():
+            if thread.name.startswith('build-slot-'):
+                thread.join()
+        self.assertEqual(self.built, [self.a])
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -53,6 +53,15 @@ class CheckoutError(cliapp.AppException):
             'Failed to check out ref %s in %s' % (ref, target_dir))
 
 
+class ExportError(cliapp.AppException):
+
+    def __init__(self, repo, ref, target_dir):
+        cliapp.AppException.__init__(
+            self,
+            'Failed to export ref %s of %s into %s' %
+            (ref, repo.original_name, target_dir))
+
+
 class UpdateError(cliapp.AppException):
 
     def __init__(self, repo):
@@ -90,7 +99,7 @@ class CachedRepo(object):
         self.is_mirror = not url.startswith('file://')
         self.already_updated = False
 
-        self._gitdir = morphlib.gitdir.GitDirectory(path)
+        self._gitdir = morphlib.gitdir.GitDirectory(path, batch=True)
 
     def ref_exists(self, ref):  # pragma: no cover
         '''Returns True if the given ref exists in the repo'''
@@ -131,6 +140,14 @@ class CachedRepo(object):
         '''
         return self._gitdir.list_files(ref, recurse)
 
+    def get_tree_entry(self, ref, path):  # pragma: no cover
+        '''Return the (mode, type, sha1) of a path in the tree of a ref.
+
+        Returns None if there is no such path.
+
+        '''
+        return self._gitdir.get_tree_entry(ref, path)
+
     def clone_checkout(self, ref, target_dir):
         '''Clone from the cache into the target path and check out a given ref.
 
@@ -169,6 +186,26 @@ class CachedRepo(object):
 
         self._checkout_ref_in_clone(ref, target_dir)
 
+    def export(self, ref, target_dir):
+        '''Writes the files of a commit ref into a directory.
+
+        Unlike checkout, this does not copy the repository: only the files
+        in the tree of the commit are written, and the directory is not a
+        git repository afterwards.
+
+        Raises an gitdir.InvalidRefError if the ref is not found in the
+        repository. Raises an ExportError if something else goes wrong
+        while writing the files.
+
+        '''
+
+        commit = self._gitdir.resolve_ref_to_commit(ref)
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        self._export_tree(commit, target_dir)
+
     def requires_update_for_ref(self, ref):
         '''Returns False if there's no need to update this cached repo.
 
@@ -231,6 +268,14 @@ class CachedRepo(object):
         except cliapp.AppException:
             raise CopyError(self, target_dir)
 
+    def _export_tree(self, commit, target_dir):
+        try:
+            morphlib.git.export_tree(
+                self._runcmd, self.path, commit, target_dir,
+                tempdir=self.app.settings['tempdir'])
+        except cliapp.AppException:
+            raise ExportError(self, commit, target_dir)
+
     def _checkout_ref_in_clone(self, ref, clone_dir):  # pragma: no cover
         # This is a separate GitDirectory instance. Don't confuse it with the
         # internal ._gitdir attribute!
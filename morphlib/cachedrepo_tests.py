@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -29,7 +29,8 @@ class FakeApplication(object):
 
     def __init__(self):
         self.settings = {
-            'verbose': True
+            'verbose': True,
+            'tempdir': '/tmp/morph',
         }
 
 
@@ -141,6 +142,35 @@ class CachedRepoTests(unittest.TestCase):
         morph_filename = os.path.join(unpack_dir, 'foo.morph')
         self.assertTrue(os.path.exists(morph_filename))
 
+    def export_tree(self, runcmd, repo, ref, destdir, tempdir=None):
+        if destdir.endswith('failed-export'):
+            raise cliapp.AppException('git read-tree %s' % ref)
+        self.exported = (repo, ref, destdir, tempdir)
+
+    def test_export_commit_of_ref_into_new_directory(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.addCleanup(setattr, morphlib.git, 'export_tree',
+                        morphlib.git.export_tree)
+        morphlib.git.export_tree = self.export_tree
+
+        export_dir = self.tempfs.getsyspath('export-dir')
+        self.repo.export('master', export_dir)
+        self.assertTrue(os.path.isdir(export_dir))
+        self.assertEqual(self.exported,
+                         (self.repo_path,
+                          'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
+                          export_dir, '/tmp/morph'))
+
+    def test_fail_export_due_to_export_error(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.addCleanup(setattr, morphlib.git, 'export_tree',
+                        morphlib.git.export_tree)
+        morphlib.git.export_tree = self.export_tree
+
+        self.assertRaises(
+            morphlib.cachedrepo.ExportError, self.repo.export,
+            'master', self.tempfs.getsyspath('failed-export'))
+
     def test_successful_update(self):
         self.repo._gitdir.update_remotes = self.update_successfully
         self.repo.update()
@@ -0,0 +1,328 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import morphlib
+
+
+# In the names of the directories chunks are unpacked in, before they
+# are renamed into place.
+_UNPACKING = '.unpacking-'
+
+
+class UnpackedChunkCache(object):
+
+    '''Keep chunk artifacts unpacked, to install them into staging areas.
+
+    Each chunk is unpacked once into ``dirname``, as ``NAME.d``, with the
+    manifest of what it holds as ``NAME.manifest`` and its size on disk
+    as ``NAME.size``, where NAME is the basename of the artifact. Builds
+    in other threads and other processes, such as the other workers on
+    the same machine, share the one copy.
+
+    Every chunk has a lock file, ``NAME.lock``, which is locked with
+    flock(2). A build holds a shared lock on it while it uses the chunk,
+    and an exclusive lock while it unpacks it, so the locks also count
+    how many builds use each chunk. The kernel drops the locks of a
+    process that dies, so they never go stale.
+
+    When the chunks take more than ``max_bytes``, those used longest ago
+    are removed, apart from any that a build is using. So are what
+    unpacking that was interrupted left behind, and chunks unpacked by
+    older versions of morph, which have no lock file. If ``max_bytes``
+    is None, nothing is ever removed.
+
+    How often a chunk was already unpacked is counted in ``hits`` and
+    ``misses``.
+
+    '''
+
+    def __init__(self, dirname, max_bytes=None):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _path(self, basename, suffix):
+        return os.path.join(self.dirname, basename + suffix)
+
+    @contextlib.contextmanager
+    def get(self, basename, unpack):
+        '''Use an unpacked chunk, unpacking it first if needed.
+
+        This is a context manager, which gives the directory the chunk is
+        unpacked in and its manifest, as made by
+        ``morphlib.stagingarea.make_manifest``. The chunk is not removed
+        until the block ends. ``unpack`` is called with the name of an
+        empty directory to unpack the chunk into, if it is not unpacked
+        already.
+
+        '''
+
+        unpacked = False
+        while True:
+            fd = self._open_lock(basename, fcntl.LOCK_SH)
+            if os.path.exists(self._path(basename, '.size')):
+                break
+            # Only one build unpacks a chunk. The others wait for it, and
+            # then use what it unpacked. flock(2) does not change a shared
+            # lock to an exclusive one atomically, so the lock is taken
+            # again from the start either way.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if self._is_current(fd, basename):
+                    unpacked = self._unpack(basename, unpack) or unpacked
+            finally:
+                os.close(fd)
+
+        try:
+            self._count(hit=not unpacked)
+            os.utime(self._path(basename, '.lock'), None)
+            if unpacked:
+                self.evict()
+            manifest = self._manifest(basename)
+            yield self._path(basename, '.d'), manifest
+        finally:
+            os.close(fd)
+
+    def _is_current(self, fd, basename):
+        '''Tell if a lock file is still the one for a chunk.
+
+        It may have been removed with the chunk, by another build,
+        between opening and locking it.
+
+        '''
+
+        try:
+            st = os.stat(self._path(basename, '.lock'))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            return False
+        return os.fstat(fd).st_ino == st.st_ino
+
+    def _open_lock(self, basename, operation):
+        '''Open and lock the lock file of a chunk, and return it.'''
+
+        path = self._path(basename, '.lock')
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, operation)
+                if self._is_current(fd, basename):
+                    return fd
+            except BaseException:  # pragma: no cover
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def _unpack(self, basename, unpack):
+        '''Unpack a chunk unless it is already, and tell if it was.'''
+
+        unpacked_dir = self._path(basename, '.d')
+        manifest_file = self._path(basename, '.manifest')
+        size_file = self._path(basename, '.size')
+        if os.path.exists(size_file):
+            return False
+
+        if not os.path.isdir(unpacked_dir):
+            savedir = tempfile.mkdtemp(dir=self.dirname,
+                                       prefix=basename + _UNPACKING)
+            try:
+                unpack(savedir)
+            except BaseException:
+                shutil.rmtree(savedir)
+                raise
+            os.rename(savedir, unpacked_dir)
+            unpacked = True
+        else:
+            # Unpacked by an older version of morph, which kept no size.
+            unpacked = False
+
+        manifest = morphlib.stagingarea.make_manifest(unpacked_dir)
+        morphlib.stagingarea.write_manifest(manifest_file, manifest)
+        with morphlib.savefile.SaveFile(size_file, 'w') as f:
+            f.write('%d\n' % self._disk_usage(unpacked_dir))
+        return unpacked
+
+    def _manifest(self, basename):
+        manifest_file = self._path(basename, '.manifest')
+        try:
+            return morphlib.stagingarea.read_manifest(manifest_file)
+        except (IOError, ValueError):  # pragma: no cover
+            # The manifest was lost, so make it again.
+            manifest = morphlib.stagingarea.make_manifest(
+                self._path(basename, '.d'))
+            morphlib.stagingarea.write_manifest(manifest_file, manifest)
+            return manifest
+
+    def _disk_usage(self, dirname):
+        total = 0
+        for dirpath, subdirs, basenames in os.walk(dirname):
+            for name in subdirs + basenames:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+        return total
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _size(self, basename):
+        try:
+            with open(self._path(basename, '.size')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    def list_contents(self):
+        '''Return (basename, size, last use) of every unpacked chunk.'''
+
+        contents = []
+        for filename in os.listdir(self.dirname):
+            if not filename.endswith('.lock'):
+                continue
+            basename = filename[:-len('.lock')]
+            try:
+                mtime = os.stat(self._path(basename, '.lock')).st_mtime
+            except OSError:
+                continue  # removed meanwhile
+            contents.append((basename, self._size(basename), mtime))
+        return contents
+
+    def total_size(self):
+        '''Return how many bytes all the unpacked chunks take.'''
+
+        return sum(size for basename, size, mtime in self.list_contents())
+
+    def evict(self):
+        '''Remove the chunks used longest ago, until under max_bytes.
+
+        Return how many were removed.
+
+        '''
+
+        if self.max_bytes is None:
+            return 0
+        self._remove_leftovers()
+        contents = self.list_contents()
+        total = sum(size for basename, size, mtime in contents)
+        removed = 0
+        for basename, size, mtime in sorted(contents, key=lambda x: x[2]):
+            if total <= self.max_bytes:
+                break
+            if self._remove(basename):
+                total -= size
+                removed += 1
+        return removed
+
+    def _remove(self, basename):
+        '''Remove a chunk, unless a build is using it.'''
+
+        path = self._path(basename, '.lock')
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            return False  # removed meanwhile
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise  # pragma: no cover
+                return False  # in use
+            if not self._is_current(fd, basename):
+                return False  # pragma: no cover
+            logging.debug('Removing unpacked chunk %s' % basename)
+            # The size goes first, so that the chunk is unpacked again if
+            # removing it is interrupted.
+            for suffix in ('.size', '.manifest'):
+                if os.path.exists(self._path(basename, suffix)):
+                    os.remove(self._path(basename, suffix))
+            if os.path.exists(self._path(basename, '.d')):
+                shutil.rmtree(self._path(basename, '.d'))
+            os.remove(path)
+            return True
+        finally:
+            os.close(fd)
+
+    def _remove_leftovers(self):
+        '''Remove what belongs to no unpacked chunk.
+
+        That is the directories of unpacking that was interrupted, and
+        chunks unpacked by older versions of morph, unless a build is
+        using them. Each is removed with the lock of its chunk held, so
+        that no build unpacks or starts using the chunk meanwhile.
+
+        '''
+
+        for filename in os.listdir(self.dirname):
+            basename = self._leftover_of(filename)
+            if basename is not None:
+                self._remove_leftover(basename, filename)
+
+    def _leftover_of(self, filename):
+        '''Return the basename of the chunk a leftover is of, or None.'''
+
+        if _UNPACKING in filename:
+            return filename.rpartition(_UNPACKING)[0]
+        if (filename.endswith('.d') and
+                not os.path.exists(self._path(filename[:-2], '.lock'))):
+            return filename[:-2]
+        return None
+
+    def _remove_leftover(self, basename, filename):
+        try:
+            fd = self._open_lock(basename, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise  # pragma: no cover
+            return  # in use
+        try:
+            unpacked = os.path.exists(self._path(basename, '.size'))
+            path = os.path.join(self.dirname, filename)
+            if os.path.exists(path) and not (
+                    unpacked and filename.endswith('.d')):
+                logging.debug('Removing leftover %s' % filename)
+                shutil.rmtree(path)
+            if not unpacked:
+                os.remove(self._path(basename, '.lock'))
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        '''Return the counts of hits and misses, and the total size.'''
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'size': self.total_size(),
+        }
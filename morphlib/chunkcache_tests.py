@@ -0,0 +1,198 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'chunks')
+        self.cache = morphlib.chunkcache.UnpackedChunkCache(self.dirname)
+        self.unpacked = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def unpack(self, dirname):
+        self.unpacked.append(dirname)
+        os.mkdir(os.path.join(dirname, 'bin'))
+        with open(os.path.join(dirname, 'bin', 'foo'), 'w') as f:
+            f.write('x' * 10000)
+
+    def use(self, basename):
+        with self.cache.get(basename, self.unpack) as (path, manifest):
+            return path, manifest
+
+    def set_last_use(self, basename, when):
+        os.utime(os.path.join(self.dirname, basename + '.lock'),
+                 (when, when))
+
+    def test_unpacks_chunk_once(self):
+        path, manifest = self.use('foo')
+        self.assertEqual(path, os.path.join(self.dirname, 'foo.d'))
+        self.assertEqual(manifest, [('d', 'bin'), ('f', 'bin/foo')])
+        self.assertEqual(self.use('foo'), (path, manifest))
+        self.assertEqual(len(self.unpacked), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_removes_partly_unpacked_chunk(self):
+        def unpack(dirname):
+            raise morphlib.Error('corrupt chunk')
+        with self.assertRaises(morphlib.Error):
+            with self.cache.get('foo', unpack):
+                pass  # pragma: no cover
+        self.assertEqual(os.listdir(self.dirname), ['foo.lock'])
+        self.use('foo')
+        self.assertEqual(len(self.unpacked), 1)
+
+    def test_uses_chunk_unpacked_by_older_morph(self):
+        os.makedirs(os.path.join(self.dirname, 'foo.d', 'bin'))
+        path, manifest = self.use('foo')
+        self.assertEqual(manifest, [('d', 'bin')])
+        self.assertEqual(self.unpacked, [])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_shares_one_unpacking_between_threads(self):
+        started = threading.Event()
+
+        def unpack(dirname):
+            started.set()
+            time.sleep(0.1)
+            self.unpack(dirname)
+
+        def use():
+            with self.cache.get('foo', unpack):
+                pass
+
+        first = threading.Thread(target=use)
+        first.start()
+        started.wait()
+        self.use('foo')
+        first.join()
+        self.assertEqual(len(self.unpacked), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_counts_size_of_chunks(self):
+        self.use('foo')
+        self.use('bar')
+        self.assertTrue(self.cache.total_size() >= 2 * 10000)
+        self.assertEqual(self.cache.stats(), {
+            'hits': 0,
+            'misses': 2,
+            'size': self.cache.total_size(),
+        })
+
+    def test_never_removes_chunks_without_limit(self):
+        self.use('foo')
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dirname, 'foo.d')))
+
+    def test_removes_chunks_used_longest_ago(self):
+        for i, basename in enumerate(['a', 'b', 'c']):
+            self.use(basename)
+            self.set_last_use(basename, i)
+        size = self.cache.total_size() / 3
+        self.cache.max_bytes = size * 2
+        self.use('a')
+        self.use('d')
+        self.assertEqual(sorted(b for b, s, m in self.cache.list_contents()),
+                         ['a', 'd'])
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['a.d', 'a.lock', 'a.manifest', 'a.size',
+                          'd.d', 'd.lock', 'd.manifest', 'd.size'])
+
+    def test_does_not_remove_chunk_in_use(self):
+        self.use('b')
+        self.set_last_use('b', 0)
+        self.cache.max_bytes = 0
+        with self.cache.get('a', self.unpack) as (path, manifest):
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual([b for b, s, m in self.cache.list_contents()],
+                             ['a'])
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertEqual(os.listdir(self.dirname), [])
+
+    def test_unpacks_chunk_again_if_removed_while_waiting_for_it(self):
+        self.use('foo')
+        lock = os.open(os.path.join(self.dirname, 'foo.lock'), os.O_RDWR)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        thread = threading.Thread(target=self.use, args=('foo',))
+        thread.start()
+        time.sleep(0.1)
+        for name in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        os.close(lock)
+        thread.join()
+        self.assertEqual(len(self.unpacked), 2)
+
+    def test_unpacking_skips_chunk_unpacked_meanwhile(self):
+        self.use('foo')
+        self.assertFalse(self.cache._unpack('foo', self.unpack))
+        self.assertEqual(len(self.unpacked), 1)
+
+    def test_counts_chunk_with_unreadable_size_as_empty(self):
+        self.use('foo')
+        with open(os.path.join(self.dirname, 'foo.size'), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.cache.list_contents()[0][1], 0)
+
+    def test_lists_only_chunks_that_are_there(self):
+        self.use('foo')
+        os.symlink('missing', os.path.join(self.dirname, 'bar.lock'))
+        self.assertEqual([b for b, s, m in self.cache.list_contents()],
+                         ['foo'])
+        self.assertFalse(self.cache._remove('baz'))
+
+    def test_removes_leftovers_when_removing_chunks(self):
+        self.use('foo')
+        os.makedirs(os.path.join(self.dirname, 'old.d', 'bin'))
+        os.mkdir(os.path.join(self.dirname, 'foo.unpacking-xyz'))
+        os.mkdir(os.path.join(self.dirname, 'bar.unpacking-xyz'))
+        self.cache.max_bytes = 10 ** 9
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['foo.d', 'foo.lock', 'foo.manifest', 'foo.size'])
+
+    def test_keeps_leftovers_of_chunks_in_use(self):
+        leftover = os.path.join(self.dirname, 'foo.unpacking-xyz')
+        self.cache.max_bytes = 10 ** 9
+        with self.cache.get('foo', self.unpack):
+            os.mkdir(leftover)
+            self.cache.evict()
+            self.assertTrue(os.path.exists(leftover))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(leftover))
+
+    def test_unpacks_chunk_again_after_removing_it(self):
+        self.use('foo')
+        self.cache.max_bytes = 0
+        self.cache.evict()
+        self.use('foo')
+        self.assertEqual(len(self.unpacked), 2)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -83,7 +83,9 @@ def invert_paths(tree_walker, paths):
     traversing into these subdirectories, if it doesn't need to.
 
     As such, if a directory is returned, it is implied that its contents
-    are also not in the set of paths.
+    are also not in the set of paths. Only directories that paths are
+    in are traversed into, so the cost depends on how many of them
+    there are, rather than on the size of the tree.
 
     If the tree walker does not support culling the traversal this way,
     such as `os.walk(root, topdown=False)`, then the contents will also
@@ -104,36 +106,55 @@ def invert_paths(tree_walker, paths):
         if not os.path.isabs(path):
             path = os.path.join('.', path)
         return path
-    def any_paths_are_subpath_of(prefix):
-        prefix = normpath(prefix)
-        norm_paths = (normpath(path) for path in paths)
-        return any(path[:len(prefix)] == prefix
-                   for path in norm_paths)
 
-    def path_is_listed(path):
-        return any(normpath(path) == normpath(other)
-                   for other in paths)
+    listed = set(normpath(path) for path in paths)
+    # The directories that listed paths are in, at any depth. Only these
+    # need to be walked into; anything else in the tree is either listed
+    # or returned whole.
+    parents = set()
+    for path in listed:
+        while True:
+            parent = os.path.dirname(path)
+            if not parent or parent == path or parent in parents:
+                break
+            parents.add(parent)
+            path = parent
+    # Directories already returned, in case the walker cannot be culled
+    # and visits them too.
+    returned = set()
 
     for dirpath, dirnames, filenames in tree_walker:
+        norm_dirpath = normpath(dirpath)
 
-        if path_is_listed(dirpath):
+        if norm_dirpath in listed or norm_dirpath in returned:
             # No subpaths need to be considered
             del dirnames[:]
             del filenames[:]
-        elif any_paths_are_subpath_of(dirpath):
-            # Subpaths may be marked, or may not, need to leave this
-            # writable, so don't yield, but we don't cull.
-            pass
-        else:
-            # not listed as a parent or an exact match, needs to be
-            # yielded, but we don't need to consider subdirs, so can cull
+            continue
+        if norm_dirpath not in parents:
+            # Not listed and nothing in it is either, so it can all be
+            # returned at once.
+            returned.add(norm_dirpath)
             yield dirpath
             del dirnames[:]
             del filenames[:]
+            continue
+
+        # Subpaths may be listed, so this needs to be left writable, but
+        # only subdirectories with listed paths in them are walked into.
+        # The others are returned from here, without listing them.
+        walk_into = []
+        for dirname in dirnames:
+            fullpath = os.path.join(dirpath, dirname)
+            norm_path = normpath(fullpath)
+            if norm_path in parents:
+                walk_into.append(dirname)
+            elif norm_path not in listed and norm_path not in returned:
+                returned.add(norm_path)
+                yield fullpath
+        dirnames[:] = walk_into
 
         for filename in filenames:
             fullpath = os.path.join(dirpath, filename)
-            if path_is_listed(fullpath):
-                pass
-            else:
+            if normpath(fullpath) not in listed:
                 yield fullpath
@@ -1,4 +1,4 @@
-# Copyright (C) 2013, 2014  Codethink Limited
+# Copyright (C) 2013, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -112,3 +112,33 @@ class InvertPathsTests(unittest.TestCase):
                     ]))
         expected = ["./bin"]
         self.assertEqual(sorted(found), expected)
+
+    def test_walks_only_into_dirs_with_listed_paths(self):
+        visited = []
+        def walker():
+            for dirpath, dirnames, filenames in dummy_top_down_walker(
+                    '.', self.nested_tree):
+                visited.append(dirpath)
+                yield dirpath, dirnames, filenames
+        found = list(morphlib.fsutils.invert_paths(walker(), ['./fs/nfs']))
+        self.assertEqual(visited, ['.', './fs'])
+        self.assertEqual(sorted(found),
+                         ['./foo', './fs/btrfs', './fs/ext2', './fs/ext3',
+                          './fs/ext4'])
+
+    def test_lists_dir_whose_name_starts_with_listed_path(self):
+        walker = dummy_top_down_walker('.', {
+            "foo": {"bar": None},
+            "foobar": {"baz": None},
+        })
+        found = list(morphlib.fsutils.invert_paths(walker, ['./foo']))
+        self.assertEqual(found, ['./foobar'])
+
+    def test_lists_each_path_once_from_bottom_up_walker(self):
+        def walker():
+            walked = list(dummy_top_down_walker('.', self.nested_tree))
+            return reversed(walked)
+        found = list(morphlib.fsutils.invert_paths(walker(), ['./fs/nfs']))
+        self.assertEqual(len(found), len(set(found)))
+        self.assertTrue('./foo' in found)
+        self.assertTrue('./fs/nfs' not in found)
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,9 +19,11 @@ import ConfigParser
 import logging
 import os
 import re
+import shutil
 import string
 import StringIO
 import sys
+import tempfile
 
 import morphlib
 
@@ -59,10 +61,17 @@ class MissingSubmoduleCommitError(cliapp.AppException):
 
 class Submodules(object):
 
-    def __init__(self, app, repo, ref):
+    def __init__(self, app, repo, ref, cached_repo=None):
+        '''Find the submodules of a repo at a ref.
+
+        If 'cached_repo' is the CachedRepo for 'repo', it is used to read
+        the repository instead of running git for each query.
+
+        '''
         self.app = app
         self.repo = repo
         self.ref = ref
+        self.cached_repo = cached_repo
         self.submodules = []
 
     def load(self):
@@ -77,13 +86,16 @@ class Submodules(object):
     def _read_gitmodules_file(self):
         try:
             # try to read the .gitmodules file from the repo/ref
-            content = gitcmd(self.app.runcmd, 'cat-file', 'blob',
-                             '%s:.gitmodules' % self.ref, cwd=self.repo,
-                             ignore_fail=True)
+            if self.cached_repo is not None:
+                content = self.cached_repo.read_file('.gitmodules', self.ref)
+            else:
+                content = gitcmd(self.app.runcmd, 'cat-file', 'blob',
+                                 '%s:.gitmodules' % self.ref, cwd=self.repo,
+                                 ignore_fail=True)
 
             # drop indentation in sections, as RawConfigParser cannot handle it
             return '\n'.join([line.strip() for line in content.splitlines()])
-        except cliapp.AppException:
+        except (IOError, cliapp.AppException):
             raise NoModulesFileError(self.repo, self.ref)
 
     def _validate_and_read_entries(self, parser):
@@ -101,13 +113,9 @@ class Submodules(object):
                 try:
                     # list objects in the parent repo tree to find the commit
                     # object that corresponds to the submodule
-                    commit = gitcmd(self.app.runcmd, 'ls-tree', self.ref,
-                                    submodule.path, cwd=self.repo)
-
-                    # read the commit hash from the output
-                    fields = commit.split()
+                    fields = self._get_tree_entry(submodule.path)
                     if len(fields) >= 2 and fields[1] == 'commit':
-                        submodule.commit = commit.split()[2]
+                        submodule.commit = fields[2]
 
                         # fail if the commit hash is invalid
                         if len(submodule.commit) != 40:
@@ -127,6 +135,13 @@ class Submodules(object):
             else:
                 raise InvalidSectionError(self.repo, self.ref, section)
 
+    def _get_tree_entry(self, path):
+        if self.cached_repo is not None:
+            return self.cached_repo.get_tree_entry(self.ref, path) or ()
+        commit = gitcmd(self.app.runcmd, 'ls-tree', self.ref, path,
+                        cwd=self.repo)
+        return commit.split()
+
     def __iter__(self):
         for submodule in self.submodules:
             yield submodule
@@ -265,6 +280,31 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
     gitcmd(runcmd, 'remote', 'update', 'origin', '--prune', cwd=destdir)
 
 
+def export_tree(runcmd, repo, ref, destdir, tempdir=None):
+    '''Writes the files in the tree of a commit in repo into destdir.
+
+    Only the files in that tree are written. Unlike copy_repository,
+    nothing else from the repository is copied, and destdir is not a git
+    repository afterwards. Submodules are left as empty directories.
+
+    The temporary index used to write the files is made in tempdir, or
+    the system's default temporary directory if that is None.
+
+    '''
+    # The index used to write the files is a temporary one, so that the
+    # repository, which may be a bare mirror, is not changed.
+    tempdir = tempfile.mkdtemp(dir=tempdir)
+    try:
+        env = dict(os.environ)
+        env['GIT_INDEX_FILE'] = os.path.join(tempdir, 'index')
+        gitcmd(runcmd, '--git-dir', repo, '--work-tree', destdir,
+               'read-tree', ref, env=env)
+        gitcmd(runcmd, '--git-dir', repo, '--work-tree', destdir,
+               'checkout-index', '--all', env=env)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def reset_workdir(runcmd, gitdir):
     '''Removes any differences between the current commit '''
     '''and the status of the working directory'''
@@ -0,0 +1,165 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import atexit
+import logging
+import os
+import subprocess
+import threading
+import weakref
+
+import cliapp
+
+
+class CatFileBatchError(cliapp.AppException):
+
+    def __init__(self, dirname, msg):
+        cliapp.AppException.__init__(
+            self, 'git cat-file in %s failed: %s' % (dirname, msg))
+
+
+class CatFileBatch(object):
+
+    '''Look up objects in a repository through long-lived git processes.
+
+    Running ``git rev-parse`` or ``git cat-file`` for every query costs a
+    fork and exec, and git setting itself up for the repository, which
+    adds up when resolving sources reads hundreds of refs and files. This
+    keeps a ``git cat-file --batch-check`` process for queries that only
+    need an object's name and type, and a ``git cat-file --batch`` process
+    for queries that need its contents, and feeds them a query at a time.
+    Each is started by its first query.
+
+    Names are anything git understands as an object, such as ``master``,
+    ``master^{tree}`` or ``master:path/to/file``.
+
+    The processes may not see ref updates made after they started, so
+    ``close`` should be called once the repository has been changed; the
+    next query starts new ones. If a process cannot be started or stops
+    answering, a CatFileBatchError is raised so that the caller can fall
+    back to running git for each query.
+
+    The object may be shared between threads.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._processes = {}
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def check(self, name):
+        '''Return (sha1, type) of an object, or None if it does not exist.'''
+
+        with self._lock:
+            header = self._query('--batch-check', name)
+        if header is None:
+            return None
+        sha1, kind, size = header
+        return sha1, kind
+
+    def read(self, name):
+        '''Return (sha1, type, contents) of an object, or None.'''
+
+        with self._lock:
+            header = self._query('--batch', name)
+            if header is None:
+                return None
+            sha1, kind, size = header
+            process = self._processes['--batch']
+            try:
+                contents = process.stdout.read(size)
+                terminator = process.stdout.read(1)
+            except IOError, e:
+                self._stop('--batch')
+                raise CatFileBatchError(self.dirname, str(e))
+            if len(contents) != size or terminator != '\n':
+                self._stop('--batch')
+                raise CatFileBatchError(self.dirname,
+                                        'short read of %s' % name)
+        return sha1, kind, contents
+
+    def close(self):
+        '''Stop the git processes, if they are running.'''
+
+        with self._lock:
+            for option in self._processes.keys():
+                self._stop(option)
+
+    def _query(self, option, name):
+        if '\n' in name:
+            raise CatFileBatchError(self.dirname,
+                                    'object name %r has a newline' % name)
+        process = self._process(option)
+        try:
+            process.stdin.write(name + '\n')
+            process.stdin.flush()
+            header = process.stdout.readline()
+        except IOError, e:
+            self._stop(option)
+            raise CatFileBatchError(self.dirname, str(e))
+
+        if header.endswith(' missing\n') or header.endswith(' ambiguous\n'):
+            return None
+        fields = header.split()
+        if not header.endswith('\n') or len(fields) != 3:
+            self._stop(option)
+            raise CatFileBatchError(self.dirname,
+                                    'unexpected output %r' % header)
+        sha1, kind, size = fields
+        return sha1, kind, int(size)
+
+    def _process(self, option):
+        process = self._processes.get(option)
+        if process is not None:
+            return process
+
+        env = dict(os.environ)
+        # As in morphlib.git.gitcmd, don't let git replace objects.
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        try:
+            with open(os.devnull, 'w') as devnull:
+                process = subprocess.Popen(
+                    ['git', 'cat-file', option], cwd=self.dirname, env=env,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, close_fds=True, bufsize=-1)
+        except OSError, e:
+            raise CatFileBatchError(self.dirname, str(e))
+        logging.debug('Started git cat-file %s in %s' %
+                      (option, self.dirname))
+        self._processes[option] = process
+        return process
+
+    def _stop(self, option):
+        process = self._processes.pop(option)
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        process.stdout.close()
+        process.wait()
+
+
+_instances = weakref.WeakSet()
+
+
+@atexit.register
+def close_all():
+    '''Stop the git processes of every CatFileBatch.'''
+
+    for batch in list(_instances):
+        batch.close()
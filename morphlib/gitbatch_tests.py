@@ -0,0 +1,149 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import morphlib
+
+
+class BrokenOutput(StringIO.StringIO):
+
+    '''Output of a process that cannot be read past the first line.'''
+
+    def read(self, *args):
+        raise IOError(errno.EIO, 'Input/output error')
+
+
+class BrokenPipe(StringIO.StringIO):
+
+    '''Input of a process that has died.'''
+
+    def flush(self):
+        raise IOError(errno.EPIPE, 'Broken pipe')
+
+    close = flush
+
+
+class FakeProcess(object):
+
+    '''A git cat-file process that gives some output, and then stops.'''
+
+    def __init__(self, output, output_class=StringIO.StringIO):
+        self.stdin = StringIO.StringIO()
+        self.stdout = output_class(output)
+
+    def wait(self):
+        return 0
+
+
+class CatFileBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.gd = morphlib.gitdir.init(self.tempdir)
+        with open(os.path.join(self.tempdir, 'file'), 'w') as f:
+            f.write('first line\nsecond line\n')
+        morphlib.git.gitcmd(self.gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(self.gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.commit = morphlib.git.gitcmd(self.gd._runcmd, 'rev-parse',
+                                          'HEAD').strip()
+        self.batch = morphlib.gitbatch.CatFileBatch(self.tempdir)
+
+    def tearDown(self):
+        self.batch.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_checks_objects(self):
+        self.assertEqual(self.batch.check('master'), (self.commit, 'commit'))
+        self.assertEqual(self.batch.check('master:file')[1], 'blob')
+
+    def test_reads_objects(self):
+        sha1, kind, contents = self.batch.read('master:file')
+        self.assertEqual(kind, 'blob')
+        self.assertEqual(contents, 'first line\nsecond line\n')
+
+    def test_answers_many_queries(self):
+        for i in xrange(3):
+            self.assertEqual(self.batch.read('master:file')[2],
+                             'first line\nsecond line\n')
+            self.assertEqual(self.batch.check('master')[0], self.commit)
+
+    def test_returns_none_for_missing_objects(self):
+        self.assertEqual(self.batch.check('no-such-ref'), None)
+        self.assertEqual(self.batch.read('master:no-such-file'), None)
+        self.assertEqual(self.batch.read('master'.ljust(40, '0')), None)
+
+    def test_rejects_names_with_newlines(self):
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.check, 'master\nmaster')
+
+    def test_restarts_after_close(self):
+        self.batch.check('master')
+        self.batch.close()
+        self.assertEqual(self.batch.check('master')[0], self.commit)
+
+    def test_reports_processes_that_cannot_start(self):
+        batch = morphlib.gitbatch.CatFileBatch(
+            os.path.join(self.tempdir, 'missing'))
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          batch.check, 'master')
+
+    def test_reports_and_restarts_process_that_died(self):
+        self.batch.check('master')
+        process = self.batch._processes['--batch-check']
+        process.kill()
+        process.wait()
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.check, 'master')
+        self.assertEqual(self.batch.check('master')[0], self.commit)
+
+    def test_stops_process_whose_input_is_broken(self):
+        process = FakeProcess('')
+        process.stdin = BrokenPipe()
+        self.batch._processes['--batch-check'] = process
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.check, 'master')
+        self.assertEqual(self.batch._processes, {})
+
+    def test_reports_contents_that_cannot_be_read(self):
+        self.batch._processes['--batch'] = FakeProcess(
+            '%s blob 10\n' % self.commit, BrokenOutput)
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.read, 'master:file')
+        self.assertEqual(self.batch._processes, {})
+
+    def test_reports_short_contents(self):
+        self.batch._processes['--batch'] = FakeProcess(
+            '%s blob 10\nshort' % self.commit)
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.read, 'master:file')
+        self.assertEqual(self.batch._processes, {})
+
+    def test_reports_unexpected_output(self):
+        self.batch._processes['--batch-check'] = FakeProcess('garbage\n')
+        self.assertRaises(morphlib.gitbatch.CatFileBatchError,
+                          self.batch.check, 'master')
+        self.assertEqual(self.batch._processes, {})
+
+    def test_stops_processes_of_all_instances(self):
+        self.batch.check('master')
+        morphlib.gitbatch.close_all()
+        self.assertEqual(self.batch._processes, {})
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2015  Codethink Limited
+# Copyright (C) 2013-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,6 +18,7 @@
 
 import cliapp
 import itertools
+import logging
 import os
 import re
 
@@ -367,13 +368,18 @@ class GitDirectory(object):
 
     '''
 
-    def __init__(self, dirname, search_for_root=False):
+    def __init__(self, dirname, search_for_root=False, batch=False):
         '''Set up a GitDirectory instance for the repository at 'dirname'.
 
         If 'search_for_root' is set to True, 'dirname' may point to a
         subdirectory inside the working tree of repository. Otherwise 'dirname'
         must be the top directory.
 
+        If 'batch' is set to True, refs are resolved and objects are read
+        through long-lived `git cat-file` processes, rather than by running
+        git for each of them. Only use this for repositories which are not
+        changed other than through this instance.
+
         '''
 
         if search_for_root:
@@ -384,6 +390,30 @@ class GitDirectory(object):
 
         self._ensure_is_git_repo()
 
+        self._batch = None
+        if batch:
+            self._batch = morphlib.gitbatch.CatFileBatch(dirname)
+
+    def close(self):
+        '''Stop any long-lived git processes for this repository.'''
+
+        if self._batch is not None:
+            self._batch.close()
+
+    def _batch_query(self, method, name):
+        # Returns None if the object does not exist, and False if there is
+        # no cat-file process to ask, in which case the caller should run
+        # git as usual.
+        if self._batch is None:
+            return False
+        try:
+            return getattr(self._batch, method)(name)
+        except morphlib.gitbatch.CatFileBatchError as e:
+            logging.warning('%s: running git for each query instead' % e)
+            self._batch.close()
+            self._batch = None
+            return False
+
     def _runcmd(self, argv, **kwargs):
         '''Run a command at the root of the git directory.
 
@@ -408,6 +438,7 @@ class GitDirectory(object):
 
     def checkout(self, branch_name): # pragma: no cover
         '''Check out a git branch.'''
+        self.close()
         morphlib.git.gitcmd(self._runcmd, 'checkout', branch_name)
         if self.has_fat():
             self.fat_init()
@@ -425,6 +456,7 @@ class GitDirectory(object):
         argv = ['branch', new_branch_name]
         if base_ref is not None:
             argv.append(base_ref)
+        self.close()
         morphlib.git.gitcmd(self._runcmd, *argv)
 
     def is_currently_checked_out(self, ref): # pragma: no cover
@@ -460,12 +492,20 @@ class GitDirectory(object):
 
     def get_blob_contents(self, blob_id): # pragma: no cover
         '''Get file contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob', blob_id)
+        return self._cat_file('blob', blob_id)
 
     def get_commit_contents(self, commit_id): # pragma: no cover
         '''Get commit contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'commit',
-                                   commit_id)
+        return self._cat_file('commit', commit_id)
+
+    def _cat_file(self, kind, name):
+        found = self._batch_query('read', name)
+        if found is False:
+            return morphlib.git.gitcmd(self._runcmd, 'cat-file', kind, name)
+        if found is None or found[1] != kind:
+            raise cliapp.AppException('%s is not a %s in %s' %
+                                      (name, kind, self))
+        return found[2]
 
     def update_submodules(self, app): # pragma: no cover
         '''Change .gitmodules URLs, and checkout submodules.'''
@@ -506,6 +546,7 @@ class GitDirectory(object):
 
     def update_remotes(self, echo_stderr=False): # pragma: no cover
         '''Run "git remote update --prune".'''
+        self.close()
         morphlib.git.gitcmd(self._runcmd, 'remote', 'update', '--prune',
                             echo_stderr=echo_stderr)
 
@@ -531,6 +572,11 @@ class GitDirectory(object):
             return self._list_files_in_ref(ref, recurse)
 
     def _rev_parse(self, ref):
+        found = self._batch_query('check', ref)
+        if found is None:
+            raise InvalidRefError(self, ref)
+        elif found is not False:
+            return found[0]
         try:
             return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
                                        '--verify', ref).strip()
@@ -592,6 +638,11 @@ class GitDirectory(object):
     def _list_files_in_ref(self, ref, recurse=True):
         tree = self.resolve_ref_to_tree(ref)
 
+        if self._batch is not None:
+            paths = self._list_files_in_tree(tree, recurse)
+            if paths is not None:
+                return paths
+
         command = ['ls-tree', '--name-only', '-z']
         if recurse:
             command.append('-r')
@@ -603,6 +654,84 @@ class GitDirectory(object):
         paths = output.strip('\0').split('\0')
         return paths
 
+    def _list_files_in_tree(self, tree, recurse, prefix=''):
+        # List files like `git ls-tree --name-only`, by reading the tree
+        # objects through the cat-file process. Returns None if that fails.
+        entries = self._read_tree(tree)
+        if entries is None or entries is False:
+            return None
+        paths = []
+        for mode, name, sha1 in entries:
+            path = prefix + name
+            if recurse and mode == '040000':
+                subpaths = self._list_files_in_tree(sha1, recurse,
+                                                    path + '/')
+                if subpaths is None:
+                    return None
+                paths.extend(subpaths)
+            else:
+                paths.append(path)
+        return paths
+
+    def _read_tree(self, tree):
+        # Return the (mode, name, sha1) entries of a tree object read by
+        # the cat-file process, None if there is no such tree, or False
+        # if there is no cat-file process to read it with.
+        found = self._batch_query('read', tree)
+        if not found:
+            return found
+        sha1, kind, data = found
+        if kind != 'tree':
+            return None
+        entries = []
+        start = 0
+        while start < len(data):
+            space = data.index(' ', start)
+            nul = data.index('\0', space)
+            mode = data[start:space].zfill(6)
+            name = data[space+1:nul]
+            sha1 = data[nul+1:nul+21].encode('hex')
+            entries.append((mode, name, sha1))
+            start = nul + 21
+        return entries
+
+    def get_tree_entry(self, ref, path):
+        '''Return the (mode, type, sha1) of a path in the tree of a ref.
+
+        This is what `git ls-tree ref path` shows for it. Returns None if
+        there is no such path. Raises an InvalidRefError if the ref is not
+        found in the repository.
+
+        '''
+
+        path = path.strip('/')
+        parent, name = os.path.split(path)
+        if parent:
+            parent_tree = '%s:%s' % (ref, parent)
+        else:
+            parent_tree = '%s^{tree}' % ref
+        entries = self._read_tree(parent_tree)
+        if entries is False:
+            tree = self.resolve_ref_to_tree(ref)
+            output = morphlib.git.gitcmd(self._runcmd, 'ls-tree', tree, path)
+            for line in output.splitlines():
+                info, entry_path = line.split('\t', 1)
+                if entry_path == path:
+                    return tuple(info.split())
+            return None
+        if entries is None:
+            if parent:
+                # As with ls-tree, a path below a missing directory is
+                # simply not there, as long as the ref exists.
+                self.resolve_ref_to_tree(ref)
+                return None
+            raise InvalidRefError(self, ref)
+        for mode, entry_name, sha1 in entries:
+            if entry_name == name:
+                kinds = {'040000': 'tree', '160000': 'commit'}
+                return mode, kinds.get(mode, 'blob'), sha1
+        return None
+
     def read_file(self, filename, ref=None):
         '''Attempts to read a file, from the working tree or a given ref.
 
@@ -629,10 +758,8 @@ class GitDirectory(object):
         if ref is None:
             filepath = os.path.join(self.dirname, filename.lstrip('/'))
             return os.path.islink(filepath)
-        tree_entry = morphlib.git.gitcmd(self._runcmd, 'ls-tree', ref,
-                                         filename)
-        file_mode = tree_entry.split(' ', 1)[0]
-        return file_mode == '120000'
+        tree_entry = self.get_tree_entry(ref, filename)
+        return tree_entry is not None and tree_entry[0] == '120000'
 
     @property
     def HEAD(self):
@@ -690,6 +817,7 @@ class GitDirectory(object):
         if message is not None: # pragma: no cover
             args.extend(('-m', message))
         args.extend(ref_args)
+        self.close()
         morphlib.git.gitcmd(self._runcmd, *args)
 
     def add_ref(self, ref, sha1, message=None):
@@ -760,6 +888,7 @@ class GitDirectory(object):
         return morphlib.git.gitcmd(self._runcmd, 'fat', 'push')
 
     def fat_pull(self): # pragma: no cover
+        self.close()
         return morphlib.git.gitcmd(self._runcmd, 'fat', 'pull')
 
     def has_fat(self): # pragma: no cover
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -304,6 +304,103 @@ class GitDirectoryFileTypeTests(unittest.TestCase):
                           gd.is_symlink, 'file')
 
 
+class GitDirectoryBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'foo')
+        os.makedirs(os.path.join(self.dirname, 'dir', 'subdir'))
+        gd = morphlib.gitdir.init(self.dirname)
+        for fn in ('file', 'dir/file', 'dir/subdir/file'):
+            with open(os.path.join(self.dirname, fn), 'w') as f:
+                f.write('text of %s' % fn)
+        os.symlink('file', os.path.join(self.dirname, 'dir', 'link'))
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.plain = morphlib.gitdir.GitDirectory(self.dirname)
+        self.batch = morphlib.gitdir.GitDirectory(self.dirname, batch=True)
+
+    def tearDown(self):
+        self.batch.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_resolves_refs_like_plain_git(self):
+        self.assertEqual(self.batch.resolve_ref_to_commit('master'),
+                         self.plain.resolve_ref_to_commit('master'))
+        self.assertEqual(self.batch.resolve_ref_to_tree('master'),
+                         self.plain.resolve_ref_to_tree('master'))
+
+    def test_raises_invalid_ref(self):
+        self.assertRaises(morphlib.gitdir.InvalidRefError,
+                          self.batch.resolve_ref_to_commit, 'no-such-ref')
+        self.assertRaises(morphlib.gitdir.InvalidRefError,
+                          self.batch.list_files, 'no-such-ref')
+
+    def test_lists_files_like_plain_git(self):
+        for recurse in (True, False):
+            self.assertEqual(self.batch.list_files('master', recurse),
+                             self.plain.list_files('master', recurse))
+
+    def test_reads_files(self):
+        self.assertEqual(self.batch.read_file('dir/subdir/file', 'master'),
+                         'text of dir/subdir/file')
+        self.assertRaises(IOError, self.batch.read_file, 'dir/missing',
+                          'master')
+
+    def test_gets_tree_entries_like_plain_git(self):
+        for path in ('file', 'dir', 'dir/link', 'dir/subdir/file',
+                     'missing', 'dir/missing', 'missing/file', 'file/x'):
+            self.assertEqual(self.batch.get_tree_entry('master', path),
+                             self.plain.get_tree_entry('master', path))
+        self.assertTrue(self.batch.is_symlink('dir/link', 'master'))
+        self.assertFalse(self.batch.is_symlink('dir/file', 'master'))
+
+    def test_sees_refs_changed_through_gitdir(self):
+        commit = self.batch.resolve_ref_to_commit('master')
+        self.batch.add_ref('refs/heads/other', commit)
+        self.assertEqual(self.batch.resolve_ref_to_commit('other'), commit)
+
+    def test_raises_invalid_ref_for_tree_entries(self):
+        for gd in (self.plain, self.batch):
+            for path in ('file', 'dir/file'):
+                self.assertRaises(morphlib.gitdir.InvalidRefError,
+                                  gd.get_tree_entry, 'no-such-ref', path)
+
+    def fail_reads_after(self, count):
+        read = self.batch._batch.read
+        calls = []
+
+        def fail(name):
+            calls.append(name)
+            if len(calls) > count:
+                raise morphlib.gitbatch.CatFileBatchError(self.dirname,
+                                                          'broken')
+            return read(name)
+        self.batch._batch.read = fail
+
+    def test_lists_files_if_batch_fails_partway(self):
+        for count in xrange(3):
+            self.batch.close()
+            self.batch = morphlib.gitdir.GitDirectory(self.dirname,
+                                                      batch=True)
+            self.fail_reads_after(count)
+            self.assertEqual(self.batch.list_files('master'),
+                             self.plain.list_files('master'))
+            self.assertEqual(self.batch._batch, None)
+
+    def test_gets_tree_entries_if_batch_fails(self):
+        self.fail_reads_after(0)
+        self.assertEqual(self.batch.get_tree_entry('master', 'dir/file'),
+                         self.plain.get_tree_entry('master', 'dir/file'))
+
+    def test_falls_back_to_plain_git_if_batch_fails(self):
+        def fail(name):
+            raise morphlib.gitbatch.CatFileBatchError(self.dirname, 'broken')
+        self.batch._batch.check = fail
+        self.assertEqual(self.batch.resolve_ref_to_commit('master'),
+                         self.plain.resolve_ref_to_commit('master'))
+
+
 class GitDirectoryRefTwiddlingTests(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,283 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+
+import morphlib
+
+
+class GraphCache(object):
+
+    '''Remember resolved build graphs between runs of morph.
+
+    Resolving the sources of a system, resolving its artifacts and
+    computing their cache keys only depends on the commit of definitions
+    the system comes from, and on the commits that the named refs of its
+    chunks point to. This stores the resolved graph, reachable from the
+    root artifact, in a directory, keyed by the former. When it is looked
+    up again, only the named refs are resolved again to check that the
+    graph is still valid.
+
+    The graph is stored as flat lists of sources and artifacts that refer
+    to each other by index, so that neither storing nor loading it
+    recurses along long chains of dependencies.
+
+    At most ``max_entries`` graphs are kept; the least recently used ones
+    are removed when a new one is stored.
+
+    '''
+
+    # Change this when the stored format or the contents of Source or
+    # Artifact objects change.
+    format_version = 1
+
+    def __init__(self, dirname, max_entries=20):
+        self.dirname = dirname
+        self.max_entries = max_entries
+
+    def key(self, repo_name, sha1, filename, original_ref):
+        '''Return the key for a system at a commit of definitions.'''
+
+        # Graphs from another version of morph may have been resolved, or
+        # had their cache keys computed, differently.
+        version = morphlib.gitversion.version
+        return hashlib.sha1(repr((self.format_version, version, repo_name,
+                                  sha1, filename, original_ref))).hexdigest()
+
+    def get(self, key, resolve_refs):
+        '''Return the root artifact of a stored graph, or None.
+
+        ``resolve_refs`` is called with the (repo_name, ref) pairs of the
+        named refs of chunks in the graph, and returns a dict mapping them
+        to (commit, tree) pairs, like SourceResolver.resolve_refs. The
+        graph is only returned if they all still resolve to the commits
+        they did when it was stored.
+
+        '''
+
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                encoded = cPickle.load(f)
+        except (IOError, EOFError):
+            return None
+        except Exception, e:
+            logging.warning('Ignoring unreadable graph cache entry %s: %s' %
+                            (filename, e))
+            return None
+        if (not isinstance(encoded, dict) or
+                encoded.get('format-version') != self.format_version):
+            # Written by another version of morph, or not a graph at all.
+            return None
+
+        named_refs = encoded['named-refs']
+        if named_refs:
+            try:
+                resolved = resolve_refs([(r, ref)
+                                         for r, ref, c in named_refs])
+            except Exception, e:
+                # Resolving the graph from scratch reports this properly.
+                logging.debug('Could not validate graph cache entry %s: %s' %
+                              (key, e))
+                return None
+            for repo_name, ref, commit in named_refs:
+                if resolved[repo_name, ref][0] != commit:
+                    logging.debug('Graph cache entry %s is out of date: %s '
+                                  '%s has moved' % (key, repo_name, ref))
+                    return None
+
+        os.utime(filename, None)
+        return decode_graph(encoded)
+
+    def put(self, key, root_artifact):
+        '''Store the graph of a root artifact.
+
+        The cache only saves time, so if the graph cannot be written, for
+        example because the disk is full, a warning is logged instead of
+        failing the build.
+
+        '''
+
+        encoded = encode_graph(root_artifact)
+        encoded['format-version'] = self.format_version
+        try:
+            if not os.path.exists(self.dirname):
+                os.makedirs(self.dirname)
+            fd, tempname = tempfile.mkstemp(dir=self.dirname)
+        except EnvironmentError, e:
+            logging.warning('Could not store graph cache entry %s: %s' %
+                            (key, e))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(encoded, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tempname, self._filename(key))
+        except BaseException, e:
+            os.remove(tempname)
+            if not isinstance(e, EnvironmentError):
+                raise
+            logging.warning('Could not store graph cache entry %s: %s' %
+                            (key, e))
+            return
+        self._remove_old_entries()
+
+    def _filename(self, key):
+        return os.path.join(self.dirname, key + '.graph')
+
+    def _remove_old_entries(self):
+        entries = []
+        for name in os.listdir(self.dirname):
+            if name.endswith('.graph'):
+                path = os.path.join(self.dirname, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for mtime, path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def walk_graph(root_artifact):
+    '''Return the sources and artifacts in the graph of a root artifact.
+
+    This is everything reachable from the root artifact: its sources,
+    their dependencies and artifacts, and the sources which depend on
+    those artifacts.
+
+    '''
+
+    sources = []
+    artifacts = []
+    seen = set()
+    todo = [root_artifact.source]
+    while todo:
+        source = todo.pop()
+        if source in seen:
+            continue
+        seen.add(source)
+        sources.append(source)
+        for artifact in (source.artifacts.values() + source.dependencies):
+            if artifact not in seen:
+                seen.add(artifact)
+                artifacts.append(artifact)
+                todo.append(artifact.source)
+                todo.extend(artifact.dependents)
+    return sources, artifacts
+
+
+def encode_graph(root_artifact):
+    '''Encode the graph of a root artifact as plain data.'''
+
+    sources, artifacts = walk_graph(root_artifact)
+    source_ids = dict((s, i) for i, s in enumerate(sources))
+    artifact_ids = dict((a, i) for i, a in enumerate(artifacts))
+
+    morphologies = []
+    morphology_ids = {}
+    encoded_sources = []
+    named_refs = set()
+    for source in sources:
+        morphology = source.morphology
+        if id(morphology) not in morphology_ids:
+            morphology_ids[id(morphology)] = len(morphologies)
+            morphologies.append((dict(morphology), morphology.repo_url,
+                                 morphology.ref, morphology.filename,
+                                 morphology.dirty))
+        optional = dict((attr, getattr(source, attr))
+                        for attr in ('build_mode', 'prefix')
+                        if hasattr(source, attr))
+        encoded_sources.append({
+            'name': source.name,
+            'repo_name': source.repo_name,
+            'original_ref': source.original_ref,
+            'sha1': source.sha1,
+            'tree': source.tree,
+            'morphology': morphology_ids[id(morphology)],
+            'filename': source.filename,
+            'cache_id': source.cache_id,
+            'cache_key': source.cache_key,
+            'artifacts': [artifact_ids[a]
+                          for a in source.artifacts.itervalues()],
+            'dependencies': [artifact_ids[a] for a in source.dependencies],
+            'optional': optional,
+        })
+        if (morphology['kind'] == 'chunk' and
+                not morphlib.git.is_valid_sha1(source.original_ref)):
+            named_refs.add((source.repo_name, source.original_ref,
+                            source.sha1))
+
+    encoded_artifacts = [(source_ids[a.source], a.name,
+                          [source_ids[s] for s in a.dependents])
+                         for a in artifacts]
+
+    return {
+        'morphologies': morphologies,
+        'sources': encoded_sources,
+        'artifacts': encoded_artifacts,
+        'root-artifact': artifact_ids[root_artifact],
+        'named-refs': sorted(named_refs),
+    }
+
+
+def decode_graph(encoded):
+    '''Re-create the artifacts of an encoded graph, returning the root.'''
+
+    morphologies = []
+    split_rules = []
+    for data, repo_url, ref, filename, dirty in encoded['morphologies']:
+        morphology = morphlib.morphology.Morphology(data)
+        morphology.repo_url = repo_url
+        morphology.ref = ref
+        morphology.filename = filename
+        morphology.dirty = dirty
+        morphologies.append(morphology)
+        # As in morphlib.source.make_sources
+        unifier = getattr(morphlib.artifactsplitrule,
+                          'unify_%s_matches' % morphology['kind'])
+        split_rules.append(unifier(morphology))
+
+    sources = []
+    for info in encoded['sources']:
+        source = morphlib.source.Source(
+            info['name'], info['repo_name'], info['original_ref'],
+            info['sha1'], info['tree'], morphologies[info['morphology']],
+            info['filename'], split_rules[info['morphology']])
+        source.cache_id = info['cache_id']
+        source.cache_key = info['cache_key']
+        for attr, value in info['optional'].iteritems():
+            setattr(source, attr, value)
+        sources.append(source)
+
+    artifacts = [morphlib.artifact.Artifact(sources[source_id], name)
+                 for source_id, name, dependents in encoded['artifacts']]
+    for artifact, (source_id, name, dependents) in zip(
+            artifacts, encoded['artifacts']):
+        artifact.dependents = [sources[i] for i in dependents]
+
+    for source, info in zip(sources, encoded['sources']):
+        source.artifacts = dict((artifacts[i].name, artifacts[i])
+                                for i in info['artifacts'])
+        source.dependencies = [artifacts[i] for i in info['dependencies']]
+
+    return artifacts[encoded['root-artifact']]
@@ -0,0 +1,194 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class GraphCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.graphcache.GraphCache(self.tempdir,
+                                                    max_entries=2)
+        self.root = self.make_graph()
+        self.resolved = {('repo', 'master'): ('chunk-sha1', 'tree')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_sources(self, text, repo, ref, sha1):
+        loader = morphlib.morphloader.MorphologyLoader()
+        morphology = loader.load_from_string(text)
+        filename = '%s.morph' % morphology['name']
+        return list(morphlib.source.make_sources(repo, ref, filename, sha1,
+                                                 'tree', morphology))
+
+    def make_graph(self):
+        chunks = []
+        for name, ref, sha1 in (('a', 'master', 'chunk-sha1'),
+                                ('b', 'f' * 40, 'f' * 40)):
+            source, = self.make_sources(
+                'name: %s\nkind: chunk\nbuild-system: manual\n' % name,
+                'repo', ref, sha1)
+            source.build_mode = 'staging'
+            source.prefix = '/usr'
+            chunks.append(source)
+        chunks[1].add_dependency(chunks[0].artifacts['a-libs'])
+
+        strata = self.make_sources(
+            'name: s\nkind: stratum\nbuild-depends: []\n'
+            'chunks:\n'
+            '- {name: a, repo: repo, ref: master, build-depends: []}\n'
+            '- {name: b, repo: repo, ref: %s, build-depends: [a]}\n'
+            % ('f' * 40), 'definitions', 'master', 'definitions-sha1')
+        for stratum in strata:
+            for chunk in chunks:
+                for artifact in chunk.artifacts.itervalues():
+                    stratum.add_dependency(artifact)
+        for source in chunks + strata:
+            source.cache_key = '%s-key' % source.name
+            source.cache_id = {'name': source.name}
+        return strata[0].artifacts.values()[0]
+
+    def resolve_refs(self, pairs):
+        self.asked = pairs
+        return self.resolved
+
+    def graph_summary(self, root):
+        sources, artifacts = morphlib.graphcache.walk_graph(root)
+        return sorted((s.name, s.sha1, s.cache_key,
+                       sorted(a.name for a in s.artifacts.itervalues()),
+                       sorted(str(a) for a in s.dependencies),
+                       getattr(s, 'prefix', None))
+                      for s in sources)
+
+    def test_returns_none_for_unknown_graph(self):
+        self.assertEqual(self.cache.get('key', self.resolve_refs), None)
+
+    def test_returns_stored_graph(self):
+        self.cache.put('key', self.root)
+        root = self.cache.get('key', self.resolve_refs)
+        self.assertEqual(str(root), str(self.root))
+        self.assertEqual(self.graph_summary(root),
+                         self.graph_summary(self.root))
+        self.assertEqual([str(a) for a in root.walk()],
+                         [str(a) for a in self.root.walk()])
+
+    def test_keeps_dependents(self):
+        self.cache.put('key', self.root)
+        root = self.cache.get('key', self.resolve_refs)
+        chunk = root.source.dependencies[0].source
+        self.assertTrue(all(root.source in a.dependents
+                            for a in root.source.dependencies))
+        self.assertEqual(chunk.morphology['kind'], 'chunk')
+
+    def test_only_validates_named_chunk_refs(self):
+        self.cache.put('key', self.root)
+        self.cache.get('key', self.resolve_refs)
+        self.assertEqual(self.asked, [('repo', 'master')])
+
+    def test_misses_when_named_ref_has_moved(self):
+        self.cache.put('key', self.root)
+        self.resolved = {('repo', 'master'): ('new-sha1', 'tree')}
+        self.assertEqual(self.cache.get('key', self.resolve_refs), None)
+
+    def test_misses_when_named_ref_cannot_be_resolved(self):
+        def fail(pairs):
+            raise morphlib.Error('no such ref')
+        self.cache.put('key', self.root)
+        self.assertEqual(self.cache.get('key', fail), None)
+
+    def test_ignores_corrupt_entries(self):
+        with open(os.path.join(self.tempdir, 'key.graph'), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.cache.get('key', self.resolve_refs), None)
+
+    def test_ignores_entries_that_are_not_graphs(self):
+        with open(os.path.join(self.tempdir, 'key.graph'), 'wb') as f:
+            cPickle.dump(['not', 'a', 'graph'], f)
+        self.assertEqual(self.cache.get('key', self.resolve_refs), None)
+
+    def test_ignores_entries_of_other_format_versions(self):
+        self.cache.put('key', self.root)
+        self.cache.format_version += 1
+        self.assertEqual(self.cache.get('key', self.resolve_refs), None)
+
+    def test_makes_missing_directory(self):
+        dirname = os.path.join(self.tempdir, 'more', 'graphs')
+        cache = morphlib.graphcache.GraphCache(dirname)
+        cache.put('key', self.root)
+        self.assertEqual(str(cache.get('key', self.resolve_refs)),
+                         str(self.root))
+
+    def test_warns_if_directory_cannot_be_made(self):
+        filename = os.path.join(self.tempdir, 'file')
+        with open(filename, 'w'):
+            pass
+        cache = morphlib.graphcache.GraphCache(
+            os.path.join(filename, 'graphs'))
+        cache.put('key', self.root)
+        self.assertEqual(cache.get('key', self.resolve_refs), None)
+
+    def fail_rename(self, exception):
+        def rename(old, new):
+            raise exception
+        self.addCleanup(setattr, os, 'rename', os.rename)
+        os.rename = rename
+
+    def test_removes_temporary_file_if_entry_cannot_be_written(self):
+        self.fail_rename(OSError(errno.ENOSPC, 'No space left on device'))
+        self.cache.put('key', self.root)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_removes_temporary_file_if_interrupted(self):
+        self.fail_rename(KeyboardInterrupt())
+        self.assertRaises(KeyboardInterrupt, self.cache.put, 'key', self.root)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_skips_entries_removed_meanwhile(self):
+        self.cache.put('key', self.root)
+        os.symlink('missing', os.path.join(self.tempdir, 'gone.graph'))
+        remove = os.remove
+
+        def fail_remove(path):
+            raise OSError(errno.ENOENT, 'No such file or directory')
+        self.addCleanup(setattr, os, 'remove', remove)
+        os.remove = fail_remove
+        self.cache.max_entries = 0
+        self.cache._remove_old_entries()
+        os.remove = remove
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['gone.graph', 'key.graph'])
+
+    def test_removes_least_recently_used_entries(self):
+        for i, key in enumerate(('one', 'two', 'three')):
+            self.cache.put(key, self.root)
+            os.utime(os.path.join(self.tempdir, '%s.graph' % key), (i, i))
+            self.cache._remove_old_entries()
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['three.graph', 'two.graph'])
+
+    def test_keys_differ_for_different_commits(self):
+        self.assertNotEqual(
+            self.cache.key('definitions', 'sha1', 'system.morph', 'master'),
+            self.cache.key('definitions', 'sha2', 'system.morph', 'master'))
@@ -0,0 +1,286 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import base64
+import httplib
+import logging
+import socket
+import StringIO
+import threading
+import urllib
+import urllib2
+import urlparse
+
+
+class HTTPConnectionPool(object):
+
+    '''Reuse HTTP/1.1 connections for requests to the same server.
+
+    ``urllib2.urlopen`` opens a new connection for every request, which
+    costs a round trip or more per request to a server far away. This
+    keeps up to ``max_per_host`` idle connections to each server open,
+    and uses them for later requests. More connections than that are
+    opened if needed, and closed again once their response is read.
+
+    A kept-alive connection may have been closed by the server in the
+    meantime, so a request which fails on a reused connection is retried
+    once on a new one. Only idempotent requests are retried, as the
+    server may have acted on the first attempt; the others are always
+    sent on a new connection.
+
+    Responses behave like those of ``urllib2.urlopen``: unsuccessful
+    requests raise ``urllib2.HTTPError``, and failures to connect raise
+    ``urllib2.URLError``. Redirects are followed for GET and HEAD
+    requests, and proxies are used as set in the environment, for
+    example in ``http_proxy`` and ``no_proxy``. A connection only goes
+    back to the pool once its response has been read to the end, or
+    closed.
+
+    The pool may be shared between threads.
+
+    '''
+
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    idempotent_methods = frozenset(
+        ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+    redirect_codes = frozenset([301, 302, 303, 307])
+
+    # As in urllib2.HTTPRedirectHandler.
+    max_redirects = 10
+
+    def __init__(self, max_per_host=4, timeout=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.connections_opened = 0
+        self.requests_served = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers={}):
+        '''Make a request, returning a file-like response object.'''
+
+        for i in xrange(self.max_redirects + 1):
+            pooled = self._request(method, url, body, headers)
+            location = pooled.headers.get('location')
+            if (pooled.code not in self.redirect_codes or
+                    method not in ('GET', 'HEAD') or location is None):
+                break
+            # Read the body, so that the connection can be reused.
+            pooled.read()
+            pooled.close()
+            url = urlparse.urljoin(url, location)
+        else:
+            raise urllib2.HTTPError(url, pooled.code,
+                                    'Too many redirects',
+                                    pooled.headers, StringIO.StringIO())
+
+        if not 200 <= pooled.code < 300:
+            data = pooled.read()
+            pooled.close()
+            raise urllib2.HTTPError(url, pooled.code, pooled.msg,
+                                    pooled.headers, StringIO.StringIO(data))
+        return pooled
+
+    def _request(self, method, url, body, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in self.connection_classes:
+            raise urllib2.URLError('unsupported URL scheme %s' % parts.scheme)
+        proxy = self._proxy(parts.scheme, parts.netloc)
+        key = (parts.scheme, parts.netloc, proxy)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+        if proxy is not None and parts.scheme == 'http':
+            # Plain HTTP proxies are asked for the whole URL. HTTPS goes
+            # through a tunnel, set up when connecting.
+            path = parts.scheme + '://' + parts.netloc + path
+            headers = dict(headers)
+            headers.update(_parse_proxy(proxy)[1])
+
+        if method in self.idempotent_methods:
+            conn, reused = self._get_connection(key)
+        else:
+            conn, reused = self._new_connection(key), False
+        try:
+            response = self._send(conn, method, path, body, headers)
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            if not reused:
+                raise urllib2.URLError(e)
+            logging.debug('Kept-alive connection to %s failed, '
+                          'retrying with a new one: %s' % (parts.netloc, e))
+            conn, reused = self._new_connection(key), False
+            try:
+                response = self._send(conn, method, path, body, headers)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        with self._lock:
+            self.requests_served += 1
+
+        return PooledResponse(self, key, conn, response, url)
+
+    def stats(self):
+        '''Return counters of connections opened and requests served.'''
+
+        with self._lock:
+            return {
+                'connections-opened': self.connections_opened,
+                'requests-served': self.requests_served,
+            }
+
+    def close(self):
+        '''Close all idle connections.'''
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def _get_connection(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self._new_connection(key), False
+
+    def _proxy(self, scheme, netloc):
+        '''Return the URL of the proxy to use for a server, or None.'''
+
+        proxy = urllib.getproxies().get(scheme)
+        if proxy is None or urllib.proxy_bypass(netloc):
+            return None
+        return proxy
+
+    def _new_connection(self, key):
+        scheme, netloc, proxy = key
+        conn_class = self.connection_classes[scheme]
+        host = netloc
+        if proxy is not None:
+            host, proxy_headers = _parse_proxy(proxy)
+        if self.timeout is None:
+            conn = conn_class(host)
+        else:
+            conn = conn_class(host, timeout=self.timeout)
+        if proxy is not None and scheme == 'https':
+            conn.set_tunnel(netloc, headers=proxy_headers)
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+def _parse_proxy(proxy):
+    '''Return the host and port of a proxy, and the headers it needs.
+
+    The proxy is given as a URL, or as just a host and port, as in
+    ``http_proxy``.
+
+    '''
+
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parts = urlparse.urlsplit(proxy)
+    userinfo, at, hostport = parts.netloc.rpartition('@')
+    headers = {}
+    if at:
+        headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+            urllib.unquote(userinfo))
+    return hostport, headers
+
+
+class PooledResponse(object):
+
+    '''The response to a request made through an HTTPConnectionPool.'''
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        if response.length == 0:
+            # Nothing to read, as for HEAD requests, so we are done with
+            # the connection already.
+            response.read()
+            self._release()
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        if self._response.isclosed():
+            if self._response.length:
+                # The server closed the connection before sending all of
+                # the body, which httplib only says when reading all of it
+                # at once.
+                self.close()
+                raise httplib.IncompleteRead(data, self._response.length)
+            self._release()
+        return data
+
+    def close(self):
+        if self._response.isclosed() and not self._response.length:
+            self._release()
+        elif self._conn is not None:
+            # The rest of the response is unread, so the connection can't
+            # be used for anything else.
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self._url
+
+    def info(self):
+        return self.headers
+
+    def _release(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._response.will_close:
+            conn.close()
+        else:
+            self._pool._release(self._key, conn)
+
+
+# Shared by all the remote caches.
+default_pool = HTTPConnectionPool()
@@ -0,0 +1,275 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import select
+import shutil
+import tempfile
+import threading
+
+
+class JobServer(object):
+
+    '''A GNU make jobserver shared by every build on this host.
+
+    GNU make limits the number of jobs run by a tree of make processes by
+    passing around tokens in a pipe: a make has to read a token from the
+    pipe before it starts a job and writes it back once the job is done.
+    Sharing one such pipe between all concurrent chunk builds keeps the
+    total number of jobs within one budget, rather than every chunk
+    running its own ``-jN``.
+
+    The pipe is a FIFO in ``dirname``, so separate morph processes on the
+    same host (such as concurrent ``morph worker-build`` processes) share
+    it too. Every user holds a shared lock on a lock file next to it. The
+    first user, the one that can take the lock exclusively, fills the FIFO
+    with ``jobs - 1`` tokens; each top-level make runs one job without a
+    token, as usual for make.
+
+    Commands get the pipe as file descriptors ``fds``, which are opened
+    by a shell wrapper around the command. They cannot simply be inherited
+    from morph, since ``cliapp.runcmd`` closes all other file descriptors
+    in the child process.
+
+    A make that dies while it holds tokens never writes them back, so a
+    command is not given the shared FIFO itself, but one of its own, to
+    which morph lends tokens while the command runs; see ``lend``.
+
+    '''
+
+    # The shell only allows redirecting single digit file descriptors.
+    fds = (8, 9)
+
+    def __init__(self, dirname, jobs):
+        self.fifo = os.path.join(dirname, 'jobserver')
+        self.jobs = max(jobs, 1)
+        self._lock_fd = None
+        self._fifo_fd = None
+        self._open_lock = threading.Lock()
+
+    def open(self):
+        '''Join the host's jobserver, starting it if nobody else has.'''
+
+        self._lock_fd = os.open(self.fifo + '.lock',
+                                os.O_RDWR | os.O_CREAT, 0644)
+        self._set_cloexec(self._lock_fd)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            self._open_fifo()
+            logging.debug('Joined jobserver %s' % self.fifo)
+        else:
+            if not os.path.exists(self.fifo):
+                os.mkfifo(self.fifo, 0600)
+            self._open_fifo()
+            self._fill()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            logging.debug('Started jobserver %s with %d jobs' %
+                          (self.fifo, self.jobs))
+
+    def close(self):
+        '''Leave the jobserver.'''
+
+        for fd in (self._fifo_fd, self._lock_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fifo_fd = self._lock_fd = None
+
+    def makeflags(self):
+        '''Return the MAKEFLAGS which make a make use the jobserver.'''
+
+        return ' --jobserver-fds=%d,%d -j' % self.fds
+
+    def wrap_command(self, argv, fifo=None):
+        '''Return a command line which runs argv with the jobserver fds.
+
+        The fds are opened on ``fifo``, as given by ``lend``, or on the
+        shared FIFO if it is None.
+
+        '''
+
+        script = 'exec %d<>"$0" %d<>"$0"; exec "$@"' % self.fds
+        return ['sh', '-c', script, fifo or self.fifo] + list(argv)
+
+    @contextlib.contextmanager
+    def lend(self):
+        '''Lend tokens to one command, and take them all back after it.
+
+        This is a context manager, which gives the FIFO to run the command
+        with. Every token lent to the command is put back into the shared
+        FIFO when the block ends, even those the command did not give
+        back, for example because it crashed.
+
+        The jobserver is joined first, if it is not yet, so that builds
+        which never run make in parallel never join it.
+
+        '''
+
+        with self._open_lock:
+            if self._lock_fd is None:
+                self.open()
+        lender = _TokenLender(self.fifo, self.jobs - 1)
+        lender.start()
+        try:
+            yield lender.fifo
+        finally:
+            lender.stop()
+
+    def _open_fifo(self):
+        # Opening for reading and writing does not block waiting for the
+        # other end, and keeps the tokens alive while we hold it open.
+        self._fifo_fd = os.open(self.fifo, os.O_RDWR)
+        self._set_cloexec(self._fifo_fd)
+
+    def _fill(self):
+        # Nobody else is using the jobserver, so throw away any tokens
+        # left behind by a previous user before putting ours in.
+        flags = fcntl.fcntl(self._fifo_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._fifo_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            while os.read(self._fifo_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        finally:
+            fcntl.fcntl(self._fifo_fd, fcntl.F_SETFL, flags)
+        os.write(self._fifo_fd, '+' * (self.jobs - 1))
+
+    @staticmethod
+    def _set_cloexec(fd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class _TokenLender(object):
+
+    '''Lend tokens from a jobserver to one command, through its own FIFO.
+
+    A thread keeps one token waiting in the command's FIFO, borrowing
+    another from the shared FIFO whenever the command takes it, and puts
+    back any more the command returns, so that the tokens the command
+    does not use are available to other builds. The number of tokens
+    borrowed is counted, so that they can all be put back when the
+    command is over.
+
+    When no token is waiting, the thread blocks until one can be
+    borrowed or the command gives one back. A FIFO tells nobody when a
+    token is read from it, though, so while one is waiting the thread
+    checks whether it was taken, soon after the last one was and then
+    less and less often.
+
+    '''
+
+    # The shortest and longest times, in seconds, between checks.
+    min_delay = 0.001
+    max_delay = 0.05
+
+    def __init__(self, shared_fifo, limit):
+        self.limit = limit
+        self.borrowed = 0
+        self.waiting = False
+        self.dirname = tempfile.mkdtemp(dir=os.path.dirname(shared_fifo),
+                                        prefix='.jobserver-')
+        self.fifo = os.path.join(self.dirname, 'jobserver')
+        os.mkfifo(self.fifo, 0600)
+        self._shared_fd = self._open(shared_fifo)
+        self._own_fd = self._open(self.fifo)
+        # Written to by stop, to wake the thread up.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = threading.Thread(target=self._run,
+                                        name='jobserver-lender')
+        self._thread.daemon = True
+
+    @staticmethod
+    def _open(fifo):
+        fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+        JobServer._set_cloexec(fd)
+        return fd
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        '''Stop lending, and put back every token borrowed.'''
+
+        os.write(self._wakeup_w, 'x')
+        self._thread.join()
+        try:
+            tokens = self._read(self._own_fd)
+            tokens += '+' * (self.borrowed - len(tokens))
+            os.write(self._shared_fd, tokens)
+            self.borrowed = 0
+        finally:
+            for fd in (self._shared_fd, self._own_fd,
+                       self._wakeup_r, self._wakeup_w):
+                os.close(fd)
+            shutil.rmtree(self.dirname)
+
+    def _run(self):
+        delay = self.min_delay
+        while True:
+            if not self.relay():
+                # Taking one token is often followed by taking more.
+                delay = self.min_delay
+            if self.waiting:
+                watched = [self._wakeup_r]
+                timeout = delay
+                delay = min(delay * 2, self.max_delay)
+            else:
+                watched = [self._wakeup_r, self._own_fd]
+                if self.borrowed < self.limit:
+                    watched.append(self._shared_fd)
+                timeout = None
+            if self._wakeup_r in select.select(watched, [], [], timeout)[0]:
+                return
+
+    def relay(self):
+        '''Leave exactly one token waiting for the command, if allowed.
+
+        Return whether a token was waiting already.
+
+        '''
+
+        waiting = self._read(self._own_fd)
+        was_waiting = bool(waiting)
+        if len(waiting) > 1:
+            os.write(self._shared_fd, waiting[1:])
+            self.borrowed -= len(waiting) - 1
+            waiting = waiting[:1]
+        elif not waiting and self.borrowed < self.limit:
+            waiting = self._read(self._shared_fd, 1)
+            self.borrowed += len(waiting)
+        if waiting:
+            os.write(self._own_fd, waiting)
+        self.waiting = bool(waiting)
+        return was_waiting
+
+    @staticmethod
+    def _read(fd, size=4096):
+        try:
+            return os.read(fd, size)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return ''
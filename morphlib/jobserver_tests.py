@@ -0,0 +1,248 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import fcntl
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class JobServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.jobservers = []
+
+    def tearDown(self):
+        for jobserver in self.jobservers:
+            jobserver.close()
+        shutil.rmtree(self.tempdir)
+
+    def new_jobserver(self, jobs):
+        jobserver = morphlib.jobserver.JobServer(self.tempdir, jobs)
+        jobserver.open()
+        self.jobservers.append(jobserver)
+        return jobserver
+
+    def tokens(self, jobserver):
+        fd = os.open(jobserver.fifo, os.O_RDWR | os.O_NONBLOCK)
+        data = ''
+        try:
+            while True:
+                data += os.read(fd, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        os.write(fd, data)
+        os.close(fd)
+        return data
+
+    def test_first_user_fills_fifo_with_tokens(self):
+        jobserver = self.new_jobserver(4)
+        self.assertEqual(self.tokens(jobserver), '+++')
+
+    def test_later_user_shares_existing_tokens(self):
+        self.new_jobserver(4)
+        jobserver = self.new_jobserver(8)
+        self.assertEqual(self.tokens(jobserver), '+++')
+
+    def test_refills_fifo_once_everyone_has_left(self):
+        self.new_jobserver(4).close()
+        jobserver = self.new_jobserver(2)
+        self.assertEqual(self.tokens(jobserver), '+')
+
+    def test_makeflags_name_jobserver_fds(self):
+        jobserver = morphlib.jobserver.JobServer(self.tempdir, 4)
+        self.assertEqual(jobserver.makeflags(),
+                         ' --jobserver-fds=%d,%d -j' % jobserver.fds)
+
+    def test_wrapped_commands_get_jobserver_fds(self):
+        jobserver = self.new_jobserver(4)
+        argv = ['head', '-c', '1', '/proc/self/fd/%d' % jobserver.fds[0]]
+        child = subprocess.Popen(jobserver.wrap_command(argv),
+                                 stdout=subprocess.PIPE, close_fds=True)
+        out, err = child.communicate()
+        self.assertEqual(out, '+')
+        self.assertEqual(self.tokens(jobserver), '++')
+
+    def test_wrapped_commands_keep_their_arguments(self):
+        jobserver = self.new_jobserver(4)
+        argv = ['echo', 'a b', '$0']
+        child = subprocess.Popen(jobserver.wrap_command(argv),
+                                 stdout=subprocess.PIPE, close_fds=True)
+        out, err = child.communicate()
+        self.assertEqual(out, 'a b $0\n')
+
+    def test_fds_are_not_inherited_without_preexec_fn(self):
+        jobserver = self.new_jobserver(4)
+        for fd in (jobserver._fifo_fd, jobserver._lock_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            self.assertTrue(flags & fcntl.FD_CLOEXEC)
+
+    def test_throws_away_tokens_left_by_earlier_users(self):
+        jobserver = self.new_jobserver(4)
+        # A make that outlived its build keeps the FIFO and its tokens.
+        fd = os.open(jobserver.fifo, os.O_RDWR)
+        try:
+            jobserver.close()
+            jobserver = self.new_jobserver(2)
+            self.assertEqual(self.tokens(jobserver), '+')
+        finally:
+            os.close(fd)
+
+    def test_reports_unexpected_errors_locking(self):
+        def flock(fd, operation):
+            raise IOError(errno.ENOLCK, 'No locks available')
+        self.addCleanup(setattr, fcntl, 'flock', fcntl.flock)
+        fcntl.flock = flock
+        jobserver = morphlib.jobserver.JobServer(self.tempdir, 4)
+        self.jobservers.append(jobserver)
+        self.assertRaises(IOError, jobserver.open)
+
+    def test_reports_unexpected_errors_emptying_fifo(self):
+        def read(fd, size):
+            raise OSError(errno.EIO, 'Input/output error')
+        jobserver = morphlib.jobserver.JobServer(self.tempdir, 4)
+        self.jobservers.append(jobserver)
+        real_read = os.read
+        os.read = read
+        try:
+            self.assertRaises(OSError, jobserver.open)
+        finally:
+            os.read = real_read
+
+    def test_lent_tokens_are_put_back_after_command(self):
+        jobserver = self.new_jobserver(4)
+        # Like a make that crashed, head never gives back the tokens.
+        argv = ['head', '-c', '2', '/proc/self/fd/%d' % jobserver.fds[0]]
+        with jobserver.lend() as fifo:
+            child = subprocess.Popen(jobserver.wrap_command(argv, fifo),
+                                     stdout=subprocess.PIPE, close_fds=True)
+            out, err = child.communicate()
+        self.assertEqual(out, '++')
+        self.assertEqual(self.tokens(jobserver), '+++')
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['jobserver', 'jobserver.lock'])
+
+    def test_joins_jobserver_when_first_lending(self):
+        jobserver = morphlib.jobserver.JobServer(self.tempdir, 4)
+        self.jobservers.append(jobserver)
+        self.assertEqual(os.listdir(self.tempdir), [])
+        for i in xrange(2):
+            with jobserver.lend():
+                self.assertTrue(os.path.exists(jobserver.fifo))
+        self.assertEqual(self.tokens(jobserver), '+++')
+
+
+class TokenLenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.jobserver = morphlib.jobserver.JobServer(self.tempdir, 4)
+        self.jobserver.open()
+        self.lender = morphlib.jobserver._TokenLender(self.jobserver.fifo, 2)
+        self.command_fd = os.open(self.lender.fifo,
+                                  os.O_RDWR | os.O_NONBLOCK)
+
+    def tearDown(self):
+        os.close(self.command_fd)
+        if self.lender._thread.ident is None:
+            self.lender.start()
+        self.lender.stop()
+        self.jobserver.close()
+        shutil.rmtree(self.tempdir)
+
+    def take(self):
+        return morphlib.jobserver._TokenLender._read(self.command_fd, 1)
+
+    def test_keeps_one_token_waiting(self):
+        self.lender.relay()
+        self.lender.relay()
+        self.assertEqual(self.lender.borrowed, 1)
+        self.assertEqual(self.take(), '+')
+        self.assertEqual(self.take(), '')
+
+    def test_borrows_another_token_once_one_is_taken(self):
+        self.lender.relay()
+        self.take()
+        self.lender.relay()
+        self.assertEqual(self.lender.borrowed, 2)
+        self.assertEqual(self.take(), '+')
+
+    def test_borrows_no_more_than_the_limit(self):
+        for i in xrange(3):
+            self.lender.relay()
+            self.take()
+        self.assertEqual(self.lender.borrowed, 2)
+
+    def test_puts_back_tokens_the_command_returns(self):
+        self.lender.relay()
+        self.take()
+        self.lender.relay()
+        os.write(self.command_fd, '+')
+        self.lender.relay()
+        self.assertEqual(self.lender.borrowed, 1)
+
+    def test_puts_back_every_token_when_stopped(self):
+        self.lender.relay()
+        self.take()
+        self.lender.relay()
+        self.lender.start()
+        self.lender.stop()
+        self.assertEqual(self.lender.borrowed, 0)
+        fd = os.open(self.jobserver.fifo, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            self.assertEqual(os.read(fd, 4096), '+++')
+        finally:
+            os.close(fd)
+        self.lender = morphlib.jobserver._TokenLender(self.jobserver.fifo, 2)
+
+    def test_reports_unexpected_errors_reading(self):
+        r, w = os.pipe()
+        os.close(r)
+        os.close(w)
+        self.assertRaises(OSError, morphlib.jobserver._TokenLender._read, r)
+
+    def wait_for_token(self):
+        readable, _, _ = select.select([self.command_fd], [], [], 10)
+        self.assertEqual(readable, [self.command_fd])
+        return self.take()
+
+    def test_lends_tokens_as_they_are_taken(self):
+        self.lender.start()
+        self.assertEqual(self.wait_for_token(), '+')
+        self.assertEqual(self.wait_for_token(), '+')
+        self.assertEqual(self.lender.borrowed, 2)
+
+    def test_puts_back_returned_tokens_while_running(self):
+        self.lender.start()
+        self.wait_for_token()
+        self.wait_for_token()
+        os.write(self.command_fd, '+')
+        # With no token waiting, the lender blocks until one is returned.
+        for i in xrange(1000):
+            if self.lender.waiting:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.lender.waiting)
+        self.assertEqual(self.lender.borrowed, 2)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012, 2013, 2014  Codethink Limited
+# Copyright (C) 2012, 2013, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -50,14 +50,17 @@ class LocalArtifactCache(object):
 
     def put(self, artifact):
         filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
+        return self._save_file(filename)
+
+    def _save_file(self, filename):
         return morphlib.savefile.SaveFile(filename, mode='w')
 
     def _has_file(self, filename):
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -24,6 +24,11 @@ import yaml
 import morphlib
 
 
+# The C implementation of the YAML parser is much faster, but is only
+# available if PyYAML was built with libyaml.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class MorphologyObsoleteFieldWarning(UserWarning):
 
     def __init__(self, morphology, spec, field):
@@ -309,7 +314,13 @@ class MorphologyDumper(yaml.SafeDumper):
 
 class MorphologyLoader(object):
 
-    '''Load morphologies from disk, or save them back to disk.'''
+    '''Load morphologies from disk, or save them back to disk.
+
+    If a MorphologyCache is given, morphologies are looked up in it
+    before their text is parsed, and stored in it once they have been
+    loaded, together with the warnings validating them gave.
+
+    '''
 
     _required_fields = {
         'chunk': [
@@ -375,6 +386,9 @@ class MorphologyLoader(object):
         },
     }
 
+    def __init__(self, cache=None):
+        self.cache = cache
+
     def parse_morphology_text(self, text, morph_filename):
         '''Parse a textual morphology.
 
@@ -389,7 +403,7 @@ class MorphologyLoader(object):
         '''
 
         try:
-            obj = yaml.safe_load(text)
+            obj = yaml.load(text, Loader=SafeLoader)
         except yaml.error.YAMLError as e:
             raise MorphologyNotYamlError(morph_filename, e)
 
@@ -405,13 +419,35 @@ class MorphologyLoader(object):
 
         '''
 
+        key = None
+        if self.cache is not None:
+            key = morphlib.morphologycache.blob_id(string)
+            cached = self.cache.get(key)
+            if cached is not None:
+                m, caught = cached
+                m.filename = filename
+                self._warn_again(caught)
+                return m
+
         m = self.parse_morphology_text(string, filename)
         m.filename = filename
-        self.validate(m)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.validate(m)
+        caught = [w.message for w in caught]
+        self._warn_again(caught)
         self.set_commands(m)
         self.set_defaults(m)
+        if key is not None:
+            self.cache.put(key, m, caught)
         return m
 
+    def _warn_again(self, caught):
+        # Validation warnings are caught so that they can be cached with
+        # the morphology, and given again each time it is loaded.
+        for warning in caught:
+            warnings.warn(warning, stacklevel=3)
+
     def load_from_file(self, filename):
         '''Load a morphology from a named file.
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -542,6 +542,42 @@ build-system: dummy
         self.assertEqual(morph['name'], 'foo')
         self.assertEqual(morph['build-system'], 'dummy')
 
+    def test_loads_from_cache_without_parsing(self):
+        string = 'name: foo\nkind: chunk\nbuild-system: dummy\n'
+        cache = morphlib.morphologycache.MorphologyCache()
+        loader = morphlib.morphloader.MorphologyLoader(cache=cache)
+        first = loader.load_from_string(string, 'foo.morph')
+        loader.parse_morphology_text = None
+        second = loader.load_from_string(string, 'bar.morph')
+        self.assertEqual(second, first)
+        self.assertEqual(second.filename, 'bar.morph')
+        self.assertFalse(second is first)
+
+    def test_warns_again_when_loading_from_cache(self):
+        string = ('name: foo\nkind: stratum\n'
+                  'build-depends:\n- {morph: bar, repo: baserock:bar}\n'
+                  'chunks:\n- {name: c, morph: c, build-depends: []}\n')
+        cache = morphlib.morphologycache.MorphologyCache()
+        loader = morphlib.morphloader.MorphologyLoader(cache=cache)
+        for i in xrange(2):
+            with self.catch_warnings(MorphologyObsoleteFieldWarning) \
+            as caught_warnings:
+                loader.load_from_string(string)
+            self.assertEqual([(w.message.stratum_name, w.message.field)
+                              for w in caught_warnings],
+                             [('bar', 'repo')])
+            # The second time, the morphology comes from the cache.
+            loader.parse_morphology_text = None
+
+    def test_does_not_cache_invalid_morphologies(self):
+        cache = morphlib.morphologycache.MorphologyCache()
+        loader = morphlib.morphloader.MorphologyLoader(cache=cache)
+        self.assertRaises(morphlib.morphloader.MissingFieldError,
+                          loader.load_from_string, 'kind: chunk\n')
+        self.assertEqual(
+            cache.get(morphlib.morphologycache.blob_id('kind: chunk\n')),
+            None)
+
     def test_loads_from_file(self):
         with open(self.filename, 'w') as f:
             f.write('''\
@@ -0,0 +1,202 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+import morphlib
+
+
+def blob_id(text):
+    '''Return the sha1 git would give a blob with the given contents.'''
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1('blob %d\0%s' % (len(text), text)).hexdigest()
+
+
+def _make_warning(cls, args, state):
+    # Warnings such as MorphologyObsoleteFieldWarning take different
+    # arguments than they keep in args, so they cannot be pickled as they
+    # are.
+    warning = cls.__new__(cls, *args)
+    warning.args = args
+    warning.__dict__.update(state)
+    return warning
+
+
+class MorphologyCache(object):
+
+    '''Remember morphologies that have already been parsed and validated.
+
+    Parsing the YAML of a morphology, validating it and filling in its
+    defaults takes far longer than reading it, and the same files are
+    loaded over and over again: by every run of morph, and for every
+    commit of definitions that did not change them. The result only
+    depends on the text of the file, so this keeps loaded morphologies
+    keyed by the git blob id of their text.
+
+    Morphologies are kept in memory and, if ``dirname`` is given, in a
+    directory with one compressed file per morphology. The least recently
+    used files are removed once they take up more than ``max_size`` bytes.
+
+    The warnings loading a morphology gave are kept with it, so that
+    they can be given again when it is looked up.
+
+    Every lookup returns a new Morphology object, so callers may change
+    what they get without affecting later lookups.
+
+    The cache may be shared between threads.
+
+    '''
+
+    # Change this when the stored format changes.
+    format_version = 2
+
+    def __init__(self, dirname=None, max_size=16 * 1024**2):
+        self.dirname = dirname
+        self.max_size = max_size
+        self._memory = {}
+        self._disk_size = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return what was stored for a blob id, or None.
+
+        What was stored is a (morphology, warnings) pair, where warnings
+        is the list of warnings loading the morphology gave.
+
+        '''
+
+        with self._lock:
+            data = self._memory.get(key)
+        if data is None and self.dirname is not None:
+            data = self._read_entry(key)
+            if data is not None:
+                with self._lock:
+                    self._memory[key] = data
+        if data is None:
+            return None
+        fields, warning_states = cPickle.loads(data)
+        return (morphlib.morphology.Morphology(fields),
+                [_make_warning(*state) for state in warning_states])
+
+    def put(self, key, morphology, warnings=()):
+        '''Store a loaded morphology, and its warnings, for a blob id.'''
+
+        warning_states = [(w.__class__, w.args, w.__dict__)
+                          for w in warnings]
+        data = cPickle.dumps((dict(morphology), warning_states),
+                             cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._memory[key] = data
+        if self.dirname is not None:
+            self._write_entry(key, data)
+
+    def _filename(self, key):
+        return os.path.join(self.dirname, key)
+
+    def _read_entry(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                compressed = f.read()
+        except IOError:
+            return None
+        try:
+            version, data = cPickle.loads(zlib.decompress(compressed))
+        except Exception, e:
+            logging.warning('Ignoring unreadable morphology cache entry '
+                            '%s: %s' % (filename, e))
+            return None
+        # Another version of morph may validate or fill in defaults
+        # differently.
+        if version != (self.format_version, morphlib.gitversion.version):
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return data
+
+    def _write_entry(self, key, data):
+        version = (self.format_version, morphlib.gitversion.version)
+        compressed = zlib.compress(
+            cPickle.dumps((version, data), cPickle.HIGHEST_PROTOCOL))
+        try:
+            if not os.path.exists(self.dirname):
+                os.makedirs(self.dirname)
+            fd, tempname = tempfile.mkstemp(dir=self.dirname,
+                                            prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(compressed)
+                os.rename(tempname, self._filename(key))
+            except BaseException:
+                os.remove(tempname)
+                raise
+        except (IOError, OSError), e:
+            # The cache only saves time, so failing to fill it is not an
+            # error.
+            logging.warning('Could not store morphology in cache: %s' % e)
+            return
+
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(compressed)
+            if self._disk_size is None or self._disk_size > self.max_size:
+                self._disk_size = self._remove_old_entries()
+
+    def _remove_old_entries(self):
+        '''Remove the least recently used entries beyond max_size.
+
+        Entries are removed until they take up three quarters of max_size,
+        so that the directory is not listed again for every new entry.
+        Return the size of the remaining entries.
+
+        '''
+
+        entries = []
+        for name in os.listdir(self.dirname):
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        if total <= self.max_size:
+            return total
+
+        entries.sort(reverse=True)
+        total = 0
+        for i, (mtime, size, path) in enumerate(entries):
+            if total + size > self.max_size * 3 / 4:
+                break
+            total += size
+        for mtime, size, path in entries[i:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return total
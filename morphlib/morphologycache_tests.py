@@ -0,0 +1,163 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class BlobIdTests(unittest.TestCase):
+
+    def test_matches_git(self):
+        # As printed by `echo hello | git hash-object --stdin`
+        self.assertEqual(morphlib.morphologycache.blob_id('hello\n'),
+                         'ce013625030ba8dba906f756967f9e9ca394464a')
+
+    def test_encodes_unicode_as_utf8(self):
+        self.assertEqual(morphlib.morphologycache.blob_id(u'caf\xe9\n'),
+                         morphlib.morphologycache.blob_id('caf\xc3\xa9\n'))
+
+
+class MorphologyCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'morphologies')
+        self.morph = morphlib.morphology.Morphology(
+            {'name': 'foo', 'kind': 'chunk', 'products': []})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_returns_none_for_unknown_key(self):
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        self.assertEqual(cache.get('key'), None)
+
+    def test_returns_stored_morphology_from_memory(self):
+        cache = morphlib.morphologycache.MorphologyCache()
+        cache.put('key', self.morph)
+        self.assertEqual(cache.get('key'), (self.morph, []))
+
+    def test_returns_stored_morphology_from_disk(self):
+        morphlib.morphologycache.MorphologyCache(self.dirname).put(
+            'key', self.morph)
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        self.assertEqual(cache.get('key'), (self.morph, []))
+
+    def test_returns_a_new_copy_each_time(self):
+        cache = morphlib.morphologycache.MorphologyCache()
+        cache.put('key', self.morph)
+        cache.get('key')[0]['products'].append('bar')
+        self.assertEqual(cache.get('key')[0]['products'], [])
+
+    def test_returns_stored_warnings(self):
+        spec = {'morph': 'bar', 'repo': 'baserock:bar'}
+        morphlib.morphologycache.MorphologyCache(self.dirname).put(
+            'key', self.morph,
+            [morphlib.morphloader.MorphologyObsoleteFieldWarning(
+                self.morph, spec, 'repo'),
+             DeprecationWarning('old')])
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        morph, (obsolete, deprecated) = cache.get('key')
+        self.assertEqual(
+            (obsolete.__class__, obsolete.morphology_name,
+             obsolete.stratum_name, obsolete.field),
+            (morphlib.morphloader.MorphologyObsoleteFieldWarning,
+             'foo', 'bar', 'repo'))
+        self.assertEqual(str(deprecated), 'old')
+        self.assertEqual(deprecated.__class__, DeprecationWarning)
+
+    def test_ignores_entries_of_other_versions(self):
+        morphlib.morphologycache.MorphologyCache(self.dirname).put(
+            'key', self.morph)
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        cache.format_version += 1
+        self.assertEqual(cache.get('key'), None)
+
+    def test_warns_if_entry_cannot_be_written(self):
+        filename = os.path.join(self.tempdir, 'file')
+        with open(filename, 'w'):
+            pass
+        cache = morphlib.morphologycache.MorphologyCache(
+            os.path.join(filename, 'morphologies'))
+        cache.put('key', self.morph)
+        self.assertEqual(cache.get('key'), (self.morph, []))
+
+    def test_removes_temporary_file_if_entry_cannot_be_written(self):
+        def rename(old, new):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        self.addCleanup(setattr, os, 'rename', os.rename)
+        os.rename = rename
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        cache.put('key', self.morph)
+        self.assertEqual(os.listdir(self.dirname), [])
+
+    def test_ignores_corrupt_entries(self):
+        os.mkdir(self.dirname)
+        with open(os.path.join(self.dirname, 'key'), 'w') as f:
+            f.write('garbage')
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        self.assertEqual(cache.get('key'), None)
+
+    def test_removes_least_recently_used_entries(self):
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        cache.put('old', self.morph)
+        size = os.path.getsize(os.path.join(self.dirname, 'old'))
+        os.utime(os.path.join(self.dirname, 'old'), (0, 0))
+        cache.max_size = size * 2
+        cache.put('new', self.morph)
+        self.assertEqual(sorted(os.listdir(self.dirname)), ['new', 'old'])
+        os.utime(os.path.join(self.dirname, 'new'), (1, 1))
+        cache.put('newer', self.morph)
+        self.assertEqual(os.listdir(self.dirname), ['newer'])
+
+    def test_returns_entry_it_cannot_mark_as_used(self):
+        def utime(path, times):
+            raise OSError(errno.EROFS, 'Read-only file system')
+        morphlib.morphologycache.MorphologyCache(self.dirname).put(
+            'key', self.morph)
+        self.addCleanup(setattr, os, 'utime', os.utime)
+        os.utime = utime
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname)
+        self.assertEqual(cache.get('key'), (self.morph, []))
+
+    def test_skips_temporary_and_vanished_files_when_removing(self):
+        os.mkdir(self.dirname)
+        with open(os.path.join(self.dirname, '.tmpxyz'), 'w') as f:
+            f.write('x' * 1000)
+        os.symlink('missing', os.path.join(self.dirname, 'gone'))
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname,
+                                                         max_size=1)
+        cache.put('key', self.morph)
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['.tmpxyz', 'gone'])
+
+    def test_ignores_entries_removed_meanwhile(self):
+        def remove(path):
+            raise OSError(errno.ENOENT, 'No such file or directory')
+        cache = morphlib.morphologycache.MorphologyCache(self.dirname,
+                                                         max_size=1)
+        real_remove = os.remove
+        os.remove = remove
+        try:
+            cache.put('key', self.morph)
+        finally:
+            os.remove = real_remove
+        self.assertEqual(os.listdir(self.dirname), ['key'])
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -42,16 +42,40 @@ class MorphologyFactory(object):
     '''A way of creating morphologies which will provide a default'''
 
     def __init__(self, local_repo_cache, remote_repo_cache=None,
-                 status_cb=None):
+                 status_cb=None, morphology_cache=None):
         self._lrc = local_repo_cache
         self._rrc = remote_repo_cache
+        self._remote_texts = {}
+        if morphology_cache is None:
+            morphology_cache = morphlib.morphologycache.MorphologyCache()
+        self._loader = morphlib.morphloader.MorphologyLoader(
+            cache=morphology_cache)
 
         null_status_function = lambda **kwargs: None
         self.status = status_cb or null_status_function
 
+    def prefetch_morphologies(self, keys):
+        '''Read many morphologies from the remote repo cache in one go.
+
+        ``keys`` are (reponame, sha1, filename) triples, as later passed to
+        get_morphology. The files in repos that are not cached locally are
+        requested from the remote repo cache with a single request, so that
+        get_morphology does not need one request for each of them.
+
+        '''
+        if self._rrc is None:
+            return
+        wanted = [key for key in keys
+                  if key not in self._remote_texts and
+                  not self._lrc.has_repo(key[0])]
+        if wanted:
+            self.status(msg="Retrieving %(count)d morphologies from the "
+                        "remote git cache.", count=len(wanted), chatty=True)
+            self._remote_texts.update(self._rrc.cat_files(wanted))
+
     def get_morphology(self, reponame, sha1, filename):
         morph_name = os.path.splitext(os.path.basename(filename))[0]
-        loader = morphlib.morphloader.MorphologyLoader()
+        loader = self._loader
         if self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
                         chatty=True)
@@ -68,7 +92,7 @@ class MorphologyFactory(object):
                         reponame=reponame, sha1=sha1, filename=filename,
                         chatty=True)
             try:
-                text = self._rrc.cat_file(reponame, sha1, filename)
+                text = self._cat_remote_file(reponame, sha1, filename)
                 morph = loader.load_from_string(text)
             except morphlib.remoterepocache.CatFileError:
                 morph = None
@@ -88,3 +112,13 @@ class MorphologyFactory(object):
             loader.set_commands(morph)
             loader.set_defaults(morph)
         return morph
+
+    def _cat_remote_file(self, reponame, sha1, filename):
+        key = (reponame, sha1, filename)
+        if key not in self._remote_texts:
+            return self._rrc.cat_file(reponame, sha1, filename)
+        text = self._remote_texts[key]
+        if text is None:
+            raise morphlib.remoterepocache.CatFileError(
+                reponame, sha1, filename)
+        return text
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -37,6 +37,9 @@ class FakeRemoteRepoCache(object):
     def ls_tree(self, reponame, sha1):
         return []
 
+    def cat_files(self, triples):
+        return dict((t, self.cat_file(*t)) for t in triples)
+
 
 class FakeLocalRepo(object):
 
@@ -279,3 +282,39 @@ class MorphologyFactoryTests(unittest.TestCase):
             morphlib.morphloader.EmptyStratumError,
             self.mf.get_morphology, 'reponame', 'sha1', 'stratum-empty.morph')
 
+    def test_uses_prefetched_remote_morphologies(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.mf.prefetch_morphologies([('reponame', 'sha1', 'chunk.morph')])
+        self.rrc.cat_file = self.noremotefile
+        morph = self.mf.get_morphology('reponame', 'sha1', 'chunk.morph')
+        self.assertEqual('chunk', morph['name'])
+
+    def test_infers_morphology_prefetched_as_missing(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_files = lambda triples: dict((t, None) for t in triples)
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        self.mf.prefetch_morphologies(
+            [('reponame', 'sha1', 'assumed-remote.morph')])
+        self.rrc.cat_file = self.fail
+        morph = self.mf.get_morphology('reponame', 'sha1',
+                                       'assumed-remote.morph')
+        self.assertEqual('assumed-remote', morph['name'])
+
+    def test_prefetches_nothing_with_no_remote(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.lmf.prefetch_morphologies([('reponame', 'sha1', 'chunk.morph')])
+        self.assertEqual(self.lmf._remote_texts, {})
+
+    def test_prefetches_only_remote_morphologies_not_yet_read(self):
+        requested = []
+
+        def cat_files(triples):
+            requested.append(triples)
+            return dict((t, 'name: chunk\nkind: chunk\n') for t in triples)
+
+        self.rrc.cat_files = cat_files
+        self.lrc.has_repo = lambda reponame: reponame == 'local'
+        self.mf.prefetch_morphologies([('remote', 'sha1', 'chunk.morph'),
+                                       ('local', 'sha1', 'chunk.morph')])
+        self.mf.prefetch_morphologies([('remote', 'sha1', 'chunk.morph')])
+        self.assertEqual(requested, [[('remote', 'sha1', 'chunk.morph')]])
@@ -0,0 +1,177 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import httplib
+import logging
+import random
+import socket
+import threading
+
+import morphlib
+
+
+# How long, in seconds, to wait for a peer before getting an artifact from
+# the remote artifact cache instead.
+PEER_TIMEOUT = 10
+
+
+class PeerArtifactCache(object):
+
+    '''Get artifacts from peers that hold them, or from a remote cache.
+
+    ``peers`` maps the basenames of artifacts to the URLs of the artifact
+    cache servers of peers, such as other distbuild workers, which may
+    hold them. An artifact and its metadata are got from one of those
+    peers, picked at random to spread the load, or from the remote
+    artifact cache ``rac`` if none of them has it. If reading from a
+    peer fails part way, the rest is read from the next peer, or the
+    remote artifact cache.
+
+    The remote artifact cache is what decides what is cached: all the
+    ``has`` methods ask only it.
+
+    How many bytes are got from each server is counted in
+    ``transferred``, which maps server URLs to byte counts.
+
+    '''
+
+    def __init__(self, rac, peers, timeout=PEER_TIMEOUT):
+        self.rac = rac
+        self.peers = peers
+        self.transferred = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._pool = morphlib.httppool.HTTPConnectionPool(timeout=timeout)
+        self._peer_caches = {}
+
+    def has(self, artifact):
+        return self.rac.has(artifact)
+
+    def has_artifact_metadata(self, artifact, name):
+        return self.rac.has_artifact_metadata(artifact, name)
+
+    def has_source_metadata(self, source, cachekey, name):
+        return self.rac.has_source_metadata(source, cachekey, name)
+
+    def has_many(self, artifacts):
+        return self.rac.has_many(artifacts)
+
+    def has_many_artifact_metadata(self, artifacts, name):
+        return self.rac.has_many_artifact_metadata(artifacts, name)
+
+    def get(self, artifact, log=logging.error):
+        return self._get(artifact,
+                         lambda cache, log: cache.get(artifact, log=log),
+                         log)
+
+    def get_artifact_metadata(self, artifact, name, log=logging.error):
+        return self._get(
+            artifact,
+            lambda cache, log: cache.get_artifact_metadata(
+                artifact, name, log=log),
+            log)
+
+    def get_source_metadata(self, source, cachekey, name):
+        return _FailoverResponse(
+            [(self.rac, None)],
+            lambda cache, log: cache.get_source_metadata(
+                source, cachekey, name),
+            self._count)
+
+    def _get(self, artifact, get, log):
+        urls = list(self.peers.get(artifact.basename(), []))
+        random.shuffle(urls)
+        sources = [(self._peer_cache(url), logging.debug) for url in urls]
+        sources.append((self.rac, log))
+        return _FailoverResponse(sources, get, self._count)
+
+    def _peer_cache(self, url):
+        with self._lock:
+            if url not in self._peer_caches:
+                self._peer_caches[url] = \
+                    morphlib.remoteartifactcache.RemoteArtifactCache(
+                        url, pool=self._pool)
+            return self._peer_caches[url]
+
+    def _count(self, server, size):
+        with self._lock:
+            self.transferred[server] += size
+
+    def __str__(self):  # pragma: no cover
+        return str(self.rac)
+
+
+class _FailoverResponse(object):
+
+    '''Read a file from the first of some caches that can give it.
+
+    ``sources`` are (cache, log) pairs, to try in turn, with ``get``
+    called with each to get the file. If getting or reading the file
+    fails from any but the last, it is got from the next one instead,
+    and what was read already is skipped. How many bytes are read from
+    each is counted with ``count``.
+
+    '''
+
+    def __init__(self, sources, get, count):
+        self._sources = list(sources)
+        self._get = get
+        self._count = count
+        self._offset = 0  # how much was read from the file
+        self._open()
+
+    def _open(self):
+        while True:
+            cache, log = self._sources.pop(0)
+            try:
+                self._response = self._get(cache, log)
+            except morphlib.remoteartifactcache.GetError, e:
+                if not self._sources:
+                    raise
+                logging.debug('%s could not give a file: %s' % (cache, e))
+            else:
+                self._cache = cache
+                self._position = 0  # how much was read from this cache
+                return
+
+    def read(self, *args):
+        while True:
+            try:
+                while self._position < self._offset:
+                    skipped = self._read(
+                        min(self._offset - self._position, 64 * 1024))
+                    if not skipped:
+                        raise httplib.IncompleteRead(skipped)
+                data = self._read(*args)
+            except (socket.error, httplib.HTTPException), e:
+                if not self._sources:
+                    raise
+                logging.warning('Reading from %s failed, so reading from '
+                                'the next cache: %s' % (self._cache, e))
+                self._response.close()
+                self._open()
+            else:
+                self._offset += len(data)
+                return data
+
+    def _read(self, *args):
+        data = self._response.read(*args)
+        self._position += len(data)
+        self._count(str(self._cache), len(data))
+        return data
+
+    def close(self):
+        self._response.close()
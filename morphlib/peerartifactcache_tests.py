@@ -0,0 +1,220 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import httplib
+import socket
+import StringIO
+import unittest
+
+import morphlib
+
+
+class BrokenFile(object):
+
+    '''A file that fails to read after some bytes, like a broken socket.'''
+
+    def __init__(self, contents, size):
+        self._file = StringIO.StringIO(contents[:size])
+        self.closed = False
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        if not data:
+            raise socket.error('Connection reset by peer')
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRemoteArtifactCache(object):
+
+    def __init__(self, url, files):
+        self.url = url
+        self.files = files
+        self.broken = {}
+        self.gets = 0
+
+    def has(self, artifact):
+        return artifact.basename() in self.files
+
+    def has_artifact_metadata(self, artifact, name):
+        return artifact.metadata_basename(name) in self.files
+
+    def has_source_metadata(self, source, cachekey, name):
+        return '%s.%s' % (cachekey, name) in self.files
+
+    def has_many(self, artifacts):
+        return set(a for a in artifacts if self.has(a))
+
+    def has_many_artifact_metadata(self, artifacts, name):
+        return set(a for a in artifacts
+                   if self.has_artifact_metadata(a, name))
+
+    def get(self, artifact, log=None):
+        self.gets += 1
+        if artifact.basename() not in self.files:
+            raise morphlib.remoteartifactcache.GetError(self, artifact)
+        if artifact.basename() in self.broken:
+            return BrokenFile(self.files[artifact.basename()],
+                              self.broken[artifact.basename()])
+        return StringIO.StringIO(self.files[artifact.basename()])
+
+    def get_artifact_metadata(self, artifact, name, log=None):
+        self.gets += 1
+        filename = artifact.metadata_basename(name)
+        if filename not in self.files:
+            raise morphlib.remoteartifactcache.GetArtifactMetadataError(
+                self, artifact, name)
+        return StringIO.StringIO(self.files[filename])
+
+    def get_source_metadata(self, source, cachekey, name):
+        self.gets += 1
+        filename = '%s.%s' % (cachekey, name)
+        if filename not in self.files:
+            raise morphlib.remoteartifactcache.GetSourceMetadataError(
+                self, source, cachekey, name)
+        return StringIO.StringIO(self.files[filename])
+
+    def __str__(self):
+        return self.url
+
+
+class PeerArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        loader = morphlib.morphloader.MorphologyLoader()
+        morph = loader.load_from_string(
+            '''
+                name: chunk
+                kind: chunk
+                products:
+                    - artifact: chunk-runtime
+                      include:
+                          - usr/bin
+                    - artifact: chunk-devel
+                      include:
+                          - usr/include
+            ''')
+        sources = morphlib.source.make_sources('repo', 'original/ref',
+                                               'chunk.morph', 'sha1',
+                                               'tree', morph)
+        self.source, = sources
+        self.source.cache_key = 'CHUNK'
+        self.runtime = self.source.artifacts['chunk-runtime']
+        self.devel = self.source.artifacts['chunk-devel']
+
+        self.rac = FakeRemoteArtifactCache('http://shared/', {
+            self.runtime.basename(): 'runtime',
+            self.devel.basename(): 'devel',
+            self.runtime.metadata_basename('meta'): 'meta',
+            'CHUNK.build-log': 'log',
+        })
+        self.peer_caches = {
+            'http://peer1/': FakeRemoteArtifactCache('http://peer1/', {
+                self.runtime.basename(): 'runtime',
+                self.runtime.metadata_basename('meta'): 'meta',
+            }),
+            'http://peer2/': FakeRemoteArtifactCache('http://peer2/', {}),
+        }
+        self.cache = morphlib.peerartifactcache.PeerArtifactCache(
+            self.rac, {
+                self.runtime.basename(): ['http://peer1/'],
+                self.devel.basename(): ['http://peer2/'],
+            })
+        self.cache._peer_cache = self.peer_caches.get
+
+    def test_asks_remote_cache_what_is_cached(self):
+        self.rac.files.pop(self.devel.basename())
+        self.assertTrue(self.cache.has(self.runtime))
+        self.assertTrue(self.cache.has_artifact_metadata(self.runtime, 'meta'))
+        self.assertTrue(self.cache.has_source_metadata(
+            self.source, 'CHUNK', 'build-log'))
+        self.assertEqual(self.cache.has_many([self.runtime, self.devel]),
+                         set([self.runtime]))
+        self.assertEqual(
+            self.cache.has_many_artifact_metadata(
+                [self.runtime, self.devel], 'meta'),
+            set([self.runtime]))
+        self.assertEqual(self.peer_caches['http://peer1/'].gets, 0)
+
+    def test_gets_source_metadata_from_remote_cache(self):
+        f = self.cache.get_source_metadata(self.source, 'CHUNK', 'build-log')
+        self.assertEqual(f.read(), 'log')
+        self.assertEqual(dict(self.cache.transferred), {'http://shared/': 3})
+
+    def test_makes_one_remote_cache_for_each_peer(self):
+        cache = morphlib.peerartifactcache.PeerArtifactCache(self.rac, {})
+        peer = cache._peer_cache('http://peer1/')
+        self.assertEqual(peer.server_url, 'http://peer1/')
+        self.assertIs(cache._peer_cache('http://peer1/'), peer)
+
+    def test_gets_artifact_from_peer_holding_it(self):
+        self.assertEqual(self.cache.get(self.runtime).read(), 'runtime')
+        self.assertEqual(self.peer_caches['http://peer1/'].gets, 1)
+        self.assertEqual(self.rac.gets, 0)
+
+    def test_gets_artifact_metadata_from_peer_holding_artifact(self):
+        f = self.cache.get_artifact_metadata(self.runtime, 'meta')
+        self.assertEqual(f.read(), 'meta')
+        self.assertEqual(self.rac.gets, 0)
+
+    def test_gets_artifact_from_remote_cache_if_peers_fail(self):
+        self.assertEqual(self.cache.get(self.devel).read(), 'devel')
+        self.assertEqual(self.peer_caches['http://peer2/'].gets, 1)
+        self.assertEqual(self.rac.gets, 1)
+
+    def test_raises_error_if_remote_cache_fails_too(self):
+        self.rac.files = {}
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          self.cache.get, self.devel)
+
+    def test_counts_bytes_from_each_server(self):
+        self.cache.get(self.runtime).read()
+        self.cache.get(self.devel).read()
+        self.cache.get(self.devel).read()
+        self.assertEqual(dict(self.cache.transferred),
+                         {'http://peer1/': 7, 'http://shared/': 10})
+
+    def read_all(self, f):
+        data = ''
+        while True:
+            part = f.read(2)
+            if not part:
+                f.close()
+                return data
+            data += part
+
+    def test_reads_rest_from_remote_cache_if_peer_breaks(self):
+        peer = self.peer_caches['http://peer1/']
+        peer.broken[self.runtime.basename()] = 3
+        f = self.cache.get(self.runtime)
+        self.assertEqual(self.read_all(f), 'runtime')
+        self.assertEqual(dict(self.cache.transferred),
+                         {'http://peer1/': 3, 'http://shared/': 7})
+
+    def test_raises_error_if_next_cache_has_too_little(self):
+        self.peer_caches['http://peer1/'].broken[self.runtime.basename()] = 5
+        self.rac.files[self.runtime.basename()] = 'run'
+        f = self.cache.get(self.runtime)
+        self.assertEqual(f.read(5), 'runti')
+        self.assertRaises(httplib.IncompleteRead, f.read, 2)
+
+    def test_raises_error_if_remote_cache_breaks_too(self):
+        self.rac.broken[self.devel.basename()] = 2
+        f = self.cache.get(self.devel)
+        self.assertEqual(f.read(2), 'de')
+        self.assertRaises(socket.error, f.read, 2)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012,2013,2014  Codethink Limited
+# Copyright (C) 2012,2013,2014,2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -295,7 +295,8 @@ class BranchAndMergePlugin(cliapp.Plugin):
 
         ws = morphlib.workspace.open('.')
         sb = morphlib.sysbranchdir.open_from_within('.')
-        loader = morphlib.morphloader.MorphologyLoader()
+        loader = morphlib.morphloader.MorphologyLoader(
+            cache=morphlib.util.new_morphology_cache(self.app.settings))
         morphs = self._load_all_sysbranch_morphologies(sb, loader)
 
         def edit_chunk(morph, chunk_name):
@@ -607,7 +608,8 @@ class BranchAndMergePlugin(cliapp.Plugin):
             gd.branch(system_branch, base_ref)
             gd.checkout(system_branch)
 
-            loader = morphlib.morphloader.MorphologyLoader()
+            loader = morphlib.morphloader.MorphologyLoader(
+                cache=morphlib.util.new_morphology_cache(self.app.settings))
             morphs = self._load_all_sysbranch_morphologies(sb, loader)
 
             morphs.repoint_refs(sb.root_repository_url,
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2015  Codethink Limited
+# Copyright (C) 2013-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -547,16 +547,17 @@ class DeployPlugin(cliapp.Plugin):
             # Unpack the artifact (tarball) to a temporary directory.
             self.app.status(msg='Unpacking system for configuration')
 
-            if build_command.lac.has(artifact):
-                f = build_command.lac.get(artifact)
-            elif build_command.rac.has(artifact):
-                build_command.cache_artifacts_locally([artifact])
-                f = build_command.lac.get(artifact)
-            else:
-                raise cliapp.AppException('Deployment failed as system is'
-                                          ' not yet built.\nPlease ensure'
-                                          ' the system is built before'
-                                          ' deployment.')
+            if not build_command.lac.has(artifact):
+                # Just try fetching it, rather than first asking the
+                # remote cache whether it has it.
+                try:
+                    build_command.cache_artifacts_locally([artifact])
+                except morphlib.remoteartifactcache.GetError:
+                    raise cliapp.AppException('Deployment failed as system is'
+                                              ' not yet built.\nPlease ensure'
+                                              ' the system is built before'
+                                              ' deployment.')
+            f = build_command.lac.get(artifact)
             tf = tarfile.open(fileobj=f)
             tf.extractall(path=system_tree)
 
@@ -1,6 +1,6 @@
 # distbuild_plugin.py -- Morph distributed build plugin
 #
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,9 +17,14 @@
 
 
 import cliapp
+import fcntl
+import json
 import logging
+import os
 import re
+import signal
 import sys
+import time
 
 import morphlib
 import distbuild
@@ -27,6 +32,10 @@ import distbuild
 
 group_distbuild = 'Distributed Build Options'
 
+# How often, in seconds, morph worker-build-service garbage collects the
+# caches of the worker.
+GC_INTERVAL = 10 * 60
+
 class DistbuildOptionsPlugin(cliapp.Plugin):
 
     def enable(self):
@@ -69,9 +78,8 @@ class SerialiseArtifactPlugin(cliapp.Plugin):
 
         filename = morphlib.util.sanitise_morphology_path(morph_name)
         build_command = morphlib.buildcommand.BuildCommand(self.app)
-        srcpool = build_command.create_source_pool(
+        artifact = build_command.resolve_graph(
             repo_name, ref, filename, original_ref=original_ref)
-        artifact = build_command.resolve_artifacts(srcpool)
         self.app.output.write(distbuild.serialise_artifact(artifact))
         self.app.output.write('\n')
 
@@ -79,8 +87,19 @@ class SerialiseArtifactPlugin(cliapp.Plugin):
 class WorkerBuild(cliapp.Plugin):
 
     def enable(self):
+        self.app.settings.string(
+            ['artifact-upload-server'],
+            'upload what worker-build builds to the artifact cache server '
+                'at URL as it is built (default: the shared cache server '
+                'fetches it from the worker afterwards)',
+            metavar='URL',
+            default='',
+            group=group_distbuild)
         self.app.add_subcommand(
             'worker-build', self.worker_build, arg_synopsis='')
+        self.app.add_subcommand(
+            'worker-build-service', self.worker_build_service,
+            arg_synopsis='')
 
     def disable(self):
         pass
@@ -95,14 +114,115 @@ class WorkerBuild(cliapp.Plugin):
         
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
 
-        serialized = sys.stdin.readline()
-        artifact = distbuild.deserialise_artifact(serialized)
-        
         bc = morphlib.buildcommand.BuildCommand(self.app)
 
-        # Now, before we start the build, we garbage collect the caches
-        # to ensure we have room.  First we remove all system artifacts
-        # since we never need to recover those from workers post-hoc
+        # Several builds may run on the worker at once, and garbage
+        # collecting removes files that a running build may need, so it
+        # is only done when no other build is running. Each build holds a
+        # shared lock until it finishes.
+        lock = self.open_build_lock()
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.debug('Not collecting garbage while other builds run')
+        else:
+            self.collect_garbage(bc)
+        lock.close()
+
+        with self.lock_for_build():
+            self.build(bc)
+
+    def worker_build_service(self, args):
+        '''Internal use only: Run builds for the worker daemon.
+
+        Connect to the worker daemon on this machine, as distbuild-helper
+        does, and run each worker-build it is asked for in a process
+        forked from this one. That saves each build starting morph,
+        loading its plugins and settings, and setting up the caches.
+        The caches are garbage collected in the background between
+        builds, instead of at the start of each one.
+
+        '''
+
+        distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+
+        # We don't want SIGPIPE, ever. It just kills us. We handle EPIPE
+        # instead.
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+        self.bc = morphlib.buildcommand.BuildCommand(self.app)
+        self.gc_process = None
+        self.gc_started = 0
+
+        address = self.app.settings['worker-daemon-address'] or 'localhost'
+        port = self.app.settings['worker-daemon-port']
+        conn = distbuild.create_socket()
+        conn.connect((address, port))
+        helper = distbuild.HelperMachine(
+            conn, commands=['worker-build'], spawn=self.spawn_build)
+        loop = distbuild.MainLoop()
+        loop.add_state_machine(helper)
+        loop.run()
+
+    def spawn_build(self, argv):
+        self.maybe_collect_garbage()
+        return distbuild.ForkedProcess(self.run_build, argv)
+
+    def run_build(self, argv):
+        self.app.settings.parse_args(argv[1:])
+        with self.lock_for_build():
+            self.build(self.bc)
+
+    def maybe_collect_garbage(self):
+        '''Start garbage collecting in the background, if it is time to.'''
+
+        if self.gc_process is not None:
+            if self.gc_process.poll() is None:
+                return
+            self.gc_process = None
+
+        if time.time() - self.gc_started < GC_INTERVAL:
+            return
+
+        self.gc_started = time.time()
+        self.gc_process = distbuild.ForkedProcess(self.collect_garbage_later)
+        for f in (self.gc_process.stdin, self.gc_process.stdout,
+                  self.gc_process.stderr):
+            f.close()
+
+    def collect_garbage_later(self):
+        # Nothing reads the output.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        # flock(2) grants shared locks while an exclusive one is waiting,
+        # so while builds overlap, waiting for the build lock alone could
+        # take forever. Holding the gate lock first stops new builds from
+        # starting, so the builds already running are all there is to
+        # wait for.
+        gate = self.open_build_lock('worker-build-gate.lock')
+        fcntl.flock(gate, fcntl.LOCK_EX)
+        lock = self.open_build_lock()
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        self.collect_garbage(self.bc)
+
+    def lock_for_build(self):
+        '''Take the shared build lock, after any garbage collecting.'''
+
+        gate = self.open_build_lock('worker-build-gate.lock')
+        fcntl.flock(gate, fcntl.LOCK_SH)
+        lock = self.open_build_lock()
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        gate.close()
+        return lock
+
+    def open_build_lock(self, name='worker-build.lock'):
+        return open(os.path.join(self.app.settings['tempdir'], name), 'a')
+
+    def collect_garbage(self, bc):
+        # Garbage collect the caches to ensure we have room.  First we
+        # remove all system artifacts since we never need to recover those
+        # from workers post-hoc
         for cachekey, artifacts, last_used in bc.lac.list_contents():
             if any(self.is_system_artifact(f) for f in artifacts):
                 logging.debug("Removing all artifacts for system %s" %
@@ -111,12 +231,123 @@ class WorkerBuild(cliapp.Plugin):
 
         self.app.subcommands['gc']([])
 
+    def build(self, bc):
+        serialized = sys.stdin.readline()
+        artifact = distbuild.deserialise_artifact(serialized)
+        peers = self.read_peers(sys.stdin.readline())
+
+        # The caches are replaced only for this build, which runs in a
+        # process of its own.
         arch = artifact.arch
+        rac = bc.rac
+        if peers and rac is not None:
+            bc.rac = morphlib.peerartifactcache.PeerArtifactCache(rac, peers)
+
+        # Each file of the build is uploaded as soon as it is in the local
+        # artifact cache, while the build goes on, except for the source's
+        # metadata, which waits until the build has succeeded. The build
+        # has only finished once all of them are uploaded.
+        uploader = None
+        upload_server = self.app.settings['artifact-upload-server']
+        if upload_server:
+            uploader = morphlib.artifactuploader.ArtifactUploader(
+                upload_server)
+            bc.lac = morphlib.artifactuploader.UploadingArtifactCache(
+                bc.lac.cachefs, uploader, artifact.source.cache_key)
+
         bc.build_source(artifact.source, bc.new_build_env(arch))
 
+        if bc.rac is not rac:
+            for server, size in sorted(bc.rac.transferred.iteritems()):
+                self.app.status(msg='Fetched %(size)d bytes from %(server)s',
+                                size=size, server=server)
+        if uploader is not None:
+            bc.lac.finish()
+            uploader.wait()
+
+    def read_peers(self, line):
+        '''Return which other workers hold which artifacts.
+
+        The controller may send this as a line of JSON after the
+        artifact to build. It maps the basenames of artifacts the build
+        depends on to the URLs of the artifact cache servers of workers
+        which hold them.
+
+        '''
+
+        if not line.strip():
+            return {}
+        try:
+            return json.loads(line)['peers']
+        except (ValueError, KeyError, TypeError), e:
+            logging.warning('Ignoring peers from the controller: %s' % e)
+            return {}
+
     def is_system_artifact(self, filename):
         return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
 
+
+class WorkerCacheSummary(cliapp.Plugin):
+
+    def enable(self):
+        self.app.add_subcommand(
+            'worker-cache-summary', self.worker_cache_summary,
+            arg_synopsis='')
+
+    def disable(self):
+        pass
+
+    def worker_cache_summary(self, args):
+        '''Internal use only: Summarise the capacity and caches of a worker.
+
+        Write how many jobs the worker runs at once, a Bloom filter of
+        the artifacts in the local artifact cache and the repositories in
+        the local git cache, and that worker-build can upload what it
+        builds, as one line of JSON, for the controller to tell how many
+        jobs to give the worker, which ones, and how to cache them.
+
+        '''
+
+        distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+
+        lac, rac = morphlib.util.new_artifact_caches(self.app.settings)
+        keys = [distbuild.artifact_summary_key(os.path.basename(filename))
+                for filename in lac.cachefs.walkfiles()]
+
+        gits_dir = os.path.join(self.app.settings['cachedir'], 'gits')
+        if os.path.isdir(gits_dir):
+            keys.extend(distbuild.repo_summary_key(name)
+                        for name in os.listdir(gits_dir))
+
+        # Leave room for what the controller adds to the summary between
+        # one summary and the next.
+        bloom = distbuild.BloomFilter.for_capacity(max(1024, 2 * len(keys)))
+        for key in keys:
+            bloom.add(key)
+        summary = {
+            'slots': worker_slots(self.app.settings),
+            'caches': bloom.encode(),
+            'uploads': True,
+        }
+        self.app.output.write(json.dumps(summary))
+        self.app.output.write('\n')
+
+
+def worker_slots(settings):  # pragma: no cover
+    '''Return how many jobs a worker runs at once.
+
+    This is the worker-slots setting, or if that is 0, one for every
+    four cores and 4 GiB of memory the worker has, but at least one.
+
+    '''
+
+    slots = settings['worker-slots']
+    if slots > 0:
+        return slots
+    memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return max(1, min(morphlib.util.cpu_count() / 4, memory / (4 << 30)))
+
+
 class WorkerDaemon(cliapp.Plugin):
 
     def enable(self):
@@ -135,6 +366,13 @@ class WorkerDaemon(cliapp.Plugin):
             'write port used by worker-daemon to FILE',
             default='',
             group=group_distbuild)
+        self.app.settings.integer(
+            ['worker-slots'],
+            'run up to N jobs at once on this worker (default: one for '
+                'every four cores and 4 GiB of memory)',
+            metavar='N',
+            default=0,
+            group=group_distbuild)
         self.app.add_subcommand(
             'worker-daemon',
             self.worker_daemon,
@@ -151,7 +389,9 @@ class WorkerDaemon(cliapp.Plugin):
         address = self.app.settings['worker-daemon-address']
         port = self.app.settings['worker-daemon-port']
         port_file = self.app.settings['worker-daemon-port-file']
+        slots = worker_slots(self.app.settings)
         router = distbuild.ListenServer(address, port, distbuild.JsonRouter,
+                                        extra_args=[slots],
                                         port_file=port_file)
         loop = distbuild.MainLoop()
         loop.add_state_machine(router)
@@ -226,6 +466,14 @@ class ControllerDaemon(cliapp.Plugin):
             metavar='FILENAME',
             default='morph',
             group=group_distbuild)
+        self.app.settings.string(
+            ['build-times-file'],
+            'remember how long build steps took in FILENAME, to start the '
+                'longest chains of steps first (default: '
+                'distbuild-build-times.json in the cache directory)',
+            metavar='FILENAME',
+            default='',
+            group=group_distbuild)
 
         self.app.add_subcommand(
             'controller-daemon', self.controller_daemon, arg_synopsis='')
@@ -245,6 +493,10 @@ class ControllerDaemon(cliapp.Plugin):
         worker_cache_server_port = \
             self.app.settings['worker-cache-server-port']
         morph_instance = self.app.settings['morph-instance']
+        build_times = distbuild.BuildTimes(
+            self.app.settings['build-times-file'] or
+            os.path.join(self.app.settings['cachedir'],
+                         'distbuild-build-times.json'))
 
         listener_specs = [
             # address, port, class to initiate on connection, class init args
@@ -254,12 +506,14 @@ class ControllerDaemon(cliapp.Plugin):
             ('controller-initiator-address', 'controller-initiator-port',
              'controller-initiator-port-file',
              distbuild.InitiatorConnection, 
-             [artifact_cache_server, morph_instance]),
+             [artifact_cache_server, morph_instance, build_times]),
         ]
 
         loop = distbuild.MainLoop()
         
-        queuer = distbuild.WorkerBuildQueuer()
+        repo_resolver = morphlib.repoaliasresolver.RepoAliasResolver(
+            self.app.settings['repo-alias'])
+        queuer = distbuild.WorkerBuildQueuer(build_times, repo_resolver)
         loop.add_state_machine(queuer)
 
         for addr, port, port_file, sm, extra_args in listener_specs:
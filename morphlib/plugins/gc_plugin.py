@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -58,8 +58,8 @@ class GCPlugin(cliapp.Plugin):
            --cachedir-artifact-keep-younger-than if it still needs to make
            space.
 
-           It also removes any left over temporary chunks and staging areas
-           from failed builds.
+           It also removes any left over staging areas from failed builds,
+           and unpacked chunks that no build is using.
 
            In addition we remove failed deployments, generally these are
            cleared up by morph during deployment but in some cases they
@@ -83,7 +83,7 @@ class GCPlugin(cliapp.Plugin):
         # assumes that they exist in various places.
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
+        for subdir in ('deployments', 'failed', 'snapshots', 'chunks'):
             if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
@@ -93,6 +93,11 @@ class GCPlugin(cliapp.Plugin):
             self.app.status(msg='Removing temp subdirectory: %(subdir)s',
                             subdir=subdir)
             path = os.path.join(temp_path, subdir)
+            if subdir == 'chunks' and os.path.exists(path):
+                # Other builds may be installing some of the chunks, so
+                # only those that no build is using are removed.
+                morphlib.chunkcache.UnpackedChunkCache(path, 0).evict()
+                continue
             if os.path.exists(path):
                 shutil.rmtree(path)
             os.mkdir(path)
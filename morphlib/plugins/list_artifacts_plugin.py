@@ -1,4 +1,4 @@
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -60,6 +60,9 @@ class ListArtifactsPlugin(cliapp.Plugin):
 
         self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
         self.resolver = morphlib.artifactresolver.ArtifactResolver()
+        self.graph_cache = morphlib.util.new_graph_cache(self.app.settings)
+        self.morphology_cache = morphlib.util.new_morphology_cache(
+            self.app.settings)
 
         artifact_files = set()
         for system_filename in system_filenames:
@@ -73,6 +76,42 @@ class ListArtifactsPlugin(cliapp.Plugin):
     def list_artifacts_for_system(self, repo, ref, system_filename):
         '''List all artifact files in the build graph of a single system.'''
 
+        if self.graph_cache is None:
+            system_artifact = self.resolve_system_artifact(
+                repo, ref, system_filename)
+        else:
+            source_resolver = morphlib.sourceresolver.SourceResolver(
+                self.lrc, self.rrc, not self.app.settings['no-git-update'],
+                self.app.status, self.morphology_cache)
+            sha1, tree = source_resolver.resolve_ref(repo, ref)
+            key = self.graph_cache.key(repo, sha1, system_filename, ref)
+            system_artifact = self.graph_cache.get(
+                key, source_resolver.resolve_refs)
+            if system_artifact is None:
+                system_artifact = self.resolve_system_artifact(
+                    repo, ref, system_filename)
+                self.graph_cache.put(key, system_artifact)
+
+        artifact_files = set()
+        for artifact in system_artifact.walk():
+
+            artifact_files.add(artifact.basename())
+
+            if artifact.source.morphology.needs_artifact_metadata_cached:
+                artifact_files.add('%s.meta' % artifact.basename())
+
+            # This is unfortunate hardwiring of behaviour; in future we
+            # should list all artifacts in the meta-artifact file, so we
+            # don't have to guess what files there will be.
+            artifact_files.add('%s.meta' % artifact.source.cache_key)
+            if artifact.source.morphology['kind'] == 'chunk':
+                artifact_files.add('%s.build-log' % artifact.source.cache_key)
+
+        return artifact_files
+
+    def resolve_system_artifact(self, repo, ref, system_filename):
+        '''Resolve the build graph of a system and compute cache keys.'''
+
         # Sadly, we must use a fresh source pool and a fresh list of artifacts
         # for each system. Creating a source pool is slow (queries every Git
         # repo involved in the build) and resolving artifacts isn't so quick
@@ -87,7 +126,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
         source_pool = morphlib.sourceresolver.create_source_pool(
             self.lrc, self.rrc, repo, ref, system_filename,
             update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            morphology_cache=self.morphology_cache)
 
         self.app.status(
             msg='Resolving artifacts for %s' % system_filename, chatty=True)
@@ -112,19 +152,4 @@ class ListArtifactsPlugin(cliapp.Plugin):
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
 
-        artifact_files = set()
-        for artifact in system_artifact.walk():
-
-            artifact_files.add(artifact.basename())
-
-            if artifact.source.morphology.needs_artifact_metadata_cached:
-                artifact_files.add('%s.meta' % artifact.basename())
-
-            # This is unfortunate hardwiring of behaviour; in future we
-            # should list all artifacts in the meta-artifact file, so we
-            # don't have to guess what files there will be.
-            artifact_files.add('%s.meta' % artifact.source.cache_key)
-            if artifact.source.morphology['kind'] == 'chunk':
-                artifact_files.add('%s.build-log' % artifact.source.cache_key)
-
-        return artifact_files
+        return system_artifact
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,16 +15,13 @@
 
 
 import cliapp
+import json
 import logging
 import urllib
 import urllib2
 import urlparse
 
-
-class HeadRequest(urllib2.Request):  # pragma: no cover
-
-    def get_method(self):
-        return 'HEAD'
+import morphlib
 
 
 class GetError(cliapp.AppException):
@@ -56,8 +53,9 @@ class GetSourceMetadataError(GetError):
 
 class RemoteArtifactCache(object):
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, pool=None):
         self.server_url = server_url
+        self._pool = pool or morphlib.httppool.default_pool
 
     def has(self, artifact):
         return self._has_file(artifact.basename())
@@ -69,6 +67,24 @@ class RemoteArtifactCache(object):
         filename = '%s.%s' % (cachekey, name)
         return self._has_file(filename)
 
+    def has_many(self, artifacts):
+        '''Return the set of ``artifacts`` which are in the cache.
+
+        This asks the server about all the artifacts in one request, which
+        is much quicker than calling ``has`` for each one.
+
+        '''
+        return self._has_many(artifacts, lambda a: a.basename())
+
+    def has_many_artifact_metadata(self, artifacts, name):
+        '''Return the set of ``artifacts`` whose metadata is in the cache.'''
+        return self._has_many(artifacts, lambda a: a.metadata_basename(name))
+
+    def _has_many(self, objects, filename_of):
+        objects = list(objects)
+        cached = self._has_files([filename_of(o) for o in objects])
+        return set(o for o in objects if cached.get(filename_of(o)))
+
     def get(self, artifact, log=logging.error):
         try:
             return self._get_file(artifact.basename())
@@ -93,25 +109,41 @@ class RemoteArtifactCache(object):
     def _has_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
-        request = HeadRequest(url)
         try:
-            urllib2.urlopen(request)
+            self._pool.request('HEAD', url).close()
             return True
         except (urllib2.HTTPError, urllib2.URLError):
             return False
 
+    def _has_files(self, filenames):  # pragma: no cover
+        if not filenames:
+            return {}
+        url = self._url('/1.0/artifacts')
+        logging.debug('RemoteArtifactCache._has_files: url=%s, %d files' %
+                      (url, len(filenames)))
+        try:
+            return json.load(self._pool.request(
+                'POST', url, json.dumps(filenames),
+                {'Content-type': 'application/json'}))
+        except (urllib2.HTTPError, urllib2.URLError, ValueError), e:
+            logging.debug('Asking for many files failed, asking for each '
+                          'one instead: %s' % e)
+            return dict((f, self._has_file(f)) for f in filenames)
+
     def _get_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
-        return urllib2.urlopen(url)
+        return self._pool.request('GET', url)
 
     def _request_url(self, filename):  # pragma: no cover
+        return self._url('/1.0/artifacts?filename=%s' %
+                         urllib.quote(filename))
+
+    def _url(self, path):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        return urlparse.urljoin(
-            server_url, '/1.0/artifacts?filename=%s' % 
-            urllib.quote(filename))
+        return urlparse.urljoin(server_url, path)
 
     def __str__(self):  # pragma: no cover
         return self.server_url
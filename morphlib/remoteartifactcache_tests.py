@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -68,11 +68,15 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(
             self.server_url)
         self.cache._has_file = self._has_file
+        self.cache._has_files = self._has_files
         self.cache._get_file = self._get_file
 
     def _has_file(self, filename):
         return filename in self.existing_files
 
+    def _has_files(self, filenames):
+        return dict((f, f in self.existing_files) for f in filenames)
+
     def _get_file(self, filename):
         if filename in self.existing_files:
             return StringIO.StringIO('%s' % filename)
@@ -91,6 +95,21 @@ class RemoteArtifactCacheTests(unittest.TestCase):
     def test_does_not_have_a_non_existent_artifact(self):
         self.assertFalse(self.cache.has(self.doc_artifact))
 
+    def test_has_many_artifacts(self):
+        self.assertEqual(
+            self.cache.has_many([self.runtime_artifact, self.devel_artifact,
+                                 self.doc_artifact]),
+            set([self.runtime_artifact, self.devel_artifact]))
+
+    def test_has_many_of_no_artifacts(self):
+        self.assertEqual(self.cache.has_many([]), set())
+
+    def test_has_many_artifact_metadata(self):
+        self.assertEqual(
+            self.cache.has_many_artifact_metadata(
+                [self.runtime_artifact, self.devel_artifact], 'meta'),
+            set([self.runtime_artifact]))
+
     def test_has_existing_artifact_metadata(self):
         self.assertTrue(self.cache.has_artifact_metadata(
             self.runtime_artifact, 'meta'))
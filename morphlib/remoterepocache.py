@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
 import json
 import logging
@@ -21,6 +22,8 @@ import urllib2
 import urlparse
 import urllib
 
+import morphlib
+
 
 class ResolveRefError(cliapp.AppException):
 
@@ -47,9 +50,10 @@ class LsTreeError(cliapp.AppException):
 
 class RemoteRepoCache(object):
 
-    def __init__(self, server_url, resolver):
+    def __init__(self, server_url, resolver, pool=None):
         self.server_url = server_url
         self._resolver = resolver
+        self._pool = pool or morphlib.httppool.default_pool
 
     def resolve_ref(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
@@ -69,6 +73,58 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo_name, ref) pairs with a single request.
+
+        Returns a dict mapping each pair the server could resolve to its
+        commit and tree sha1s. Pairs it could not resolve are left out, as
+        are all of them if the request fails, so that callers can fall
+        back to resolving those some other way.
+
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        query = [{'repo': self._resolver.pull_url(repo_name), 'ref': ref}
+                 for repo_name, ref in pairs]
+        try:
+            results = json.loads(self._resolve_refs_for_repo_urls(query))
+        except Exception, e:
+            logging.error('Caught exception: %s' % str(e))
+            return {}
+        resolved = {}
+        for pair, result in zip(pairs, results):
+            if 'error' not in result:
+                resolved[pair] = (result['sha1'], result['tree'])
+        return resolved
+
+    def cat_files(self, triples):
+        '''Read many (repo_name, ref, filename) files with a single request.
+
+        Returns a dict mapping each triple to the contents of the file, or
+        to None if the server says the file does not exist. Triples are
+        left out if the request fails.
+
+        '''
+        triples = list(triples)
+        if not triples:
+            return {}
+        query = [{'repo': self._resolver.pull_url(repo_name), 'ref': ref,
+                  'filename': filename}
+                 for repo_name, ref, filename in triples]
+        try:
+            results = json.loads(self._cat_files_for_repo_urls(query))
+        except Exception, e:
+            logging.error('Caught exception: %s' % str(e))
+            return {}
+        contents = {}
+        for triple, result in zip(triples, results):
+            if 'error' in result:
+                contents[triple] = None
+            else:
+                contents[triple] = base64.b64decode(result['data'])
+        return contents
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -90,6 +146,12 @@ class RemoteRepoCache(object):
             'files?repo=%s&ref=%s&filename=%s'
             % self._quote_strings(repo_url, ref, filename))
 
+    def _resolve_refs_for_repo_urls(self, query):  # pragma: no cover
+        return self._make_post_request('sha1s', query)
+
+    def _cat_files_for_repo_urls(self, query):  # pragma: no cover
+        return self._make_post_request('files', query)
+
     def _ls_tree_for_repo_url(self, repo_url, ref):  # pragma: no cover
         return self._make_request(
             'trees?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
@@ -98,9 +160,15 @@ class RemoteRepoCache(object):
         return tuple(urllib.quote(string) for string in args)
 
     def _make_request(self, path):  # pragma: no cover
+        return self._pool.request('GET', self._url(path)).read()
+
+    def _make_post_request(self, path, data):  # pragma: no cover
+        headers = {'Content-type': 'application/json'}
+        return self._pool.request('POST', self._url(path), json.dumps(data),
+                                  headers).read()
+
+    def _url(self, path):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
-        return handle.read()
+        return urlparse.urljoin(server_url, '/1.0/%s' % path)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -40,6 +41,29 @@ class RemoteRepoCacheTests(unittest.TestCase):
             'tree': self.files[repo_url][sha1]
         })
 
+    def _resolve_refs_for_repo_urls(self, query):
+        results = []
+        for item in query:
+            try:
+                sha1 = self.sha1s[item['repo']][item['ref']]
+                results.append(dict(item, sha1=sha1[0], tree=sha1[1]))
+            except KeyError:
+                results.append(dict(item, error='not found'))
+        return json.dumps(results)
+
+    def _cat_files_for_repo_urls(self, query):
+        results = []
+        for item in query:
+            try:
+                data = self.files[item['repo']][item['ref']][item['filename']]
+                results.append(dict(item, data=base64.b64encode(data)))
+            except KeyError:
+                results.append(dict(item, error='not found'))
+        return json.dumps(results)
+
+    def _fail_request(self, query):
+        raise urllib2.URLError('connection refused')
+
     def setUp(self):
         self.sha1s = {
             'git://gitorious.org/baserock/morph': {
@@ -64,6 +88,9 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
 
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
@@ -136,3 +163,42 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.remoterepocache.LsTreeError,
                           self.cache.ls_tree, 'non-existent-repo',
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+
+    def test_resolve_refs_in_one_request(self):
+        self.sha1s['git://gitorious.org/baserock/morph']['master'] = \
+            ('e28a23812eadf2fce6583b8819b9c5dbd36b9fb9', 'tree')
+        resolved = self.cache.resolve_refs([
+            ('baserock:morph', 'master'),
+            ('baserock:morph', 'non-existent-ref'),
+            ('non-existent-repo', 'master')])
+        self.assertEqual(resolved, {
+            ('baserock:morph', 'master'):
+                ('e28a23812eadf2fce6583b8819b9c5dbd36b9fb9', 'tree')})
+
+    def test_resolve_no_refs_without_a_request(self):
+        self.cache._resolve_refs_for_repo_urls = self._fail_request
+        self.assertEqual(self.cache.resolve_refs([]), {})
+
+    def test_resolve_refs_returns_nothing_when_request_fails(self):
+        self.cache._resolve_refs_for_repo_urls = self._fail_request
+        self.assertEqual(
+            self.cache.resolve_refs([('baserock:morph', 'master')]), {})
+
+    def test_cat_files_in_one_request(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        contents = self.cache.cat_files([
+            ('upstream:linux', sha1, 'linux.morph'),
+            ('upstream:linux', sha1, 'non-existent-file')])
+        self.assertEqual(contents, {
+            ('upstream:linux', sha1, 'linux.morph'): 'linux morphology',
+            ('upstream:linux', sha1, 'non-existent-file'): None})
+
+    def test_cat_no_files_without_a_request(self):
+        self.cache._cat_files_for_repo_urls = self._fail_request
+        self.assertEqual(self.cache.cat_files([]), {})
+
+    def test_cat_files_returns_nothing_when_request_fails(self):
+        self.cache._cat_files_for_repo_urls = self._fail_request
+        self.assertEqual(
+            self.cache.cat_files([('upstream:linux', 'sha1', 'a.morph')]),
+            {})
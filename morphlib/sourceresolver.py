@@ -1,4 +1,4 @@
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,6 +18,8 @@ import cliapp
 
 import collections
 import logging
+import sys
+import threading
 
 import morphlib
 
@@ -46,10 +48,14 @@ class SourceResolver(object):
 
     '''
 
+    # How many locally cached repos to resolve refs in at once.
+    resolve_threads = 8
+
     def __init__(self, local_repo_cache, remote_repo_cache, update_repos,
-                 status_cb=None):
+                 status_cb=None, morphology_cache=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
+        self.morphology_cache = morphology_cache
 
         self.update = update_repos
 
@@ -65,14 +71,8 @@ class SourceResolver(object):
 
         if self.lrc.has_repo(reponame):
             repo = self.lrc.get_repo(reponame)
-            if self.update and repo.requires_update_for_ref(ref):
-                self.status(msg='Updating cached git repository %(reponame)s '
-                            'for ref %(ref)s', reponame=reponame, ref=ref)
-                repo.update()
-            # If the user passed --no-git-update, and the ref is a SHA1 not
-            # available locally, this call will raise an exception.
-            absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+            self._update_cached_repo(repo, reponame, ref)
+            absref, tree = self._resolve_in_cached_repo(repo, ref)
         elif self.rrc is not None:
             try:
                 absref, tree = self.rrc.resolve_ref(reponame, ref)
@@ -85,29 +85,126 @@ class SourceResolver(object):
             except BaseException, e:
                 logging.warning('Caught (and ignored) exception: %s' % str(e))
         if absref is None:
-            if self.update:
-                self.status(msg='Caching git repository %(reponame)s',
-                            reponame=reponame)
-                repo = self.lrc.cache_repo(reponame)
-                repo.update()
-            else:
+            absref, tree = self._cache_and_resolve_ref(reponame, ref)
+        return absref, tree
+
+    def resolve_refs(self, pairs):
+        '''Resolve many (reponame, ref) pairs, as resolve_ref does.
+
+        Returns a dict mapping each pair to its commit and tree sha1s.
+        Repos in the local repo cache are updated first, one at a time.
+        Their refs are then resolved concurrently, one thread per repo,
+        since each takes a git subprocess. The threads only read from the
+        repos they are given, and never use the local repo cache itself,
+        which is not safe to share between threads. Meanwhile the remote
+        repo cache is asked about the refs in other repos with a single
+        request. Refs it cannot resolve, and refs in repos that are not
+        cached anywhere, are resolved by cloning, one at a time, once the
+        threads are done. If any pair cannot be resolved, the error for
+        the first of them in ``pairs`` is raised.
+
+        '''
+        local = collections.OrderedDict()
+        remote = []
+        uncached = []
+        for pair in pairs:
+            reponame, ref = pair
+            if self.lrc.has_repo(reponame):
                 repo = self.lrc.get_repo(reponame)
-            absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+                local.setdefault(repo.path, []).append((pair, repo))
+            elif self.rrc is not None:
+                remote.append(pair)
+            else:
+                uncached.append(pair)
+
+        resolved = {}
+        errors = {}
+
+        def attempt(pair, function, *args):
+            try:
+                resolved[pair] = function(*args)
+            except BaseException:
+                errors[pair] = sys.exc_info()
+
+        groups = collections.deque()
+        for group in local.itervalues():
+            updated = []
+            for pair, repo in group:
+                attempt(pair, self._update_cached_repo, repo, *pair)
+                if pair not in errors:
+                    updated.append((pair, repo))
+            groups.append(updated)
+
+        def resolve_groups():
+            while True:
+                try:
+                    group = groups.popleft()
+                except IndexError:
+                    return
+                for pair, repo in group:
+                    attempt(pair, self._resolve_in_cached_repo, repo, pair[1])
+
+        threads = [threading.Thread(target=resolve_groups)
+                   for i in xrange(min(self.resolve_threads, len(groups)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        if remote:
+            found = self.rrc.resolve_refs(remote)
+            if found:
+                self.status(msg='Resolved %(count)d refs via remote repo '
+                            'cache', count=len(found), chatty=True)
+            resolved.update(found)
+            uncached.extend(pair for pair in remote if pair not in found)
+
+        for thread in threads:
+            # Joining with a timeout lets KeyboardInterrupt through.
+            while thread.is_alive():
+                thread.join(1.0)
+
+        for pair in uncached:
+            attempt(pair, self._cache_and_resolve_ref, *pair)
+
+        for pair in pairs:
+            if pair in errors:
+                exc_type, exc_value, exc_tb = errors[pair]
+                raise exc_type, exc_value, exc_tb
+        return resolved
+
+    def _update_cached_repo(self, repo, reponame, ref):
+        if self.update and repo.requires_update_for_ref(ref):
+            self.status(msg='Updating cached git repository %(reponame)s '
+                        'for ref %(ref)s', reponame=reponame, ref=ref)
+            repo.update()
+
+    def _resolve_in_cached_repo(self, repo, ref):
+        # If the user passed --no-git-update, and the ref is a SHA1 not
+        # available locally, this call will raise an exception.
+        absref = repo.resolve_ref_to_commit(ref)
+        tree = repo.resolve_ref_to_tree(absref)
         return absref, tree
 
+    def _cache_and_resolve_ref(self, reponame, ref):
+        if self.update:
+            self.status(msg='Caching git repository %(reponame)s',
+                        reponame=reponame)
+            repo = self.lrc.cache_repo(reponame)
+            repo.update()
+        else:
+            repo = self.lrc.get_repo(reponame)
+        return self._resolve_in_cached_repo(repo, ref)
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
                         definitions_original_ref=None):
         morph_factory = morphlib.morphologyfactory.MorphologyFactory(
-            self.lrc, self.rrc, self.status)
+            self.lrc, self.rrc, self.status, self.morphology_cache)
         definitions_queue = collections.deque(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
 
-        resolved_commits = {}
-        resolved_trees = {}
         resolved_morphologies = {}
 
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
@@ -122,6 +219,11 @@ class SourceResolver(object):
 
             key = (definitions_repo, definitions_absref, filename)
             if not key in resolved_morphologies:
+                # Read this morphology along with everything else already
+                # queued, which is the rest of this level of the graph.
+                morph_factory.prefetch_morphologies(
+                    [key] + [(definitions_repo, definitions_absref, f)
+                             for f in definitions_queue])
                 resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
 
@@ -149,13 +251,22 @@ class SourceResolver(object):
                     chunk_in_definitions_repo_queue.append(
                         (c['repo'], c['ref'], c['morph']))
 
+        # Resolve the refs of all the chunks at once, and then read all
+        # their morphologies at once, rather than one at a time.
+        chunk_refs = collections.OrderedDict()
+        for repo, ref, filename in (chunk_in_definitions_repo_queue +
+                                    chunk_in_source_repo_queue):
+            chunk_refs[repo, ref] = None
+        resolved_refs = self.resolve_refs(chunk_refs.keys())
+
+        morph_factory.prefetch_morphologies(
+            [(definitions_repo, definitions_absref, filename)
+             for repo, ref, filename in chunk_in_definitions_repo_queue] +
+            [(repo, resolved_refs[repo, ref][0], filename)
+             for repo, ref, filename in chunk_in_source_repo_queue])
+
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved_refs[repo, ref]
             key = (definitions_repo, definitions_absref, filename)
             if not key in resolved_morphologies:
                 resolved_morphologies[key] = morph_factory.get_morphology(*key)
@@ -163,12 +274,7 @@ class SourceResolver(object):
             visit(repo, ref, filename, absref, tree, morphology)
 
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved_refs[repo, ref]
             key = (repo, absref, filename)
             if key not in resolved_morphologies:
                 resolved_morphologies[key] = morph_factory.get_morphology(*key)
@@ -178,7 +284,7 @@ class SourceResolver(object):
 
 def create_source_pool(lrc, rrc, repo, ref, filename,
                        original_ref=None, update_repos=True,
-                       status_cb=None):
+                       status_cb=None, morphology_cache=None):
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -190,7 +296,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     implementation, and so they must be handled separately.
 
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
-    caches used for resolving the sources.
+    caches used for resolving the sources. Morphologies are loaded through
+    'morphology_cache', if given.
 
     '''
     pool = morphlib.sourcepool.SourcePool()
@@ -202,7 +309,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
         for source in sources:
             pool.add(source)
 
-    resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              morphology_cache)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
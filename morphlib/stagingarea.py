@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,10 +14,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import errno
 import logging
 import os
+import Queue
 import shutil
 import stat
+import sys
+import threading
 import cliapp
 from urlparse import urlparse
 import tempfile
@@ -25,6 +29,91 @@ import tempfile
 import morphlib
 
 
+# Entries of a manifest, other than directories, are installed in batches
+# of this many, by up to this many threads at once. Threads help while
+# the file system is slow to make links, as on NFS, but on a fast local
+# file system more than two just contend for the interpreter lock.
+MANIFEST_BATCH_SIZE = 1000
+MANIFEST_THREADS = 2
+
+
+def make_manifest(srcpath):
+    '''Return a list of everything in a directory, to install it.
+
+    Each entry is a tuple of a letter for what kind of file it is, its
+    path relative to srcpath, and what else is needed to make it:
+
+    * ``('d', path)`` for a directory
+    * ``('f', path)`` for a regular file
+    * ``('l', path, target)`` for a symbolic link
+    * ``('n', path, mode, rdev)`` for a block or character device
+    * ``('x', path)`` for anything else, which cannot be installed
+
+    Every directory comes before what is in it.
+
+    '''
+
+    manifest = []
+    for dirname, subdirs, basenames in os.walk(srcpath):
+        for name in subdirs + basenames:
+            src = os.path.join(dirname, name)
+            path = os.path.relpath(src, srcpath)
+            st = os.lstat(src)
+            mode = st.st_mode
+            if stat.S_ISDIR(mode):
+                manifest.append(('d', path))
+            elif stat.S_ISREG(mode):
+                manifest.append(('f', path))
+            elif stat.S_ISLNK(mode):
+                manifest.append(('l', path, os.readlink(src)))
+            elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+                manifest.append(('n', path, mode, st.st_rdev))
+            else:
+                manifest.append(('x', path))
+    return manifest
+
+
+# A manifest is saved as its fields, each followed by a NUL byte, since
+# paths may hold any other byte. Each kind of entry has a fixed number of
+# fields.
+_manifest_fields = {'d': 1, 'f': 1, 'l': 2, 'n': 3, 'x': 1}
+
+
+def write_manifest(filename, manifest):
+    '''Save a manifest made by make_manifest.'''
+
+    with morphlib.savefile.SaveFile(filename, 'wb') as f:
+        for entry in manifest:
+            f.write('\0'.join(str(field) for field in entry))
+            f.write('\0')
+
+
+def read_manifest(filename):
+    '''Load a manifest saved by write_manifest.
+
+    Raise ValueError if it is not a valid manifest.
+
+    '''
+
+    with open(filename, 'rb') as f:
+        fields = f.read().split('\0')
+    if fields.pop() != '':
+        raise ValueError('%s is not a valid manifest' % filename)
+    manifest = []
+    i = 0
+    while i < len(fields):
+        kind = fields[i]
+        count = _manifest_fields.get(kind)
+        if count is None or i + count >= len(fields):
+            raise ValueError('%s is not a valid manifest' % filename)
+        entry = fields[i:i + count + 1]
+        if kind == 'n':
+            entry[2:] = [int(x) for x in entry[2:]]
+        manifest.append(tuple(entry))
+        i += count + 1
+    return manifest
+
+
 class StagingArea(object):
 
     '''Represent the staging area for building software.
@@ -35,17 +124,34 @@ class StagingArea(object):
     system. Chunks built in 'test' or 'build-essential' mode have an empty
     staging area and are allowed to use the tools of the host.
 
+    If a ``jobserver`` is given, every command run in the staging area
+    with MAKEFLAGS naming its fds is lent tokens from it, to share make
+    jobs with other builds on the host.
+
+    Chunks are installed from ``chunk_cache``, an UnpackedChunkCache
+    shared with other builds. By default, one without a size limit is
+    made in the ``chunks`` directory of tempdir.
+
     '''
 
     _base_path = ['/sbin', '/usr/sbin', '/bin', '/usr/bin']
 
     def __init__(self, app, dirname, build_env, use_chroot=True, extra_env={},
-                 extra_path=[]):
+                 extra_path=[], jobserver=None, chunk_cache=None):
         self._app = app
         self.dirname = dirname
         self.builddirname = None
         self.destdirname = None
         self._bind_readonly_mount = None
+        self.jobserver = jobserver
+        self._chunk_cache = chunk_cache
+        # What to mount read-only for each root and set of writable paths
+        # that commands have run with, and the listings it was worked out
+        # from, since the installed tree stays the same between them.
+        self._readonly_paths = {}
+        # The artifacts installed and the listing to keep the staging area
+        # as a snapshot of, if it is to be kept; see StagingAreaCache.
+        self.snapshot = None
 
         self.use_chroot = use_chroot
         self.env = build_env.env
@@ -67,6 +173,7 @@ class StagingArea(object):
         dirname = os.path.join(self.dirname,
                                '%s.%s' % (str(source.name), suffix))
         self._mkdir(dirname)
+        self._readonly_paths.clear()
         return dirname
 
     def builddir(self, source):
@@ -101,51 +208,125 @@ class StagingArea(object):
         assert filename.startswith(dirname)
         return filename[len(dirname) - 1:]  # include leading slash
 
-    def hardlink_all_files(self, srcpath, destpath): # pragma: no cover
+    def hardlink_all_files(self, srcpath, destpath):
         '''Hardlink every file in the path to the staging-area
 
         If an exception is raised, the staging-area is indeterminate.
 
         '''
 
-        file_stat = os.lstat(srcpath)
-        mode = file_stat.st_mode
+        self.install_manifest(srcpath, make_manifest(srcpath), destpath)
 
-        if stat.S_ISDIR(mode):
-            # Ensure directory exists in destination, then recurse.
-            if not os.path.lexists(destpath):
-                os.makedirs(destpath)
-            dest_stat = os.stat(os.path.realpath(destpath))
-            if not stat.S_ISDIR(dest_stat.st_mode):
-                raise IOError('Destination not a directory. source has %s'
-                              ' destination has %s' % (srcpath, destpath))
-
-            for entry in os.listdir(srcpath):
-                self.hardlink_all_files(os.path.join(srcpath, entry),
-                                        os.path.join(destpath, entry))
-        elif stat.S_ISLNK(mode):
-            # Copy the symlink.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.symlink(os.readlink(srcpath), destpath)
-
-        elif stat.S_ISREG(mode):
-            # Hardlink the file.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.link(srcpath, destpath)
-
-        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-            # Block or character device. Put contents of st_dev in a mknod.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-            os.chmod(destpath, file_stat.st_mode)
+    def install_manifest(self, srcpath, manifest, destpath):
+        '''Hardlink what a manifest of srcpath lists to destpath.
 
-        else:
-            # Unsupported type.
-            raise IOError('Cannot extract %s into staging-area. Unsupported'
-                          ' type.' % srcpath)
+        This does what ``hardlink_all_files`` does, using the list of
+        what is in srcpath that ``make_manifest`` made, instead of
+        looking at every file again. Directories are made first, and then
+        everything else is linked, spread over a few threads if there is
+        much of it.
+
+        Entries may be installed in the same place, through symbolic
+        links to directories. They replace each other in the order of the
+        manifest, even when spread over threads.
+
+        If an exception is raised, the staging-area is indeterminate.
+
+        '''
+
+        others = []
+        for entry in manifest:
+            if entry[0] == 'd':
+                self._install_dir(srcpath, destpath, entry[1])
+            else:
+                others.append(entry)
+
+        if len(others) <= MANIFEST_BATCH_SIZE:
+            self._install_entries(srcpath, destpath, others)
+            return
+
+        # Only the last entry for each place is installed, so that no two
+        # threads install to the same place.
+        others = self._last_for_each_place(destpath, others)
+        batches = [others[i:i + MANIFEST_BATCH_SIZE]
+                   for i in xrange(0, len(others), MANIFEST_BATCH_SIZE)]
+
+        queue = Queue.Queue()
+        for batch in batches:
+            queue.put(batch)
+        errors = []
+
+        def install_batches():
+            while not errors:
+                try:
+                    batch = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._install_entries(srcpath, destpath, batch)
+                except BaseException:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=install_batches)
+                   for i in xrange(min(MANIFEST_THREADS, len(batches)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _last_for_each_place(self, destpath, entries):
+        '''Return entries without those that later ones would replace.'''
+
+        realdirs = {}
+        places = {}
+        for i, entry in enumerate(entries):
+            dirname, basename = os.path.split(entry[1])
+            if dirname not in realdirs:
+                realdirs[dirname] = os.path.realpath(
+                    os.path.join(destpath, dirname))
+            places[(realdirs[dirname], basename)] = i
+        return [entries[i] for i in sorted(places.itervalues())]
+
+    def _install_dir(self, srcpath, destpath, path):
+        dest = os.path.join(destpath, path)
+        try:
+            os.mkdir(dest)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            # The destination may be a symlink to a directory.
+            if not os.path.isdir(dest):
+                raise IOError('Destination not a directory. source has %s'
+                              ' destination has %s' %
+                              (os.path.join(srcpath, path), dest))
+
+    def _install_entries(self, srcpath, destpath, entries):
+        for entry in entries:
+            kind, path = entry[:2]
+            src = os.path.join(srcpath, path)
+            dest = os.path.join(destpath, path)
+            for attempt in (1, 2):
+                try:
+                    if kind == 'f':
+                        os.link(src, dest)
+                    elif kind == 'l':
+                        os.symlink(entry[2], dest)
+                    elif kind == 'n':
+                        mode, rdev = entry[2:]
+                        os.mknod(dest, mode, rdev)
+                        os.chmod(dest, mode)
+                    else:
+                        raise IOError('Cannot extract %s into staging-area. '
+                                      'Unsupported type.' % src)
+                    break
+                except OSError, e:
+                    # Replace what an earlier chunk installed there.
+                    if e.errno != errno.EEXIST or attempt == 2:
+                        raise
+                    os.remove(dest)
 
     def install_artifact(self, handle):
         '''Install a build artifact into the staging area.
@@ -155,29 +336,56 @@ class StagingArea(object):
 
         '''
 
-        chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
+        def unpack(dirname):
             self._app.status(
                 msg='Unpacking chunk from cache %(filename)s',
                 filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
-            try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException, e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
+            morphlib.bins.unpack_binary_from_file(handle, dirname + '/')
+
+        if self._chunk_cache is None:
+            self._chunk_cache = morphlib.chunkcache.UnpackedChunkCache(
+                os.path.join(self._app.settings['tempdir'], 'chunks'))
+        with self._chunk_cache.get(os.path.basename(handle.name),
+                                   unpack) as (unpacked_artifact, manifest):
+            if not os.path.exists(self.dirname):
+                self._mkdir(self.dirname)
+            self.install_manifest(unpacked_artifact, manifest, self.dirname)
+        self._readonly_paths.clear()
+
+    def readonly_paths(self, root, writable_paths):
+        '''Return what to mount read-only to run a command in root.
+
+        This is what morphlib.util.readonly_paths returns, but root is
+        only walked again once something is installed in the staging
+        area, or something is added to or removed from the directories
+        the walk goes into. Those are root and the directories the
+        writable paths are in, where the commands run before may have
+        made new files, and which are listed each time to check.
 
-        if not os.path.exists(self.dirname):
-            self._mkdir(self.dirname)
+        '''
 
-        self.hardlink_all_files(unpacked_artifact, self.dirname)
+        key = (root, tuple(sorted(writable_paths)))
+        listings = self._walked_listings(root, writable_paths)
+        if (key not in self._readonly_paths or
+                self._readonly_paths[key][0] != listings):
+            self._readonly_paths[key] = (
+                listings, morphlib.util.readonly_paths(root, writable_paths))
+        return self._readonly_paths[key][1]
+
+    def _walked_listings(self, root, writable_paths):
+        dirnames = set([root])
+        for path in writable_paths:
+            relpath = os.path.relpath(path, root)
+            while relpath not in ('', '.') and not relpath.startswith('..'):
+                relpath = os.path.dirname(relpath)
+                dirnames.add(os.path.join(root, relpath))
+        listings = []
+        for dirname in sorted(dirnames):
+            try:
+                listings.append((dirname, sorted(os.listdir(dirname))))
+            except OSError:
+                listings.append((dirname, None))
+        return listings
 
     def remove(self):
         '''Remove the entire staging area.
@@ -245,6 +453,19 @@ class StagingArea(object):
         # No cleanup is currently required
         pass
 
+    def chroot_writable_dirs(self, env=None):
+        '''Return where a build in a chroot may write, outside its own dirs.
+
+        The directories are relative to the root of the staging area.
+        They depend on TMPDIR in env, which defaults to the environment
+        of the staging area.
+
+        '''
+
+        if env is None:
+            env = self.env
+        return ['dev', 'proc', env.get('TMPDIR', '/tmp').lstrip('/')]
+
     def runcmd(self, argv, **kwargs):  # pragma: no cover
         '''Run a command in a chroot in the staging area.'''
         assert 'env' not in kwargs
@@ -260,7 +481,7 @@ class StagingArea(object):
 
         staging_dirs = [self.builddirname, self.destdirname]
         if self.use_chroot:
-            staging_dirs += ["dev", "proc", temp_dir.lstrip('/')]
+            staging_dirs += self.chroot_writable_dirs(kwargs["env"])
         do_not_mount_dirs = [os.path.join(self.dirname, d)
                              for d in staging_dirs]
         if not self.use_chroot:
@@ -287,18 +508,19 @@ class StagingArea(object):
             mounts=mounts,
             mount_proc=mount_proc,
             binds=binds,
-            writable_paths=do_not_mount_dirs)
+            writable_paths=do_not_mount_dirs,
+            readonly_paths=self.readonly_paths(chroot_dir, do_not_mount_dirs))
 
         cmdline = morphlib.util.containerised_cmdline(
             argv, **container_config)
 
-        if kwargs.get('logfile') != None:
-            logfile = kwargs.pop('logfile')
-            teecmd = ['tee', '-a', logfile]
-            exit, out, err = self._app.runcmd_unchecked(
-                cmdline, teecmd, **kwargs)
+        makeflags = kwargs.get('env', {}).get('MAKEFLAGS', '')
+        if self.jobserver is not None and '--jobserver-fds' in makeflags:
+            with self.jobserver.lend() as fifo:
+                exit, out, err = self._runcmd_unchecked(
+                    self.jobserver.wrap_command(cmdline, fifo), kwargs)
         else:
-            exit, out, err = self._app.runcmd_unchecked(cmdline, **kwargs)
+            exit, out, err = self._runcmd_unchecked(cmdline, kwargs)
 
         if exit == 0:
             return out
@@ -309,6 +531,14 @@ class StagingArea(object):
             raise cliapp.AppException(
                 'In staging area %s: %s' % (self._failed_location(), msg))
 
+    def _runcmd_unchecked(self, cmdline, kwargs):  # pragma: no cover
+        if kwargs.get('logfile') != None:
+            logfile = kwargs.pop('logfile')
+            teecmd = ['tee', '-a', logfile]
+            return self._app.runcmd_unchecked(cmdline, teecmd, **kwargs)
+        else:
+            return self._app.runcmd_unchecked(cmdline, **kwargs)
+
     def _failed_location(self):  # pragma: no cover
         '''Path this staging area will be moved to if an error occurs.'''
         return os.path.join(self._app.settings['tempdir'], 'failed',
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,6 +17,7 @@
 import cliapp
 import os
 import shutil
+import stat
 import tarfile
 import tempfile
 import unittest
@@ -129,6 +130,221 @@ class StagingAreaTests(unittest.TestCase):
             self.sa.install_artifact(f)
         self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
 
+    def test_saves_manifest_when_unpacking_artifact(self):
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifact(f)
+        manifest = morphlib.stagingarea.read_manifest(
+            os.path.join(self.tempdir, 'chunks', 'chunk.tar.manifest'))
+        self.assertEqual(manifest, [('f', 'file.txt')])
+
+    def test_reuses_readonly_paths_until_artifact_installed(self):
+        os.makedirs(os.path.join(self.staging, 'bin'))
+        writable = [os.path.join(self.staging, 'tmp')]
+        paths = self.sa.readonly_paths(self.staging, writable)
+        self.assertEqual(paths, ['bin'])
+        os.mkdir(os.path.join(self.staging, 'bin', 'sub'))
+        self.assertIs(self.sa.readonly_paths(self.staging, writable), paths)
+        with open(self.create_chunk(), 'rb') as f:
+            self.sa.install_artifact(f)
+        self.assertEqual(
+            sorted(self.sa.readonly_paths(self.staging, writable)),
+            ['bin', 'file.txt'])
+
+    def test_finds_readonly_paths_again_when_top_level_changes(self):
+        os.makedirs(os.path.join(self.staging, 'bin'))
+        writable = [os.path.join(self.staging, 'tmp')]
+        self.assertEqual(self.sa.readonly_paths(self.staging, writable),
+                         ['bin'])
+        os.mkdir(os.path.join(self.staging, 'usr'))
+        self.assertEqual(
+            sorted(self.sa.readonly_paths(self.staging, writable)),
+            ['bin', 'usr'])
+
+    def test_finds_readonly_paths_again_when_writable_parent_changes(self):
+        os.makedirs(os.path.join(self.staging, 'var', 'tmp'))
+        writable = [os.path.join(self.staging, 'var', 'tmp'),
+                    os.path.join(self.staging, 'var', 'run', 'lock'),
+                    '/outside']
+        self.assertEqual(self.sa.readonly_paths(self.staging, writable), [])
+        os.mkdir(os.path.join(self.staging, 'var', 'log'))
+        self.assertEqual(self.sa.readonly_paths(self.staging, writable),
+                         ['var/log'])
+
+    def make_tree(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        os.makedirs(os.path.join(srcdir, 'usr', 'lib'))
+        for name in ('usr/lib/libfoo.so.1', 'odd\nname '):
+            with open(os.path.join(srcdir, name), 'w') as f:
+                f.write(name)
+        os.symlink('libfoo.so.1', os.path.join(srcdir, 'usr/lib/libfoo.so'))
+        os.symlink('usr/lib', os.path.join(srcdir, 'lib'))
+        return srcdir
+
+    def test_manifest_survives_saving(self):
+        manifest = morphlib.stagingarea.make_manifest(self.make_tree())
+        filename = os.path.join(self.tempdir, 'manifest')
+        morphlib.stagingarea.write_manifest(filename, manifest)
+        self.assertEqual(morphlib.stagingarea.read_manifest(filename),
+                         manifest)
+        self.assertEqual(sorted(manifest), [
+            ('d', 'usr'),
+            ('d', 'usr/lib'),
+            ('f', 'odd\nname '),
+            ('f', 'usr/lib/libfoo.so.1'),
+            ('l', 'lib', 'usr/lib'),
+            ('l', 'usr/lib/libfoo.so', 'libfoo.so.1'),
+        ])
+
+    def test_rejects_invalid_manifest(self):
+        filename = os.path.join(self.tempdir, 'manifest')
+        for data in ('f', 'f\0', 'q\0foo\0', 'l\0foo\0'):
+            with open(filename, 'w') as f:
+                f.write(data)
+            self.assertRaises(ValueError,
+                              morphlib.stagingarea.read_manifest, filename)
+
+    def test_manifest_puts_directories_before_contents(self):
+        manifest = morphlib.stagingarea.make_manifest(self.make_tree())
+        paths = [entry[1] for entry in manifest]
+        self.assertTrue(paths.index('usr') < paths.index('usr/lib') <
+                        paths.index('usr/lib/libfoo.so.1'))
+
+    def test_installs_manifest_over_earlier_files(self):
+        srcdir = self.make_tree()
+        os.makedirs(os.path.join(self.staging, 'usr', 'lib'))
+        with open(os.path.join(self.staging, 'usr/lib/libfoo.so'), 'w'):
+            pass
+        self.sa.install_manifest(
+            srcdir, morphlib.stagingarea.make_manifest(srcdir),
+            self.staging)
+        self.assertEqual(self.list_tree(self.staging), self.list_tree(srcdir))
+        self.assertEqual(
+            os.readlink(os.path.join(self.staging, 'usr/lib/libfoo.so')),
+            'libfoo.so.1')
+        self.assertTrue(os.path.samefile(
+            os.path.join(srcdir, 'usr/lib/libfoo.so.1'),
+            os.path.join(self.staging, 'usr/lib/libfoo.so.1')))
+
+    def test_installs_manifest_through_symlinks_to_directories(self):
+        srcdir = self.make_tree()
+        os.makedirs(os.path.join(self.staging, 'opt'))
+        os.symlink('opt', os.path.join(self.staging, 'usr'))
+        self.sa.install_manifest(
+            srcdir, morphlib.stagingarea.make_manifest(srcdir),
+            self.staging)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.staging, 'opt/lib/libfoo.so.1')))
+
+    def test_does_not_install_directory_over_file(self):
+        srcdir = self.make_tree()
+        os.makedirs(self.staging)
+        with open(os.path.join(self.staging, 'usr'), 'w'):
+            pass
+        self.assertRaises(IOError, self.sa.install_manifest, srcdir,
+                          morphlib.stagingarea.make_manifest(srcdir),
+                          self.staging)
+
+    def test_installs_large_manifest_in_batches(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        os.makedirs(srcdir)
+        for i in xrange(50):
+            open(os.path.join(srcdir, 'file%d' % i), 'w').close()
+        old_size = morphlib.stagingarea.MANIFEST_BATCH_SIZE
+        morphlib.stagingarea.MANIFEST_BATCH_SIZE = 7
+        try:
+            os.makedirs(self.staging)
+            self.sa.hardlink_all_files(srcdir, self.staging)
+        finally:
+            morphlib.stagingarea.MANIFEST_BATCH_SIZE = old_size
+        self.assertEqual(self.list_tree(self.staging), self.list_tree(srcdir))
+
+    def test_raises_error_from_batch(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        os.makedirs(srcdir)
+        manifest = []
+        for i in xrange(20):
+            open(os.path.join(srcdir, 'file%d' % i), 'w').close()
+            manifest.append(('f', 'file%d' % i))
+        manifest.append(('x', 'fifo'))
+        old_size = morphlib.stagingarea.MANIFEST_BATCH_SIZE
+        morphlib.stagingarea.MANIFEST_BATCH_SIZE = 7
+        try:
+            os.makedirs(self.staging)
+            self.assertRaises(IOError, self.sa.install_manifest,
+                              srcdir, manifest, self.staging)
+        finally:
+            morphlib.stagingarea.MANIFEST_BATCH_SIZE = old_size
+
+    def test_installs_entries_for_same_place_in_manifest_order(self):
+        srcdir = os.path.join(self.tempdir, 'src')
+        os.makedirs(os.path.join(srcdir, 'lib'))
+        os.makedirs(os.path.join(srcdir, 'usr/lib'))
+        manifest = [('d', 'lib'), ('d', 'usr'), ('d', 'usr/lib')]
+        for dirname in ('lib', 'usr/lib'):
+            for i in xrange(200):
+                path = '%s/file%d' % (dirname, i)
+                open(os.path.join(srcdir, path), 'w').close()
+                manifest.append(('f', path))
+        os.makedirs(os.path.join(self.staging, 'usr/lib'))
+        os.symlink('usr/lib', os.path.join(self.staging, 'lib'))
+        old_size = morphlib.stagingarea.MANIFEST_BATCH_SIZE
+        morphlib.stagingarea.MANIFEST_BATCH_SIZE = 200
+        try:
+            self.sa.install_manifest(srcdir, manifest, self.staging)
+        finally:
+            morphlib.stagingarea.MANIFEST_BATCH_SIZE = old_size
+        for i in xrange(200):
+            path = 'usr/lib/file%d' % i
+            self.assertTrue(os.path.samefile(
+                os.path.join(srcdir, path), os.path.join(self.staging, path)))
+
+    @unittest.skipIf(os.getuid() != 0, 'making devices needs root')
+    def test_lists_and_installs_devices(self): # pragma: no cover
+        srcdir = os.path.join(self.tempdir, 'src')
+        os.makedirs(srcdir)
+        null = os.path.join(srcdir, 'null')
+        os.mknod(null, stat.S_IFCHR | 0600, os.makedev(1, 3))
+        os.mkfifo(os.path.join(srcdir, 'fifo'))
+        mode = os.lstat(null).st_mode
+        filename = os.path.join(self.tempdir, 'manifest')
+        morphlib.stagingarea.write_manifest(
+            filename, morphlib.stagingarea.make_manifest(srcdir))
+        manifest = morphlib.stagingarea.read_manifest(filename)
+        self.assertEqual(sorted(manifest), [
+            ('n', 'null', mode, os.makedev(1, 3)),
+            ('x', 'fifo'),
+        ])
+        os.makedirs(self.staging)
+        self.sa.install_manifest(srcdir, [('n', 'null', mode,
+                                           os.makedev(1, 3))], self.staging)
+        st = os.lstat(os.path.join(self.staging, 'null'))
+        self.assertEqual((st.st_mode, st.st_rdev), (mode, os.makedev(1, 3)))
+
+    def test_installs_special_files(self):
+        os.makedirs(self.staging)
+        self.sa.install_manifest(self.tempdir,
+                                 [('n', 'fifo', stat.S_IFIFO | 0600, 0)],
+                                 self.staging)
+        self.assertTrue(stat.S_ISFIFO(
+            os.lstat(os.path.join(self.staging, 'fifo')).st_mode))
+
+    def test_raises_error_making_directory(self):
+        os.makedirs(self.staging)
+        self.assertRaises(OSError, self.sa.install_manifest, self.tempdir,
+                          [('d', 'missing/dir')], self.staging)
+
+    def test_raises_error_linking_file(self):
+        os.makedirs(self.staging)
+        self.assertRaises(OSError, self.sa.install_manifest, self.tempdir,
+                          [('f', 'missing')], self.staging)
+
+    def test_lists_directories_chroot_builds_may_write_to(self):
+        self.assertEqual(self.sa.chroot_writable_dirs(),
+                         ['dev', 'proc', 'tmp'])
+        self.assertEqual(self.sa.chroot_writable_dirs({'TMPDIR': '/var/tmp'}),
+                         ['dev', 'proc', 'var/tmp'])
+
     def test_removes_everything(self):
         chunk_tar = self.create_chunk()
         with open(chunk_tar, 'rb') as f:
@@ -0,0 +1,196 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+
+class StagingAreaCache(object):
+
+    '''Keep the roots of staging areas, to build in them again.
+
+    Installing the dependencies of a chunk into a staging area takes a
+    hard link for every file of every dependency, and many chunks have
+    much the same dependencies. After a build, the root of its staging
+    area, with the dependencies installed, is kept as a snapshot. A later
+    build whose dependencies start with the same ones, in the same order,
+    takes the snapshot as the root of its own staging area, and installs
+    only the rest.
+
+    A snapshot is used by one build at a time: taking it moves it out of
+    the cache, and it goes back in when the build is done. A build runs
+    in a chroot where all of the root is read-only, apart from a few
+    directories; whatever the build adds to those is removed again when
+    the snapshot is kept. If the build changed anything else in them,
+    the staging area is not kept.
+
+    At most ``max_snapshots`` are kept in ``dirname``. Once there are
+    more, those used longest ago are removed.
+
+    '''
+
+    def __init__(self, dirname, max_snapshots):
+        self.dirname = dirname
+        self.max_snapshots = max_snapshots
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _keys(self, basenames):
+        '''Return the key of each leading part of a list of basenames.'''
+
+        sha1 = hashlib.sha1()
+        keys = []
+        for basename in basenames:
+            sha1.update(basename + '\n')
+            keys.append(sha1.hexdigest())
+        return keys
+
+    def take(self, basenames, rootdir):
+        '''Move the best snapshot for some artifacts to rootdir.
+
+        The best snapshot is the one with the most of the artifacts,
+        named by their basenames, installed in the order given. rootdir
+        must be empty if it exists. Return how many of the artifacts are
+        installed in rootdir, 0 if no snapshot has any of them.
+
+        '''
+
+        keys = self._keys(basenames)
+        for count in xrange(len(keys), 0, -1):
+            snapshot = os.path.join(self.dirname, keys[count - 1])
+            try:
+                os.rename(snapshot, rootdir)
+            except OSError:
+                continue  # not kept, or another build has it
+            logging.debug('Took staging area snapshot %s with %d of %d '
+                          'artifacts' % (snapshot, count, len(basenames)))
+            return count
+        return 0
+
+    def listing(self, rootdir, writable_dirs):
+        '''Return what is in the places a build may change in a staging area.
+
+        writable_dirs are the directories a build can write to, relative
+        to rootdir, as given by StagingArea.chroot_writable_dirs. A build
+        may also add its own build and install directories to rootdir.
+        This is passed to ``keep`` after the build, to check that those
+        places are as they were before it, once what it added is removed.
+
+        '''
+
+        listing = {'': self._status(rootdir, recurse=False)}
+        for dirname in writable_dirs:
+            path = os.path.join(rootdir, dirname)
+            if os.path.isdir(path) and not os.path.islink(path):
+                listing[dirname] = self._status(path, recurse=True)
+        return listing
+
+    def _status(self, path, recurse):
+        '''Return the status of what is in a directory, by relative path.
+
+        The status of a subdirectory is None, unless recurse is true,
+        when what is in it is included instead.
+
+        '''
+
+        status = {}
+        for dirpath, subdirs, filenames in os.walk(path):
+            for name in subdirs + filenames:
+                filename = os.path.join(dirpath, name)
+                st = os.lstat(filename)
+                if name in subdirs and not recurse:
+                    value = None
+                else:
+                    value = (st.st_mode, st.st_ino, st.st_size, st.st_mtime)
+                status[os.path.relpath(filename, path)] = value
+            if not recurse:
+                break
+        return status
+
+    def _restore(self, rootdir, listing):
+        '''Remove what a build added, and tell if it changed nothing else.'''
+
+        for dirname, before in listing.iteritems():
+            path = os.path.join(rootdir, dirname)
+            if not os.path.isdir(path) or os.path.islink(path):
+                return False
+            for name in os.listdir(path):
+                if name not in before:
+                    self._remove(os.path.join(path, name))
+            if self._status(path, recurse=dirname != '') != before:
+                return False
+        return True
+
+    def keep(self, rootdir, basenames, listing):
+        '''Keep the root of a staging area as a snapshot.
+
+        The artifacts named by basenames are installed in rootdir, in
+        that order, and listing is what ``listing`` returned after they
+        were installed. If the build changed rootdir other than by adding
+        to it, or the cache already has a snapshot of the same artifacts,
+        rootdir is removed instead.
+
+        '''
+
+        if not basenames:
+            self._remove(rootdir)
+            return
+        if not self._restore(rootdir, listing):
+            logging.debug('Not keeping staging area %s, as its build '
+                          'changed it' % rootdir)
+            self._remove(rootdir)
+            return
+        snapshot = os.path.join(self.dirname, self._keys(basenames)[-1])
+        try:
+            os.rename(rootdir, snapshot)
+        except OSError:
+            # Another build kept a snapshot of the same artifacts first.
+            self._remove(rootdir)
+            return
+        os.utime(snapshot, None)
+        self._evict()
+
+    def _evict(self):
+        snapshots = []
+        for name in os.listdir(self.dirname):
+            if name.startswith('.'):
+                continue  # being removed
+            path = os.path.join(self.dirname, name)
+            try:
+                snapshots.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass  # taken by another build meanwhile
+        snapshots.sort(reverse=True)
+        for mtime, path in snapshots[self.max_snapshots:]:
+            # Claim the snapshot first, so that no build takes it while it
+            # is being removed.
+            claimed = tempfile.mkdtemp(dir=self.dirname, prefix='.evict-')
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                os.rmdir(claimed)
+                continue
+            logging.debug('Removing staging area snapshot %s' % path)
+            self._remove(claimed)
+
+    def _remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
@@ -0,0 +1,184 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class StagingAreaCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.stagingareacache.StagingAreaCache(
+            os.path.join(self.tempdir, 'snapshots'), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_root(self, *files):
+        rootdir = tempfile.mkdtemp(dir=self.tempdir)
+        for filename in files:
+            path = os.path.join(rootdir, filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(filename)
+        return rootdir
+
+    def listing(self, rootdir):
+        return self.cache.listing(rootdir, ['dev', 'proc', 'tmp'])
+
+    def keep(self, rootdir, basenames):
+        self.cache.keep(rootdir, basenames, self.listing(rootdir))
+
+    def write(self, rootdir, filename, contents=''):
+        path = os.path.join(rootdir, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def snapshots(self):
+        return os.listdir(self.cache.dirname)
+
+    def test_takes_nothing_when_empty(self):
+        rootdir = self.make_root()
+        self.assertEqual(self.cache.take(['a', 'b'], rootdir), 0)
+        self.assertEqual(os.listdir(rootdir), [])
+
+    def test_takes_snapshot_of_same_artifacts(self):
+        self.keep(self.make_root('usr/bin/a', 'usr/bin/b'), ['a', 'b'])
+        rootdir = self.make_root()
+        self.assertEqual(self.cache.take(['a', 'b'], rootdir), 2)
+        self.assertTrue(os.path.exists(os.path.join(rootdir, 'usr/bin/b')))
+        self.assertEqual(self.snapshots(), [])
+
+    def test_takes_snapshot_of_most_leading_artifacts(self):
+        self.keep(self.make_root('a'), ['a'])
+        self.keep(self.make_root('a', 'b'), ['a', 'b'])
+        rootdir = self.make_root()
+        self.assertEqual(self.cache.take(['a', 'b', 'c'], rootdir), 2)
+        self.assertEqual(sorted(os.listdir(rootdir)), ['a', 'b'])
+
+    def test_does_not_take_snapshot_in_other_order(self):
+        self.keep(self.make_root('a', 'b'), ['a', 'b'])
+        rootdir = self.make_root()
+        self.assertEqual(self.cache.take(['b', 'a'], rootdir), 0)
+
+    def test_snapshot_is_taken_only_once(self):
+        self.keep(self.make_root('a'), ['a'])
+        self.assertEqual(self.cache.take(['a'], self.make_root()), 1)
+        self.assertEqual(self.cache.take(['a'], self.make_root()), 0)
+
+    def test_removes_what_build_added(self):
+        rootdir = self.make_root('usr/bin/a', 'tmp/keep', 'dev/null')
+        listing = self.listing(rootdir)
+        for filename in ('tmp/junk', 'dev/shm/junk', 'proc/x', 'a.build/x',
+                         'a.inst/usr/bin/a'):
+            self.write(rootdir, filename)
+        self.cache.keep(rootdir, ['a'], listing)
+
+        rootdir = self.make_root()
+        self.cache.take(['a'], rootdir)
+        self.assertEqual(sorted(os.listdir(rootdir)), ['dev', 'tmp', 'usr'])
+        self.assertEqual(os.listdir(os.path.join(rootdir, 'tmp')), ['keep'])
+        self.assertEqual(os.listdir(os.path.join(rootdir, 'dev')), ['null'])
+
+    def test_removes_what_build_added_to_its_tmpdir(self):
+        rootdir = self.make_root('var/tmp/keep')
+        listing = self.cache.listing(rootdir, ['var/tmp'])
+        self.write(rootdir, 'var/tmp/junk')
+        self.cache.keep(rootdir, ['a'], listing)
+        rootdir = self.make_root()
+        self.cache.take(['a'], rootdir)
+        self.assertEqual(os.listdir(os.path.join(rootdir, 'var/tmp')),
+                         ['keep'])
+
+    def assertNotKept(self, files, change, writable_dirs=['tmp']):
+        rootdir = self.make_root(*files)
+        listing = self.cache.listing(rootdir, writable_dirs)
+        change(rootdir)
+        self.cache.keep(rootdir, ['a'], listing)
+        self.assertFalse(os.path.exists(rootdir))
+        self.assertEqual(self.snapshots(), [])
+
+    def test_does_not_keep_staging_area_whose_files_build_changed(self):
+        self.assertNotKept(
+            ['tmp/keep'],
+            lambda rootdir: self.write(rootdir, 'tmp/keep', 'changed'))
+
+    def test_does_not_keep_staging_area_whose_files_build_removed(self):
+        self.assertNotKept(
+            ['tmp/keep'],
+            lambda rootdir: os.remove(os.path.join(rootdir, 'tmp/keep')))
+
+    def test_does_not_keep_staging_area_build_added_to_deep_inside(self):
+        self.assertNotKept(
+            ['tmp/dir/keep'],
+            lambda rootdir: self.write(rootdir, 'tmp/dir/junk'))
+
+    def test_does_not_keep_staging_area_with_top_level_file_changed(self):
+        self.assertNotKept(
+            ['top'],
+            lambda rootdir: self.write(rootdir, 'top', 'changed'))
+
+    def test_does_not_keep_staging_area_with_writable_dir_removed(self):
+        self.assertNotKept(
+            ['var/tmp/keep'],
+            lambda rootdir: shutil.rmtree(os.path.join(rootdir, 'var/tmp')),
+            writable_dirs=['var/tmp'])
+
+    def test_does_not_keep_second_snapshot_of_same_artifacts(self):
+        self.keep(self.make_root('a'), ['a'])
+        second = self.make_root('a')
+        self.keep(second, ['a'])
+        self.assertFalse(os.path.exists(second))
+        self.assertEqual(len(self.snapshots()), 1)
+
+    def test_does_not_keep_snapshot_of_nothing(self):
+        rootdir = self.make_root()
+        self.keep(rootdir, [])
+        self.assertFalse(os.path.exists(rootdir))
+        self.assertEqual(self.snapshots(), [])
+
+    def test_removes_snapshots_used_longest_ago(self):
+        for i, name in enumerate(['a', 'b', 'c']):
+            self.keep(self.make_root(name), [name])
+            snapshot = os.path.join(self.cache.dirname,
+                                    self.cache._keys([name])[0])
+            os.utime(snapshot, (i, i))
+        self.keep(self.make_root('d'), ['d'])
+        self.assertEqual(len(self.snapshots()), 2)
+        self.assertEqual(self.cache.take(['a'], self.make_root()), 0)
+        self.assertEqual(self.cache.take(['b'], self.make_root()), 0)
+        self.assertEqual(self.cache.take(['c'], self.make_root()), 1)
+        self.assertEqual(self.cache.take(['d'], self.make_root()), 1)
+
+    def test_leaves_alone_what_is_not_a_snapshot(self):
+        os.mkdir(os.path.join(self.cache.dirname, '.evict-other'))
+        self.write(self.cache.dirname, 'stray')
+        os.utime(os.path.join(self.cache.dirname, 'stray'), (0, 0))
+        os.symlink('missing', os.path.join(self.cache.dirname, 'dangling'))
+        for name in ['a', 'b', 'c']:
+            self.keep(self.make_root(name), [name])
+        self.assertEqual(
+            sorted(n for n in self.snapshots() if len(n) != 40),
+            ['.evict-other', 'dangling', 'stray'])
+        self.assertEqual(len(self.snapshots()), 5)
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2015, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,6 +15,7 @@
 
 import contextlib
 import itertools
+import logging
 import os
 import pipes
 import re
@@ -142,6 +143,40 @@ def new_artifact_caches(settings):  # pragma: no cover
     return lac, rac
 
 
+def new_graph_cache(settings):  # pragma: no cover
+    '''Create the cache of resolved build graphs, or return None.
+
+    There is no cache if it is disabled in the settings, or if morph is
+    run from a modified source tree, since then the version of morph does
+    not say how the graphs were resolved.
+
+    '''
+
+    if settings['no-graph-cache']:
+        return None
+    if morphlib.gitversion.version.endswith('-unreproducible'):
+        logging.debug('Not caching build graphs: morph has local changes')
+        return None
+    cachedir = create_cachedir(settings)
+    return morphlib.graphcache.GraphCache(os.path.join(cachedir, 'graphs'))
+
+
+def new_morphology_cache(settings):  # pragma: no cover
+    '''Create the cache of loaded morphologies.
+
+    Morphologies are only kept in memory if morph is run from a modified
+    source tree, since then the version of morph does not say how they
+    were validated.
+
+    '''
+
+    if morphlib.gitversion.version.endswith('-unreproducible'):
+        return morphlib.morphologycache.MorphologyCache()
+    cachedir = create_cachedir(settings)
+    return morphlib.morphologycache.MorphologyCache(
+        os.path.join(cachedir, 'morphologies'))
+
+
 def combine_aliases(app):  # pragma: no cover
     '''Create a full repo-alias set from the app's settings.
 
@@ -579,9 +614,24 @@ def unshared_cmdline(args, root='/', mounts=()): # pragma: no cover
     return cmdline
 
 
+def readonly_paths(root, writable_paths):
+    '''Return what to mount read-only to leave only writable_paths writable.
+
+    The paths returned are relative to root, which is walked to find
+    them. Symbolic links are left out, since they cannot be mounted.
+
+    '''
+
+    return [os.path.relpath(path, root)
+            for path in morphlib.fsutils.invert_paths(os.walk(root),
+                                                      writable_paths)
+            if not os.path.islink(path)]
+
+
 def containerised_cmdline(args, cwd='.', root='/', binds=(),
                           mount_proc=False, unshare_net=False,
-                          writable_paths=None, **kwargs): # pragma: no cover
+                          writable_paths=None, readonly_paths=None,
+                          **kwargs): # pragma: no cover
     '''
     Describe how to run 'args' inside a linux-user-chroot container.
     
@@ -605,6 +655,10 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     The subprocess will be run in a separate mount namespace. It can
     optionally be run in a separate network namespace too by setting
     'unshare_net'.
+
+    Finding what to make read-only walks 'root'. A caller that runs many
+    commands in the same root can pass what readonly_paths() returned
+    for it as 'readonly_paths' instead.
     
     '''
 
@@ -619,9 +673,10 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     for src, dst in binds:
         # linux-user-chroot's mount target paths are relative to the chroot
         cmdargs.extend(('--mount-bind', src, os.path.relpath(dst, root)))
-    for d in morphlib.fsutils.invert_paths(os.walk(root), writable_paths):
-        if not os.path.islink(d):
-            cmdargs.extend(('--mount-readonly', os.path.relpath(d, root)))
+    if readonly_paths is None:
+        readonly_paths = morphlib.util.readonly_paths(root, writable_paths)
+    for d in readonly_paths:
+        cmdargs.extend(('--mount-readonly', d))
     if mount_proc:
         proc_target = os.path.join(root, 'proc')
         if not os.path.exists(proc_target):
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -136,3 +136,27 @@ class IterTrickleTests(unittest.TestCase):
     def test_truncated_final_sequence(self):
         self.assertEqual(list(morphlib.util.iter_trickle("barquux", 3)),
                          [["b", "a", "r"], ["q", "u", "u"], ["x"]])
+
+
+class ReadonlyPathsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for dirname in ('bin', 'usr/lib', 'usr/share', 'tmp'):
+            os.makedirs(os.path.join(self.tempdir, dirname))
+        open(os.path.join(self.tempdir, 'usr', 'file'), 'w').close()
+        os.symlink('usr/lib', os.path.join(self.tempdir, 'lib'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lists_all_but_writable_paths_relative_to_root(self):
+        writable = [os.path.join(self.tempdir, 'tmp'),
+                    os.path.join(self.tempdir, 'usr', 'share')]
+        self.assertEqual(
+            sorted(morphlib.util.readonly_paths(self.tempdir, writable)),
+            ['bin', 'usr/file', 'usr/lib'])
+
+    def test_lists_nothing_if_root_is_writable(self):
+        self.assertEqual(
+            morphlib.util.readonly_paths(self.tempdir, [self.tempdir]), [])
@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -24,7 +24,8 @@ if morphlib.got_yaml: # pragma: no cover
 if morphlib.got_yaml: # pragma: no cover
 
     def load(*args, **kwargs):
-        return yaml.safe_load(*args, **kwargs)
+        kwargs['Loader'] = morphlib.morphloader.SafeLoader
+        return yaml.load(*args, **kwargs)
 
     def dump(*args, **kwargs):
         if 'default_flow_style' not in kwargs: